@@ -26,6 +26,11 @@ try:
 except ImportError:
     import json
 import copy
+import re
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
 
 from time import localtime, asctime
 
@@ -59,6 +64,8 @@ EGRESS_ACL_TABLE=3
 L3_LOOKUP_TABLE=4
 # table has flow rules derived from egress ACL's
 INGRESS_ACL_TABLE=5
+# IP protocol numbers of the protocols of the network ACL items, all protocols are matched with a wildcard
+ACL_PROTOCOLS = {"all": "*", "tcp": "6", "udp": "17", "icmp": "1"}
 
 class PluginError(Exception):
     """Base Exception class for all plugin errors."""
@@ -133,6 +140,114 @@ def do_cmd(cmd):
     return output
 
 
+class XapiCache(object):
+    """
+    Looks up XAPI objects with the XenAPI bindings over the local xapi socket instead of forking xe for each of
+    them. One session is used for the whole plugin call, the plugin's own when it is given one, and the records of
+    each class are read once with get_all_records and kept until release_xapi() ends the call.
+    """
+
+    def __init__(self, session=None):
+        self.session = session
+        self.own_session = False
+        self.records = {}
+        self.host = None
+
+    def xenapi(self):
+        if self.session is None:
+            import XenAPI
+            self.session = XenAPI.xapi_local()
+            self.session.login_with_password("", "")
+            self.own_session = True
+        return self.session.xenapi
+
+    def close(self):
+        if self.own_session:
+            try:
+                self.session.xenapi.session.logout()
+            except Exception, e:
+                logging.debug("Failed to log out of the XAPI session: %s" % str(e))
+        self.session = None
+        self.own_session = False
+        self.records = {}
+        self.host = None
+
+    def get_all_records(self, cls):
+        """ Returns the records of all the objects of a class such as VM, VIF or network, keyed by reference """
+        if cls not in self.records:
+            self.records[cls] = getattr(self.xenapi(), cls).get_all_records()
+        return self.records[cls]
+
+    def find(self, cls, **fields):
+        """ Returns the (reference, record) of the objects of a class whose fields have the given values """
+        found = []
+        for ref, record in self.get_all_records(cls).items():
+            for field, value in fields.items():
+                if record.get(field) != value:
+                    break
+            else:
+                found.append((ref, record))
+        return found
+
+    def find_one(self, cls, **fields):
+        found = self.find(cls, **fields)
+        if len(found) != 1:
+            raise PluginError("Found %s %s objects with %s" % (len(found), cls, fields))
+        return found[0]
+
+    def get_record(self, cls, ref):
+        return self.get_all_records(cls)[ref]
+
+    def this_host(self):
+        """ Returns the reference of the host the plugin runs on """
+        if self.host is None:
+            self.host = self.xenapi().session.get_this_host(self.session._session)
+        return self.host
+
+    def get_vif(self, domain_id, device_id):
+        """ Returns the (reference, record) of the VIF of a domain of this host, as named by vif<domid>.<device> """
+        vm_ref = self.find_one('VM', domid=str(domain_id), resident_on=self.this_host())[0]
+        return self.find_one('VIF', VM=vm_ref, device=str(device_id))
+
+    def get_network_by_bridge(self, bridge):
+        return self.find_one('network', bridge=bridge)
+
+    def get_other_config_values(self, cls, refs, key):
+        """ Returns the values of a key of the other-config of objects of a class, keyed by reference """
+        values = {}
+        for ref in refs:
+            other_config = self.get_record(cls, ref)['other_config']
+            if key in other_config:
+                values[ref] = other_config[key]
+        return values
+
+    def set_other_config(self, cls, ref, key, value):
+        api = getattr(self.xenapi(), cls)
+        api.remove_from_other_config(ref, key)
+        api.add_to_other_config(ref, key, value)
+        if cls in self.records:
+            self.records[cls][ref]['other_config'][key] = value
+
+
+_xapi = None
+
+def get_xapi(session=None):
+    """
+    Returns the XapiCache of the current plugin call, starting one on the session when there is none yet
+    """
+    global _xapi
+    if _xapi is None:
+        _xapi = XapiCache(session)
+    return _xapi
+
+def release_xapi():
+    """ Ends the XAPI session and drops the records cached by the current plugin call """
+    global _xapi
+    if _xapi is not None:
+        _xapi.close()
+        _xapi = None
+
+
 def _is_process_run(pidFile, name):
     try:
         fpid = open(pidFile, "r")
@@ -201,9 +316,11 @@ def _build_flow_expr(**kwargs):
     table = 'table' in kwargs and ",table=%s" % kwargs['table'] or ''
     cookie = 'cookie' in kwargs and ",cookie=%s" % kwargs['cookie'] or ''
     proto = 'proto' in kwargs and ",%s" % kwargs['proto'] or ''
-    ip = ('nw_src' in kwargs or 'nw_dst' in kwargs) and ',ip' or ''
+    nw_proto = 'nw_proto' in kwargs and ",nw_proto=%s" % kwargs['nw_proto'] or ''
+    tp_dst = 'tp_dst' in kwargs and ",tp_dst=%s" % kwargs['tp_dst'] or ''
+    ip = ('nw_src' in kwargs or 'nw_dst' in kwargs or 'nw_proto' in kwargs) and ',ip' or ''
     flow = (flow + cookie+ in_port + dl_type + dl_src + dl_dst +
-            (ip or proto) + nw_src + nw_dst + table)
+            (ip or proto) + nw_src + nw_dst + nw_proto + tp_dst + table)
     return flow
 
 
@@ -232,6 +349,86 @@ def del_flows(bridge, **kwargs):
     do_cmd(delFlow)
 
 
+def get_flow_cookie(flow):
+    """ Returns the cookie a flow is tagged with by update_table_flows(), a 64 bit hash of its text """
+    return long(md5(flow).hexdigest()[:16], 16)
+
+def update_table_flows(bridge, tables, flows, name):
+    """
+    Brings the given tables of the bridge to the flows without flushing them first, flows of other tables are only
+    added. Each flow is tagged with the
+    cookie get_flow_cookie() hashes from it, so comparing the cookies of a dump of the bridge tells which flows are
+    new and which are stale. New flows are added over the ones with the same match they replace, and then the stale
+    ones are deleted. When the switch supports OpenFlow 1.4 bundles both happen in one transaction. Returns the
+    number of flows added and of cookies deleted.
+    """
+    wanted = {}
+    for flow in flows:
+        cookie = get_flow_cookie(flow)
+        if cookie not in wanted:
+            wanted[cookie] = "cookie=0x%x %s" % (cookie, flow)
+
+    present = {}
+    stale = []
+    for line in do_cmd([OFCTL_PATH, 'dump-flows', bridge]).split('\n'):
+        table = re.search(r'\btable=(\d+)', line)
+        cookie = re.search(r'\bcookie=(0x[0-9a-fA-F]+)', line)
+        if table is None or cookie is None:
+            continue
+        table = int(table.group(1))
+        cookie = long(cookie.group(1), 16)
+        if cookie in wanted:
+            present[cookie] = True
+        elif table in tables and (table, cookie) not in stale:
+            stale.append((table, cookie))
+
+    additions = []
+    for flow in flows:
+        cookie = get_flow_cookie(flow)
+        if cookie not in present:
+            present[cookie] = True
+            additions.append(wanted[cookie])
+    deletions = ["table=%s,cookie=0x%x/-1" % (table, cookie) for table, cookie in stale]
+
+    logging.debug("Flows of tables %s of bridge %s for %s: %s wanted, %s to add and %s cookies to delete" %
+                  (tables, bridge, name, len(wanted), len(additions), len(deletions)))
+    if not additions and not deletions:
+        return 0, 0
+
+    if not os.path.exists('/var/run/cloud'):
+        os.makedirs('/var/run/cloud')
+    ofspec_filename = "/var/run/cloud/" + bridge + "-" + name + ".ofspec"
+    try:
+        ofspec = open(ofspec_filename, 'w')
+        for flow in additions:
+            ofspec.write("add " + flow + "\n")
+        for flow in deletions:
+            ofspec.write("delete " + flow + "\n")
+        ofspec.close()
+        try:
+            do_cmd([OFCTL_PATH, '-O', 'OpenFlow14', '--bundle', 'add-flows', bridge, ofspec_filename])
+        except PluginError, e:
+            # no bundles in this version of Open vSwitch or on this bridge, add the flows and then delete the
+            # stale ones in two steps, still without a gap for the flows that are replaced
+            logging.debug("Applying the flows without a bundle as it failed with: %s" % str(e))
+            ofspec = open(ofspec_filename, 'w')
+            for flow in additions:
+                ofspec.write(flow + "\n")
+            ofspec.close()
+            if additions:
+                do_cmd([OFCTL_PATH, 'add-flows', bridge, ofspec_filename])
+            ofspec = open(ofspec_filename, 'w')
+            for flow in deletions:
+                ofspec.write(flow + "\n")
+            ofspec.close()
+            if deletions:
+                do_cmd(["/bin/bash", "-c", "%s del-flows %s - < %s" % (OFCTL_PATH, bridge, ofspec_filename)])
+    finally:
+        if os.path.isfile(ofspec_filename):
+            os.remove(ofspec_filename)
+    return len(additions), len(deletions)
+
+
 def del_all_flows(bridge):
     delFlow = [OFCTL_PATH, "del-flows", bridge]
     do_cmd(delFlow)
@@ -246,18 +443,56 @@ def del_port(bridge, port):
 
 def get_network_id_for_vif(vif_name):
     domain_id, device_id = vif_name[3:len(vif_name)].split(".")
-    hostname = do_cmd(["/bin/bash", "-c", "hostname"])
-    this_host_uuid = do_cmd([XE_PATH, "host-list", "hostname=%s" % hostname, "--minimal"])
-    dom_uuid = do_cmd([XE_PATH, "vm-list", "dom-id=%s" % domain_id, "resident-on=%s" %this_host_uuid, "--minimal"])
-    vif_uuid = do_cmd([XE_PATH, "vif-list", "vm-uuid=%s" % dom_uuid, "device=%s" % device_id, "--minimal"])
-    vnet = do_cmd([XE_PATH, "vif-param-get", "uuid=%s" % vif_uuid,  "param-name=other-config",
-                             "param-key=cloudstack-network-id"])
-    return vnet
+    vif_record = get_xapi().get_vif(domain_id, device_id)[1]
+    return vif_record['other_config'].get('cloudstack-network-id', '')
 
 def get_network_id_for_tunnel_port(tunnelif_name):
     vnet = do_cmd([VSCTL_PATH, "get", "interface", tunnelif_name, "options:cloudstack-network-id"])
     return vnet
 
+def _ovsdb_value(value):
+    """
+    Converts a column value of the json output of ovs-vsctl: maps become dicts, uuids strings and sets lists, with
+    an empty set such as the ofport of an interface without one becoming None.
+    """
+    if isinstance(value, list):
+        if value[0] == "map":
+            return dict(value[1])
+        if value[0] == "uuid":
+            return value[1]
+        if value[0] == "set":
+            if not value[1]:
+                return None
+            return [_ovsdb_value(v) for v in value[1]]
+    return value
+
+def get_bridge_interfaces(bridge):
+    """
+    Returns the interfaces of the ports of the bridge as dicts of their name, ofport, external_ids and options. All
+    of them are read with one ovs-vsctl list instead of a get per interface and column.
+    """
+    ports = do_cmd([VSCTL_PATH, 'list-ports', bridge]).split('\n')
+    table = json.loads(do_cmd([VSCTL_PATH, '--format=json', '--columns=name,ofport,external_ids,options',
+                               'list', 'Interface']))
+    interfaces = {}
+    for row in table['data']:
+        interface = {}
+        for heading, value in zip(table['headings'], row):
+            interface[heading] = _ovsdb_value(value)
+        interfaces[interface['name']] = interface
+    return [interfaces[port] for port in ports if port in interfaces]
+
+def get_network_ids_for_vifs(vif_uuids):
+    """
+    Returns the cloudstack-network-id of the other-config of the VIFs with the given uuids, keyed by uuid. The VIF
+    records are read in one XAPI query instead of looking each VIF up.
+    """
+    network_ids = {}
+    for record in get_xapi().get_all_records('VIF').values():
+        if record['uuid'] in vif_uuids and 'cloudstack-network-id' in record['other_config']:
+            network_ids[record['uuid']] = record['other_config']['cloudstack-network-id']
+    return network_ids
+
 def clear_flooding_rules_for_port(bridge, ofport):
         del_flows(bridge, in_port=ofport, table=L2_FLOOD_TABLE)
 
@@ -273,17 +508,13 @@ def get_ofport_for_vif(vif_name):
 
 def get_macaddress_of_vif(vif_name):
     domain_id, device_id = vif_name[3:len(vif_name)].split(".")
-    dom_uuid = do_cmd([XE_PATH, "vm-list", "dom-id=%s" % domain_id, "--minimal"])
-    vif_uuid = do_cmd([XE_PATH, "vif-list", "vm-uuid=%s" % dom_uuid, "device=%s" % device_id, "--minimal"])
-    mac = do_cmd([XE_PATH, "vif-param-get", "uuid=%s" % vif_uuid,  "param-name=MAC"])
-    return mac
+    return get_xapi().get_vif(domain_id, device_id)[1]['MAC']
 
 def get_vif_name_from_macaddress(macaddress):
-    vif_uuid = do_cmd([XE_PATH, "vif-list", "MAC=%s" % macaddress, "--minimal"])
-    vif_device_id = do_cmd([XE_PATH, "vif-param-get", "uuid=%s" % vif_uuid,  "param-name=device"])
-    vm_uuid = do_cmd([XE_PATH, "vif-param-get", "uuid=%s" % vif_uuid,  "param-name=vm-uuid"])
-    vm_domain_id = do_cmd([XE_PATH, "vm-param-get", "uuid=%s" % vm_uuid,  "param-name=dom-id"])
-    return "vif"+vm_domain_id+"."+vif_device_id
+    xapi = get_xapi()
+    vif_record = xapi.find_one('VIF', MAC=macaddress)[1]
+    vm_domain_id = xapi.get_record('VM', vif_record['VM'])['domid']
+    return "vif"+vm_domain_id+"."+vif_record['device']
 
 def add_mac_lookup_table_entry(bridge, mac_address, out_of_port):
     action = "output=%s" %out_of_port
@@ -421,8 +652,7 @@ def create_tunnel(bridge, remote_ip, gre_key, src_host, dst_host, network_uuid):
         if tun_ofport.endswith('\n'):
             tun_ofport = tun_ofport[:-1]
         # find xs network for this bridge, verify is used for ovs tunnel network
-        xs_nw_uuid = do_cmd([XE_PATH, "network-list",
-								   "bridge=%s" % bridge, "--minimal"])
+        xs_nw_uuid = get_xapi().get_network_by_bridge(bridge)[1]['uuid']
 
         ovs_tunnel_network = is_regular_tunnel_network(xs_nw_uuid)
         ovs_vpc_distributed_vr_network = is_vpc_network_with_distributed_routing(xs_nw_uuid)
@@ -477,12 +707,8 @@ def configure_vpc_bridge_for_network_topology(bridge, this_host_id, json_config,
         return "FAILURE:IMPROPER_JSON_CONFG_FILE"
 
     try:
-        if not os.path.exists('/var/run/cloud'):
-            os.makedirs('/var/run/cloud')
-
-        # create a temporary file to store OpenFlow rules corresponding to L2 and L3 lookup table updates
-        ofspec_filename = "/var/run/cloud/" + bridge + sequence_no + ".ofspec"
-        ofspec = open(ofspec_filename, 'w+')
+        # OpenFlow rules corresponding to L2 and L3 lookup table updates
+        flows = []
 
         # get the list of VM's in all the tiers of VPC running in this host from the JSON config
         this_host_vms = get_vpc_vms_on_host(vpconfig, this_host_id)
@@ -497,8 +723,8 @@ def configure_vpc_bridge_for_network_topology(bridge, this_host_id, json_config,
 
                 # Add OF rule in L2 look up table, if packet's destination mac matches MAC of the VM's nic
                 # then send packet on the found OFPORT
-                ofspec.write("table=%s" %L2_LOOKUP_TABLE + " priority=1100 dl_dst=%s " %mac_addr +
-                             " actions=output:%s" %of_port + "\n")
+                flows.append("table=%s" %L2_LOOKUP_TABLE + " priority=1100 dl_dst=%s " %mac_addr +
+                             " actions=output:%s" %of_port)
 
                 # Add OF rule in L3 look up table: if packet's destination IP matches VM's IP then modify the packet
                 # to set DST MAC = VM's MAC, SRC MAC= destination tier gateway MAC and send to egress table. This step
@@ -506,18 +732,18 @@ def configure_vpc_bridge_for_network_topology(bridge, this_host_id, json_config,
                 action_str = " mod_dl_src:%s"%network.gatewaymac + ",mod_dl_dst:%s" % mac_addr \
                              + ",resubmit(,%s)"%INGRESS_ACL_TABLE
                 action_str = "table=%s"%L3_LOOKUP_TABLE + " ip nw_dst=%s"%ip + " actions=%s" %action_str
-                ofspec.write(action_str + "\n")
+                flows.append(action_str)
 
                 # Add OF rule to send intra-tier traffic from this nic of the VM to L2 lookup path (L2 switching)
                 action_str = "table=%s" %CLASSIFIER_TABLE + " priority=1200 in_port=%s " %of_port + \
                              " ip nw_dst=%s " %network.cidr + " actions=resubmit(,%s)" %L2_LOOKUP_TABLE
-                ofspec.write(action_str + "\n")
+                flows.append(action_str)
 
                 # Add OF rule to send inter-tier traffic from this nic of the VM to egress ACL table(L3 lookup path)
                 action_str = "table=%s "%CLASSIFIER_TABLE + " priority=1100 in_port=%s " %of_port +\
                              " ip dl_dst=%s " %network.gatewaymac + " nw_dst=%s " %vpconfig.cidr + \
                              " actions=resubmit(,%s)" %EGRESS_ACL_TABLE
-                ofspec.write(action_str + "\n")
+                flows.append(action_str)
 
         # get the list of hosts on which VPC spans from the JSON config
         vpc_spanning_hosts = vpconfig.hosts
@@ -547,8 +773,8 @@ def configure_vpc_bridge_for_network_topology(bridge, this_host_id, json_config,
 
                     # Add flow rule in L2 look up table, if packet's destination mac matches MAC of the VM's nic
                     # on the remote host then send packet on the found OFPORT corresponding to the tunnel
-                    ofspec.write("table=%s" %L2_LOOKUP_TABLE + " priority=1100 dl_dst=%s " %mac_addr +
-                                 " actions=output:%s" %of_port + "\n")
+                    flows.append("table=%s" %L2_LOOKUP_TABLE + " priority=1100 dl_dst=%s " %mac_addr +
+                                 " actions=output:%s" %of_port)
 
                     # Add flow rule in L3 look up table. if packet's destination IP matches VM's IP then modify the
                     # packet to set DST MAC = VM's MAC, SRC MAC=tier gateway MAC and send to ingress table. This step
@@ -556,28 +782,20 @@ def configure_vpc_bridge_for_network_topology(bridge, this_host_id, json_config,
                     action_str = "mod_dl_src:%s"%network.gatewaymac + ",mod_dl_dst:%s" % mac_addr + \
                                  ",resubmit(,%s)"%INGRESS_ACL_TABLE
                     action_str = "table=%s"%L3_LOOKUP_TABLE + " ip nw_dst=%s"%ip + " actions=%s" %action_str
-                    ofspec.write(action_str + "\n")
+                    flows.append(action_str)
 
         # add a default rule in L2_LOOKUP_TABLE to send unknown mac address to L2 flooding table
-        ofspec.write("table=%s "%L2_LOOKUP_TABLE + " priority=0 " + " actions=resubmit(,%s)"%L2_FLOOD_TABLE + "\n")
+        flows.append("table=%s "%L2_LOOKUP_TABLE + " priority=0 " + " actions=resubmit(,%s)"%L2_FLOOD_TABLE)
 
         # add a default rule in L3 lookup table to forward (unknown destination IP) packets to L2 lookup table. This
         # is fallback option to send the packet to VPC VR, when routing can not be performed at the host
-        ofspec.write("table=%s "%L3_LOOKUP_TABLE + " priority=0 " + " actions=resubmit(,%s)"%L2_LOOKUP_TABLE + "\n")
-
-        # First flush current L2_LOOKUP_TABLE & L3_LOOKUP_TABLE before re-applying L2 & L3 lookup entries
-        del_flows(bridge, table=L2_LOOKUP_TABLE)
-        del_flows(bridge, table=L3_LOOKUP_TABLE)
-
-        ofspec.seek(0)
-        logging.debug("Adding below flows rules in L2 & L3 lookup tables:\n" + ofspec.read())
-        ofspec.close()
+        flows.append("table=%s "%L3_LOOKUP_TABLE + " priority=0 " + " actions=resubmit(,%s)"%L2_LOOKUP_TABLE)
 
-        # update bridge with the flow-rules for L2 lookup and L3 lookup in the file in one attempt
-        do_cmd([OFCTL_PATH, 'add-flows', bridge, ofspec_filename])
+        logging.debug("Flow rules of the L2 & L3 lookup tables:\n" + "\n".join(flows))
 
-        # now that we updated the bridge with flow rules close and delete the file.
-        os.remove(ofspec_filename)
+        # update the L2 & L3 lookup tables with only the flows that changed, they are not flushed first so the
+        # traffic of the VMs is not dropped meanwhile
+        update_table_flows(bridge, [L2_LOOKUP_TABLE, L3_LOOKUP_TABLE], flows, "topology")
 
         return "SUCCESS: successfully configured bridge as per the VPC topology update with sequence no: %s"%sequence_no
 
@@ -585,10 +803,91 @@ def configure_vpc_bridge_for_network_topology(bridge, this_host_id, json_config,
         error_message = "An unexpected error occurred while configuring bridge " + bridge + \
                         " as per latest VPC topology update with sequence no: %s" %sequence_no
         logging.debug(error_message + " due to " + str(e))
-        if os.path.isfile(ofspec_filename):
-            os.remove(ofspec_filename)
         raise error_message
 
+def get_port_range_matches(port_start, port_end):
+    """
+    Returns the tp_dst matches covering the ports port_start to port_end with the fewest flows, each one a port or
+    a value/mask prefix. For instance 1024-65535 is matched by 0x0400/0xfc00, 0x0800/0xf800, 0x1000/0xf000,
+    0x2000/0xe000, 0x4000/0xc000 and 0x8000/0x8000.
+    """
+    matches = []
+    port = int(port_start)
+    port_end = int(port_end)
+    while port <= port_end:
+        # the largest block aligned on its size that starts at port and does not go past port_end
+        size = port & -port or 0x10000
+        while size > port_end - port + 1:
+            size = size >> 1
+        if size == 1:
+            matches.append(str(port))
+        else:
+            matches.append("0x%04x/0x%04x" % (port, 0xffff & ~(size - 1)))
+        port = port + size
+    return matches
+
+def get_acl_flows(vpconfig):
+    """
+    Returns the flows of the ingress and egress ACL tables for the ACLs of the tiers of a VPC, and the number of
+    flows the ACL items take with one flow per port. Port ranges are matched with get_port_range_matches(), and of
+    the flows with the same table, priority and match only the last one is kept, as the bridge would do.
+    """
+    flows = {}
+    matches = []
+    per_port_flows = 0
+    for tier in vpconfig.tiers:
+        tier_cidr = tier.cidr
+        acl = get_acl(vpconfig, tier.aclid)
+
+        for acl_item in acl.aclitems:
+            protocol = ACL_PROTOCOLS.get(acl_item.protocol, acl_item.protocol)
+            acl_priority = 1000 + acl_item.number
+            if acl_item.direction == "ingress":
+                matching_table = INGRESS_ACL_TABLE
+                resubmit_table = L2_LOOKUP_TABLE
+            elif acl_item.direction == "egress":
+                matching_table = EGRESS_ACL_TABLE
+                resubmit_table = L3_LOOKUP_TABLE
+            else:
+                continue
+            if acl_item.action == "deny":
+                actions = "drop"
+            elif acl_item.action == "allow":
+                actions = "resubmit(,%s)" % resubmit_table
+            else:
+                continue
+
+            if acl_item.sourceportstart is None and acl_item.sourceportend is None:
+                port_matches = [None]
+                ports = 1
+            else:
+                port_matches = get_port_range_matches(acl_item.sourceportstart, acl_item.sourceportend)
+                ports = max(0, int(acl_item.sourceportend) - int(acl_item.sourceportstart) + 1)
+
+            for source_cidr in acl_item.sourcecidrs:
+                per_port_flows = per_port_flows + ports
+                # 0.0.0.0/0 matches any address
+                if source_cidr.startswith('0.0.0.0'):
+                    source_cidr = None
+                if acl_item.direction == "ingress":
+                    addresses = [("nw_src", source_cidr), ("nw_dst", tier_cidr)]
+                else:
+                    addresses = [("nw_src", tier_cidr), ("nw_dst", source_cidr)]
+
+                for tp_dst in port_matches:
+                    match = "table=%s priority=%s ip" % (matching_table, acl_priority)
+                    if tp_dst is not None:
+                        match = match + " tp_dst=%s" % tp_dst
+                    for field, address in addresses:
+                        if address is not None:
+                            match = match + " %s=%s" % (field, address)
+                    match = match + " nw_proto=%s" % protocol
+                    if match not in flows:
+                        matches.append(match)
+                    flows[match] = match + " actions=%s" % actions
+
+    return [flows[match] for match in matches], per_port_flows
+
 # Configures the bridge created for a VPC that is enabled for distributed firewall. Management server sends VPC routing
 # policy (network ACL applied on the tiers etc) details. Based on the VPC routing policies ingress ACL table and
 # egress ACL tables are updated by this function.
@@ -601,158 +900,20 @@ def configure_vpc_bridge_for_routing_policies(bridge, json_config, sequence_no):
 
     try:
 
-        if not os.path.exists('/var/run/cloud'):
-            os.makedirs('/var/run/cloud')
-
-        # create a temporary file to store OpenFlow rules corresponding to ingress and egress ACL table updates
-        ofspec_filename = "/var/run/cloud/" + bridge + sequence_no + ".ofspec"
-        ofspec = open(ofspec_filename, 'w+')
-
-        tiers = vpconfig.tiers
-        for tier in tiers:
-            tier_cidr = tier.cidr
-            acl = get_acl(vpconfig, tier.aclid)
-            acl_items = acl.aclitems
-
-            for acl_item in acl_items:
-                number = acl_item.number
-                action = acl_item.action
-                direction = acl_item.direction
-                source_port_start = acl_item.sourceportstart
-                source_port_end = acl_item.sourceportend
-                protocol = acl_item.protocol
-                if protocol == "all":
-                    protocol = "*"
-                elif protocol == "tcp":
-                    protocol = "6"
-                elif protocol == "udp":
-                    protocol == "17"
-                elif protocol == "icmp":
-                    protocol == "1"
-                source_cidrs = acl_item.sourcecidrs
-                acl_priority = 1000 + number
-                if direction == "ingress":
-                    matching_table = INGRESS_ACL_TABLE
-                    resubmit_table = L2_LOOKUP_TABLE
-                elif direction == "egress":
-                    matching_table = EGRESS_ACL_TABLE
-                    resubmit_table = L3_LOOKUP_TABLE
-
-                for source_cidr in source_cidrs:
-                    if source_port_start is None and source_port_end is None:
-                        if source_cidr.startswith('0.0.0.0'):
-                            if action == "deny":
-                                if direction == "ingress":
-                                    ofspec.write("table=%s "%matching_table + " priority=%s " %acl_priority + " ip " +
-                                                 " nw_dst=%s " %tier_cidr + " nw_proto=%s " %protocol +
-                                                 " actions=drop" + "\n")
-                                else:
-                                    ofspec.write("table=%s "%matching_table + " priority=%s " %acl_priority + " ip " +
-                                                 " nw_src=%s " %tier_cidr + " nw_proto=%s " %protocol +
-                                                 " actions=drop" + "\n")
-                            if action == "allow":
-                                if direction == "ingress":
-                                    ofspec.write("table=%s "%matching_table + " priority=%s " %acl_priority + " ip " +
-                                                 " nw_dst=%s " %tier_cidr + " nw_proto=%s " %protocol +
-                                                 " actions=resubmit(,%s)"%resubmit_table + "\n")
-                                else:
-                                    ofspec.write("table=%s "%matching_table + " priority=%s " %acl_priority + " ip " +
-                                                 " nw_src=%s " %tier_cidr + " nw_proto=%s " %protocol +
-                                                 " actions=resubmit(,%s)"%resubmit_table + "\n")
-                        else:
-                            if action == "deny":
-                                if direction == "ingress":
-                                    ofspec.write("table=%s "%matching_table + " priority=%s " %acl_priority + " ip " +
-                                                 " nw_src=%s " %source_cidr + " nw_dst=%s " %tier_cidr +
-                                                 " nw_proto=%s " %protocol + " actions=drop" + "\n")
-                                else:
-                                    ofspec.write("table=%s "%matching_table + " priority=%s " %acl_priority + " ip " +
-                                                 " nw_src=%s " %tier_cidr + " nw_dst=%s " %source_cidr +
-                                                 " nw_proto=%s " %protocol + " actions=drop" + "\n")
-                            if action == "allow":
-                                if direction == "ingress":
-                                    ofspec.write("table=%s "%matching_table + " priority=%s " %acl_priority + " ip " +
-                                                 " nw_src=%s "%source_cidr + " nw_dst=%s " %tier_cidr +
-                                                 " nw_proto=%s " %protocol +
-                                                 " actions=resubmit(,%s)"%resubmit_table  + "\n")
-                                else:
-                                    ofspec.write("table=%s "%matching_table + " priority=%s " %acl_priority + " ip " +
-                                                 " nw_src=%s "%tier_cidr + " nw_dst=%s " %source_cidr +
-                                                 " nw_proto=%s " %protocol +
-                                                 " actions=resubmit(,%s)"%resubmit_table  + "\n")
-                        continue
-
-                    # add flow rule to do action (allow/deny) for flows where source IP of the packet is in
-                    # source_cidr and destination ip is in tier_cidr
-                    port = int(source_port_start)
-                    while (port <= int(source_port_end)):
-                        if source_cidr.startswith('0.0.0.0'):
-                            if action == "deny":
-                                if direction == "ingress":
-                                    ofspec.write("table=%s "%matching_table + " priority=%s " %acl_priority + " ip " +
-                                                 " tp_dst=%s " %port + " nw_dst=%s " %tier_cidr +
-                                                 " nw_proto=%s " %protocol + " actions=drop"  + "\n")
-                                else:
-                                    ofspec.write("table=%s "%matching_table + " priority=%s " %acl_priority + " ip " +
-                                                 " tp_dst=%s " %port + " nw_src=%s " %tier_cidr +
-                                                 " nw_proto=%s " %protocol + " actions=drop" + "\n")
-                            if action == "allow":
-                                if direction == "ingress":
-                                    ofspec.write("table=%s "%matching_table + " priority=%s " %acl_priority + " ip " +
-                                                 " tp_dst=%s " %port + " nw_dst=%s " %tier_cidr +
-                                                 " nw_proto=%s " %protocol +
-                                                 " actions=resubmit(,%s)"%resubmit_table + "\n")
-                                else:
-                                    ofspec.write("table=%s "%matching_table + " priority=%s " %acl_priority + " ip " +
-                                                 " tp_dst=%s " %port + " nw_src=%s " %tier_cidr +
-                                                 " nw_proto=%s " %protocol +
-                                                 " actions=resubmit(,%s)"%resubmit_table + "\n")
-                        else:
-                            if action == "deny":
-                                if direction == "ingress":
-                                    ofspec.write("table=%s "%matching_table + " priority=%s " %acl_priority + " ip " +
-                                                 " tp_dst=%s " %port + " nw_src=%s " %source_cidr +
-                                                 " nw_dst=%s " %tier_cidr +
-                                                 " nw_proto=%s " %protocol + " actions=drop" + "\n")
-                                else:
-                                    ofspec.write("table=%s "%matching_table + " priority=%s " %acl_priority + " ip " +
-                                                 " tp_dst=%s " %port + " nw_src=%s " %tier_cidr +
-                                                 " nw_dst=%s " %source_cidr +
-                                                 " nw_proto=%s " %protocol + " actions=drop" + "\n")
-                            if action == "allow":
-                                if direction == "ingress":
-                                    ofspec.write("table=%s "%matching_table + " priority=%s " %acl_priority + " ip " +
-                                                 " tp_dst=%s " %port + " nw_src=%s "%source_cidr +
-                                                 " nw_dst=%s " %tier_cidr +
-                                                 " nw_proto=%s " %protocol +
-                                                 " actions=resubmit(,%s)"%resubmit_table  + "\n")
-                                else:
-                                    ofspec.write("table=%s "%matching_table + " priority=%s " %acl_priority + " ip " +
-                                                 " tp_dst=%s " %port + " nw_src=%s "%tier_cidr +
-                                                 " nw_dst=%s " %source_cidr +
-                                                 " nw_proto=%s " %protocol +
-                                                 " actions=resubmit(,%s)"%resubmit_table  + "\n")
-                        port = port + 1
+        # OpenFlow rules corresponding to ingress and egress ACL table updates
+        flows, per_port_flows = get_acl_flows(vpconfig)
+        logging.debug("ACL items of the VPC compiled to %s flows, %s with one flow per port" % (len(flows), per_port_flows))
 
         # add a default rule in egress table to allow packets (so forward packet to L3 lookup table)
-        ofspec.write("table=%s " %EGRESS_ACL_TABLE + " priority=0 actions=resubmit(,%s)" %L3_LOOKUP_TABLE + "\n")
+        flows.append("table=%s " %EGRESS_ACL_TABLE + " priority=0 actions=resubmit(,%s)" %L3_LOOKUP_TABLE)
 
         # add a default rule in ingress table to drop packets
-        ofspec.write("table=%s " %INGRESS_ACL_TABLE + " priority=0 actions=drop" + "\n")
+        flows.append("table=%s " %INGRESS_ACL_TABLE + " priority=0 actions=drop")
 
-        # First flush current ingress and egress ACL's before re-applying the ACL's
-        del_flows(bridge, table=EGRESS_ACL_TABLE)
-        del_flows(bridge, table=INGRESS_ACL_TABLE)
+        logging.debug("Flow rules of the Ingress & Egress ACL tables:\n" + "\n".join(flows))
 
-        ofspec.seek(0)
-        logging.debug("Adding below flows rules Ingress & Egress ACL tables:\n" + ofspec.read())
-        ofspec.close()
-
-        # update bridge with the flow-rules for ingress and egress ACL's added in the file in one attempt
-        do_cmd([OFCTL_PATH, 'add-flows', bridge, ofspec_filename])
-
-        # now that we updated the bridge with flow rules delete the file.
-        os.remove(ofspec_filename)
+        # update the ingress and egress ACL tables with only the flows that changed instead of flushing them first
+        update_table_flows(bridge, [EGRESS_ACL_TABLE, INGRESS_ACL_TABLE], flows, "routing-policies")
 
         return "SUCCESS: successfully configured bridge as per the latest routing policies update with " \
                "sequence no: %s"%sequence_no
@@ -761,8 +922,6 @@ def configure_vpc_bridge_for_routing_policies(bridge, json_config, sequence_no):
         error_message = "An unexpected error occurred while configuring bridge " + bridge + \
                         " as per latest VPC's routing policy update with sequence number %s." %sequence_no
         logging.debug(error_message + " due to " + str(e))
-        if os.path.isfile(ofspec_filename):
-            os.remove(ofspec_filename)
         raise error_message
 
 # configures bridge L2 flooding rules stored in table=2. Single bridge is used for all the tiers of VPC. So controlled
@@ -771,9 +930,10 @@ def configure_vpc_bridge_for_routing_policies(bridge, json_config, sequence_no):
 def update_flooding_rules_on_port_plug_unplug(bridge, interface, command, if_network_id):
 
     class tier_ports:
-        tier_vif_ofports = []
-        tier_tunnelif_ofports = []
-        tier_all_ofports = []
+        def __init__(self):
+            self.tier_vif_ofports = []
+            self.tier_tunnelif_ofports = []
+            self.tier_all_ofports = []
 
     logging.debug("Updating the flooding rules on bridge " + bridge + " as interface  %s" %interface +
                   " is %s"%command + " now.")
@@ -788,15 +948,23 @@ def update_flooding_rules_on_port_plug_unplug(bridge, interface, command, if_net
 
         all_tiers = dict()
 
-        vsctl_output = do_cmd([VSCTL_PATH, 'list-ports', bridge])
-        ports = vsctl_output.split('\n')
+        # take the ofports and ids of all the interfaces of the bridge at once, and the networks of its VIFs
+        # with one XAPI query
+        interfaces = get_bridge_interfaces(bridge)
+        vif_uuids = [i['external_ids'].get('xs-vif-uuid') for i in interfaces if i['name'].startswith('vif')]
+        vif_network_ids = get_network_ids_for_vifs(vif_uuids)
 
-        for port in ports:
+        for port_interface in interfaces:
 
-            if_ofport = do_cmd([VSCTL_PATH, 'get', 'Interface', port, 'ofport'])
+            port = port_interface['name']
+            if_ofport = str(port_interface['ofport'])
 
             if port.startswith('vif'):
-                network_id = get_network_id_for_vif(port)
+                vif_uuid = port_interface['external_ids'].get('xs-vif-uuid')
+                if vif_uuid in vif_network_ids:
+                    network_id = vif_network_ids[vif_uuid]
+                else:
+                    network_id = get_network_id_for_vif(port)
                 if network_id not in all_tiers.keys():
                     all_tiers[network_id] = tier_ports()
                 tier_ports_info = all_tiers[network_id]
@@ -805,7 +973,7 @@ def update_flooding_rules_on_port_plug_unplug(bridge, interface, command, if_net
                 all_tiers[network_id] = tier_ports_info
 
             if port.startswith('t'):
-                network_id = get_network_id_for_tunnel_port(port)[1:-1]
+                network_id = port_interface['options'].get('cloudstack-network-id')
                 if network_id not in all_tiers.keys():
                     all_tiers[network_id] = tier_ports()
                 tier_ports_info = all_tiers[network_id]
@@ -859,35 +1027,19 @@ def update_flooding_rules_on_port_plug_unplug(bridge, interface, command, if_net
         raise error_message
 
 
-def is_regular_tunnel_network(xs_nw_uuid):
-    cmd = [XE_PATH,"network-param-get", "uuid=%s" % xs_nw_uuid, "param-name=other-config",
-                            "param-key=is-ovs-tun-network", "--minimal"]
-    logging.debug("Executing:%s", cmd)
-    pipe = subprocess.PIPE
-    proc = subprocess.Popen(cmd, shell=False, stdin=pipe, stdout=pipe,
-                            stderr=pipe, close_fds=True)
-    ret_code = proc.wait()
-    if ret_code:
+def get_network_other_config(xs_nw_uuid, key):
+    """ Returns the value of a key of the other-config of a XAPI network, or False when it is not set """
+    xapi = get_xapi()
+    try:
+        ref = xapi.find_one('network', uuid=xs_nw_uuid)[0]
+    except PluginError:
         return False
+    return xapi.get_other_config_values('network', [ref], key).get(ref, False)
 
-    output = proc.stdout.read()
-    if output.endswith('\n'):
-        output = output[:-1]
-    return output
 
+def is_regular_tunnel_network(xs_nw_uuid):
+    return get_network_other_config(xs_nw_uuid, "is-ovs-tun-network")
 
-def is_vpc_network_with_distributed_routing(xs_nw_uuid):
-    cmd = [XE_PATH,"network-param-get", "uuid=%s" % xs_nw_uuid, "param-name=other-config",
-                            "param-key=is-ovs-vpc-distributed-vr-network", "--minimal"]
-    logging.debug("Executing:%s", cmd)
-    pipe = subprocess.PIPE
-    proc = subprocess.Popen(cmd, shell=False, stdin=pipe, stdout=pipe,
-                            stderr=pipe, close_fds=True)
-    ret_code = proc.wait()
-    if ret_code:
-        return False
 
-    output = proc.stdout.read()
-    if output.endswith('\n'):
-        output = output[:-1]
-    return output
\ No newline at end of file
+def is_vpc_network_with_distributed_routing(xs_nw_uuid):
+    return get_network_other_config(xs_nw_uuid, "is-ovs-vpc-distributed-vr-network")
@@ -88,8 +88,7 @@ def main(command, vif_raw):
     bridge = pluginlib.do_cmd([pluginlib.VSCTL_PATH, 'iface-to-br', this_vif])
     
     # find xs network for this bridge, verify is used for ovs tunnel network
-    xs_nw_uuid = pluginlib.do_cmd([pluginlib.XE_PATH, "network-list",
-								   "bridge=%s" % bridge, "--minimal"])
+    xs_nw_uuid = pluginlib.get_xapi().get_network_by_bridge(bridge)[1]['uuid']
 
     ovs_tunnel_network = pluginlib.is_regular_tunnel_network(xs_nw_uuid)
 
@@ -142,4 +141,7 @@ if __name__ == "__main__":
         sys.exit(1)
     else:
         command, vif_raw = sys.argv[1:3]
-        main(command, vif_raw)
+        try:
+            main(command, vif_raw)
+        finally:
+            pluginlib.release_xapi()
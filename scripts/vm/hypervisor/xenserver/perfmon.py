@@ -19,11 +19,11 @@
 import pprint
 import XenAPI
 import urllib
-from xml.dom import minidom
+import xml.parsers.expat
 import time
-import commands
+from array import array
 
-# Per VM dictionary (used by RRDUpdates to look up column numbers by variable names)
+# Per VM dictionary (used by RRDUpdates to look up the values of a VM by variable names)
 class VMReport(dict):
     """Used internally by RRDUpdates"""
     def __init__(self, uuid):
@@ -31,7 +31,7 @@ class VMReport(dict):
         super(dict, self).__init__()
 
 
-# Per Host dictionary (used by RRDUpdates to look up column numbers by variable names)
+# Per Host dictionary (used by RRDUpdates to look up the values of the host by variable names)
 class HostReport(dict):
     """Used internally by RRDUpdates"""
     def __init__(self, uuid):
@@ -51,6 +51,47 @@ class UsageException(Exception):
     pass
 
 
+class RRDParser:
+    """ Streams the xml of rrd_updates through expat into one array of values per variable (column)
+
+    The values of a column are kept in the order of the <row> nodes, which is reverse chronological. Only the
+    columns of the VMs in vm_uuids are kept when it is given, the others are skipped without being converted.
+    """
+    def __init__(self, rrd_updates, vm_uuids=None):
+        self.rrd_updates = rrd_updates
+        self.vm_uuids = vm_uuids
+        self.meta = {}
+        self.columns = []
+        self.timestamps = array('l')
+        self.text = []
+        self.col = 0
+        self.parser = xml.parsers.expat.ParserCreate()
+        self.parser.StartElementHandler = self.start_element
+        self.parser.EndElementHandler = self.end_element
+        self.parser.CharacterDataHandler = self.text.append
+
+    def feed(self, data, final=False):
+        self.parser.Parse(data, final)
+
+    def start_element(self, name, attrs):
+        del self.text[:]
+        if name == 'row':
+            self.col = 0
+
+    def end_element(self, name):
+        if name == 'v':
+            values = self.columns[self.col]
+            if values is not None:
+                values.append(float(''.join(self.text)))
+            self.col += 1
+        elif name == 't':
+            self.timestamps.append(int(''.join(self.text)))
+        elif name == 'entry':
+            self.columns.append(self.rrd_updates.add_column(''.join(self.text).strip(), self.vm_uuids))
+        elif name in ('start', 'step', 'end', 'rows', 'columns'):
+            self.meta[name] = int(''.join(self.text))
+
+
 class RRDUpdates:
     """ Object used to get and parse the output the http://localhost/rrd_udpates?...
     """
@@ -61,6 +102,11 @@ class RRDUpdates:
         self.params['host'] = 'false'   # include data for host (as well as for VMs)
         self.params['cf'] = 'AVERAGE'  # consolidation function, each sample averages 12 from the 5 second RRD
         self.params['interval'] = '60'
+        # vm_reports matches uuid to per VM report
+        self.vm_reports = {}
+        self.host_report = None
+        self.rows = 0
+        self.timestamps = array('l')
 
     def get_nrows(self):
         return self.rows
@@ -74,24 +120,25 @@ class RRDUpdates:
             return []
         return report.keys()
 
-    def get_total_cpu_core(self, uuid):
-	report = self.vm_reports[uuid]
+    def get_vm_cpu_params(self, uuid):
+        """ Returns the variables of the cores of a VM: cpu0, cpu1... """
+        report = self.vm_reports.get(uuid)
         if not report:
-            return 0
-        else:
-            param_keys = report.keys()
-            result = 0
-            for param in param_keys:
-                if "cpu" in param:
-                    result += 1
-            return result
+            return []
+        cpus = [param for param in report.keys() if param.startswith("cpu") and param[3:].isdigit()]
+        cpus.sort()
+        return cpus
+
+    def get_total_cpu_core(self, uuid):
+        return len(self.get_vm_cpu_params(uuid))
 
     def get_vm_data(self, uuid, param, row):
-	#pp = pprint.PrettyPrinter(indent=4) 
-	#pp.pprint(self.vm_reports)
-        report = self.vm_reports[uuid]
-        col = report[param]
-        return self.__lookup_data(col, row)
+        values = self.vm_reports[uuid][param]
+        return values[len(values) - 1 - row]
+
+    def get_vm_values(self, uuid, param, nrows):
+        """ Returns the values of a variable of a VM over the last nrows rows, the most recent first """
+        return self.vm_reports[uuid][param][:nrows]
 
     def get_host_uuid(self):
         report = self.host_report
@@ -106,115 +153,106 @@ class RRDUpdates:
         return report.keys()
 
     def get_host_data(self, param, row):
-        report = self.host_report
-        col = report[param]
-        return self.__lookup_data(col, row)
+        values = self.host_report[param]
+        return values[len(values) - 1 - row]
 
     def get_row_time(self, row):
-        return self.__lookup_timestamp(row)
-
-    # extract float from value (<v>) node by col,row
-    def __lookup_data(self, col, row):
-        # Note: the <rows> nodes are in reverse chronological order, and comprise
-        # a timestamp <t> node, followed by self.columns data <v> nodes
-        node = self.data_node.childNodes[self.rows - 1 - row].childNodes[col + 1]
-        return float(node.firstChild.toxml())  # node.firstChild should have nodeType TEXT_NODE
-
-    # extract int from value (<t>) node by row
-    def __lookup_timestamp(self, row):
-        # Note: the <rows> nodes are in reverse chronological order, and comprise
-        # a timestamp <t> node, followed by self.columns data <v> nodes
-        node = self.data_node.childNodes[self.rows - 1 - row].childNodes[0]
-        return int(node.firstChild.toxml())  # node.firstChild should have nodeType TEXT_NODE
-
-    def refresh(self, login, starttime, session, override_params):
+        # Note: the rows are in reverse chronological order
+        return self.timestamps[self.rows - 1 - row]
+
+    def refresh(self, login, starttime, session, override_params, hosts=None, vm_uuids=None):
+        """ Fetches the updates since starttime from the hosts, all the hosts of the pool by default. When vm_uuids
+        is given only the data of these VMs is kept.
+        """
         self.params['start'] = starttime
         params = override_params
         params['session_id'] = session
         params.update(self.params)
         paramstr = "&".join(["%s=%s" % (k, params[k]) for k in params])
-        # this is better than urllib.urlopen() as it raises an Exception on http 401 'Unauthorised' error
-        # rather than drop into interactive mode
-	for host in login.host.get_all():
-		#print "http://" + str(login.host.get_address(host)) + "/rrd_updates?%s" % paramstr
-        	sock = urllib.URLopener().open("http://" + str(login.host.get_address(host)) + "/rrd_updates?%s" % paramstr)
-	        xmlsource = sock.read()
-        	sock.close()
-        	xmldoc = minidom.parseString(xmlsource)
-        	self.__parse_xmldoc(xmldoc)
-        	# Update the time used on the next run
-        	self.params['start'] = self.end_time + 1  # avoid retrieving same data twice
-
-    def __parse_xmldoc(self, xmldoc):
-        # The 1st node contains meta data (description of the data)
-        # The 2nd node contains the data
-        self.meta_node = xmldoc.firstChild.childNodes[0]
-        self.data_node = xmldoc.firstChild.childNodes[1]
-
-        def lookup_metadata_bytag(name):
-            return int(self.meta_node.getElementsByTagName(name)[0].firstChild.toxml())
+        if hosts is None:
+            hosts = login.host.get_all()
+        end_time = None
+        for host in hosts:
+            # this is better than urllib.urlopen() as it raises an Exception on http 401 'Unauthorised' error
+            # rather than drop into interactive mode
+            sock = urllib.URLopener().open("http://" + str(login.host.get_address(host)) + "/rrd_updates?%s" % paramstr)
+            parser = RRDParser(self, vm_uuids)
+            try:
+                while True:
+                    data = sock.read(65536)
+                    if not data:
+                        break
+                    parser.feed(data)
+                parser.feed("", True)
+            finally:
+                sock.close()
             # rows = number of samples per variable
-        # columns = number of variables
-        self.rows = lookup_metadata_bytag('rows')
-        self.columns = lookup_metadata_bytag('columns')
-        # These indicate the period covered by the data
-        self.start_time = lookup_metadata_bytag('start')
-        self.step_time = lookup_metadata_bytag('step')
-        self.end_time = lookup_metadata_bytag('end')
-        # the <legend> Node describes the variables
-        self.legend = self.meta_node.getElementsByTagName('legend')[0]
-        # vm_reports matches uuid to per VM report
-        if not hasattr(self,'vm_reports'):
-		self.vm_reports = {}
-        # There is just one host_report and its uuid should not change!
-        self.host_report = None
-        # Handle each column.  (I.e. each variable)
-        for col in range(self.columns):
-            self.__handle_col(col)
-
-    def __handle_col(self, col):
-        # work out how to interpret col from the legend
-        col_meta_data = self.legend.childNodes[col].firstChild.toxml()
+            self.rows = parser.meta['rows']
+            self.timestamps = parser.timestamps
+            # These indicate the period covered by the data
+            self.start_time = parser.meta['start']
+            self.step_time = parser.meta['step']
+            self.end_time = parser.meta['end']
+            if end_time is None or self.end_time > end_time:
+                end_time = self.end_time
+        # Update the time used on the next run
+        if end_time is not None:
+            self.params['start'] = end_time + 1  # avoid retrieving same data twice
+
+    def add_column(self, col_meta_data, vm_uuids=None):
+        """ Returns the array to put the values of a column in, as described by its <legend> entry, or None for a
+        column of a VM that is not in vm_uuids
+        """
         # vm_or_host will be 'vm' or 'host'.  Note that the Control domain counts as a VM!
         (cf, vm_or_host, uuid, param) = col_meta_data.split(':')
+        values = array('d')
         if vm_or_host == 'vm':
+            if vm_uuids is not None and uuid not in vm_uuids:
+                return None
             # Create a report for this VM if it doesn't exist
             if not uuid in self.vm_reports:
                 self.vm_reports[uuid] = VMReport(uuid)
-                # Update the VMReport with the col data and meta data
-            vm_report = self.vm_reports[uuid]
-            vm_report[param] = col
+            self.vm_reports[uuid][param] = values
         elif vm_or_host == 'host':
             # Create a report for the host if it doesn't exist
             if not self.host_report:
                 self.host_report = HostReport(uuid)
             elif self.host_report.uuid != uuid:
                 raise PerfMonException("Host UUID changed: (was %s, is %s)" % (self.host_report.uuid, uuid))
-                # Update the HostReport with the col data and meta data
-            self.host_report[param] = col
+            self.host_report[param] = values
         else:
             raise PerfMonException("Invalid string in <legend>: %s" % col_meta_data)
+        return values
+
+
+def get_vm_records(login, vm_names):
+    """ Returns the records of the VMs with the given name labels, read with one XAPI call """
+    records = {}
+    for record in login.VM.get_all_records().values():
+        if not record['is_a_template'] and not record['is_control_domain'] and record['name_label'] in vm_names:
+            records[record['name_label']] = record
+    for vm_name in vm_names:
+        if vm_name not in records:
+            raise PerfMonException("Invalid vm name: %s" % vm_name)
+    return records
 
-def getuuid(vm_name):
-    status, output = commands.getstatusoutput("xe vm-list | grep "+vm_name+" -B 1 | head -n 1 | awk -F':' '{print $2}' | tr -d ' '")
-    if (status != 0):
-	raise PerfMonException("Invalid vm name: %s" % vm_name)
-    return output
 
 def get_vm_group_perfmon(args={}):
     login = XenAPI.xapi_local()
-    login.login_with_password("","")
-    result = ""
+    login.login_with_password("", "")
+    try:
+        return _get_vm_group_perfmon(login, args)
+    finally:
+        login.xenapi.session.logout()
+
+
+def _get_vm_group_perfmon(login, args):
+    result = []
 
     total_vm = int(args['total_vm'])
     total_counter = int(args['total_counter'])
     now = int(time.time()) / 60
 
-    # Get pool's info of this host
-    #pool = login.xenapi.pool.get_all()[0]
-    # Get master node's address of pool
-    #master = login.xenapi.pool.get_master(pool)
-    #master_address = login.xenapi.host.get_address(master)
     session = login._session
 
     max_duration = 0
@@ -223,39 +261,40 @@ def get_vm_group_perfmon(args={}):
         if duration > max_duration:
             max_duration = duration
 
+    vm_names = [args['vmname' + str(vm_count)] for vm_count in xrange(1, total_vm + 1)]
+    vms = get_vm_records(login.xenapi, vm_names)
+    vm_uuids = dict([(vm['uuid'], True) for vm in vms.values()])
+    # Only the hosts running the VMs have their data
+    hosts = dict([(vm['resident_on'], True) for vm in vms.values() if vm['resident_on'] != 'OpaqueRef:NULL']).keys()
+
     rrd_updates = RRDUpdates()
-    rrd_updates.refresh(login.xenapi, now * 60 - max_duration, session, {})
+    rrd_updates.refresh(login.xenapi, now * 60 - max_duration, session, {}, hosts, vm_uuids)
 
-    #for uuid in rrd_updates.get_vm_list():
     for vm_count in xrange(1, total_vm + 1):
-	vm_name = args['vmname' + str(vm_count)]
-        vm_uuid = getuuid(vm_name)
-        #print "Got values for VM: " + str(vm_count) + " " + vm_uuid
+        vm_uuid = vms[vm_names[vm_count - 1]]['uuid']
+        if vm_uuid not in rrd_updates.vm_reports:
+            raise PerfMonException("No performance data for vm: %s" % vm_names[vm_count - 1])
         for counter_count in xrange(1, total_counter + 1):
-	    #refresh average
-	    average_cpu = 0
-	    average_memory = 0
             counter = args['counter' + str(counter_count)]
-            total_row = rrd_updates.get_nrows()
             duration = int(args['duration' + str(counter_count)]) / 60
-            duration_diff = total_row - duration
             if counter == "cpu":
-		total_cpu = rrd_updates.get_total_cpu_core(vm_uuid)
-                for row in xrange(duration_diff, total_row):
-                    for cpu in xrange(0, total_cpu):
-                        average_cpu += rrd_updates.get_vm_data(vm_uuid, "cpu" + str(cpu), row)
-                average_cpu /= (duration * total_cpu)
-                if result == "":
-                    result += str(vm_count) + '.' +  str(counter_count) + ':' + str(average_cpu)
-                else:
-                    result += ',' + str(vm_count) +  '.' + str(counter_count) + ':' + str(average_cpu)
+                # average over the last duration rows and over the cores
+                cpus = rrd_updates.get_vm_cpu_params(vm_uuid)
+                total = 0.0
+                samples = 0
+                for cpu in cpus:
+                    values = rrd_updates.get_vm_values(vm_uuid, cpu, duration)
+                    total += sum(values)
+                    samples += len(values)
             elif counter == "memory":
-                for row in xrange(duration_diff, total_row):
-                    average_memory += rrd_updates.get_vm_data(vm_uuid, "memory_target", row) / 1048576 - rrd_updates.get_vm_data(vm_uuid, "memory_internal_free", row) / 1024
-                average_memory /= duration
-                if result == "":
-                    result += str(vm_count) +  '.' +  str(counter_count) + ':' + str(average_memory)
-                else:
-                    result += ',' + str(vm_count) +  '.' +  str(counter_count) + ':' + str(average_memory)
-    return result
-
+                memory_target = rrd_updates.get_vm_values(vm_uuid, "memory_target", duration)
+                memory_internal_free = rrd_updates.get_vm_values(vm_uuid, "memory_internal_free", duration)
+                total = sum(memory_target) / 1048576 - sum(memory_internal_free) / 1024
+                samples = len(memory_target)
+            else:
+                continue
+            average = 0.0
+            if samples:
+                average = total / samples
+            result.append(str(vm_count) + '.' + str(counter_count) + ':' + str(average))
+    return ",".join(result)
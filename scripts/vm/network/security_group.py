@@ -17,43 +17,103 @@
 # under the License.
 
 import cloud_utils
-from subprocess import check_output, CalledProcessError
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from subprocess import check_output, CalledProcessError, Popen, PIPE
 from cloudutils.configFileOps import configFileOps
 import logging
 import sys
 import os
 import xml.dom.minidom
+from StringIO import StringIO
 from optparse import OptionParser, OptionGroup, OptParseError, BadOptionError, OptionError, OptionConflictError, OptionValueError
 import re
 import libvirt
 import fcntl
+import hashlib
+import json
+import socket
+import threading
 import time
-from netaddr import IPAddress, IPNetwork
+from netaddr import IPAddress, IPNetwork, cidr_merge
 from netaddr.core import AddrFormatError
 
 
 logpath = "/var/run/cloud/"        # FIXME: Logs should reside in /var/log/cloud
 lock_file = "/var/lock/cloudstack_security_group.lock"
+vm_lock_dir = "/var/lock/cloudstack_security_group.d/"
 driver = "qemu:///system"
 cfo = configFileOps("/etc/cloudstack/agent/agent.properties")
 hyper = cfo.getEntry("hypervisor.type")
 if hyper == "lxc":
     driver = "lxc:///"
 
-lock_handle = None
-
+global_mutex = threading.RLock()
+global_lock_handle = None
+global_lock_depth = 0
+# The libvirt connection kept by the daemon
+libvirt_conn = None
+# The rule logs and secondary ips of every vm, as {vm: {field: value}}
+rule_log_file = logpath + "security_group_rules.json"
+rule_logs = None
+rule_logs_stat = None
+RULE_LOG_FIELDS = ['name', 'id', 'ip', 'domid', 'signature', 'seqno']
+socket_path = logpath + "security_group.sock"
+request_timeout = 30
+# How long a client waits for the daemon to run its command
+client_timeout = 300
+# What the command of a thread looked up in libvirt and in the FORWARD chain
+command_cache = threading.local()
+EMPTY_RULE_LOG = ['_', '-1', '_', '-1', '_', '-1']
+
+
+@contextmanager
+def global_lock():
+    """
+    Exclusive access to what the vms share: the bridge firewall framework, the
+    tables a RuleSet commits and the rule log file. Taken for short sections, after
+    the lock of a vm if any, and reentrant within a thread.
+    """
+    global global_lock_handle, global_lock_depth
+    with global_mutex:
+        if global_lock_depth == 0:
+            global_lock_handle = open(lock_file, 'w')
+            fcntl.flock(global_lock_handle, fcntl.LOCK_EX)
+        global_lock_depth += 1
+        try:
+            yield
+        finally:
+            global_lock_depth -= 1
+            if global_lock_depth == 0:
+                global_lock_handle.close()
+                global_lock_handle = None
 
-def obtain_file_lock(path):
-    global lock_handle
 
+def open_vm_lock(vm_name, blocking=True):
+    """ Lock the chains, sets and rule log of one vm, returns the handle to close or None """
+    if not os.path.exists(vm_lock_dir):
+        try:
+            os.makedirs(vm_lock_dir)
+        except OSError:
+            pass
+    # The chains of a vm are named after a prefix of its name, the lock as well
+    handle = open(vm_lock_dir + ebtables_chain_name(vm_name) + '.lock', 'w')
     try:
-        lock_handle = open(path, 'w')
-        fcntl.flock(lock_handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
-        return True
+        fcntl.flock(handle, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
     except IOError:
-        pass
+        handle.close()
+        return None
+    return handle
 
-    return False
+
+@contextmanager
+def vm_lock(vm_name):
+    handle = open_vm_lock(vm_name)
+    try:
+        yield
+    finally:
+        handle.close()
 
 
 def execute(cmd):
@@ -64,6 +124,185 @@ def execute(cmd):
         logging.exception('Failed to execute: %s', e.cmd)
 
 
+def execute_stdin(cmd, data):
+    logging.debug(cmd)
+    p = Popen(cmd, shell=True, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    err = p.communicate(data)[1]
+    if p.returncode != 0:
+        logging.error('Failed to execute: %s: %s', cmd, err)
+        return False
+    return True
+
+
+def read_saved_tables(tool):
+    """
+    Parse the output of iptables-save, ip6tables-save or ebtables-save into
+    {table: {chain: (policy, rules)}}, the rules as -A lines without counters.
+    """
+    tables = {}
+    chains = None
+    for line in (execute(tool + '-save') or '').split('\n'):
+        line = line.strip()
+        if line.startswith('*'):
+            chains = tables.setdefault(line[1:], OrderedDict())
+        elif chains is None:
+            continue
+        elif line.startswith(':'):
+            vals = line[1:].split()
+            chains[vals[0]] = (vals[1] if len(vals) > 1 else '-', [])
+        elif line.startswith('-A '):
+            line = re.sub(r' -c \d+ \d+$', '', line)
+            chains.setdefault(line.split()[1], ('-', []))[1].append(line)
+    return tables
+
+
+EBTABLES_BUILTIN_CHAINS = ['PREROUTING', 'POSTROUTING', 'INPUT', 'FORWARD', 'OUTPUT', 'BROUTING']
+
+
+class RuleSet(object):
+    """
+    The chains and rules of one operation, applied with a single
+    iptables-restore --noflush, ip6tables-restore --noflush and ebtables-restore.
+    The chains given to chain() are created, or flushed, in the same transaction
+    that fills them, so there is never a window with flushed chains.
+    """
+
+    def __init__(self, saved=None):
+        self.tables = OrderedDict()
+        # The output of the *-save commands, when the caller read it under the global lock it still holds
+        self.saved = saved or {}
+
+    def get(self, tool, table):
+        return self.tables.setdefault((tool, table), [])
+
+    def chain(self, tool, name, table='filter'):
+        """ Create or flush a chain, the rules queued for it so far are discarded """
+        ops = self.get(tool, table)
+        ops[:] = [(op, arg) for op, arg in ops if op != 'rule' or arg.split()[0] == '-D' or arg.split()[1] != name]
+        ops.append(('chain', name))
+
+    def drop(self, tool, name, table='filter'):
+        """ Delete a chain, for ebtables the jumps to it are deleted as well """
+        self.get(tool, table).append(('drop', name))
+
+    def rule(self, tool, rule, table='filter'):
+        self.get(tool, table).append(('rule', rule))
+
+    def commit(self):
+        """ Under the global lock, as ebtables-restore rewrites the tables of every vm """
+        result = True
+        with global_lock():
+            for (tool, table), ops in self.tables.items():
+                if tool == 'ebtables':
+                    applied = self.ebtables_restore(table, ops)
+                else:
+                    applied = self.iptables_restore(tool, table, ops)
+                if not applied:
+                    logging.warning("%s-restore failed for table %s, falling back to one command per rule" % (tool, table))
+                    result = self.replay(tool, table, ops) and result
+        self.tables = OrderedDict()
+        self.saved = {}
+        return result
+
+    def iptables_restore(self, tool, table, ops):
+        chains = [name for op, name in ops if op == 'chain']
+        drops = [name for op, name in ops if op == 'drop' and name not in chains]
+        lines = ['*' + table]
+        for name in chains + drops:
+            if ':%s - [0:0]' % name not in lines:
+                lines.append(':%s - [0:0]' % name)
+        lines += [rule for op, rule in ops if op == 'rule']
+        lines += ['-X ' + name for name in drops]
+        lines.append('COMMIT')
+        return execute_stdin(tool + '-restore --noflush', '\n'.join(lines) + '\n')
+
+    def ebtables_restore(self, table, ops):
+        """
+        ebtables-restore replaces whole tables, so it is only used on the tables holding no
+        other chains than the builtin ones and the ones of the vms. The rules of the builtin
+        chains, shared with the rest of the host, are changed one command at a time: the
+        deletions before the table is read and restored, the additions after.
+        """
+        saved = self.saved.get('ebtables') or read_saved_tables('ebtables')
+        builtin = [(op, arg) for op, arg in ops if op == 'rule' and arg.split()[1] in EBTABLES_BUILTIN_CHAINS]
+        dropped = [arg for op, arg in ops if op == 'drop']
+        for name, (policy, rules) in saved.get(table, {}).items():
+            if name in EBTABLES_BUILTIN_CHAINS:
+                builtin = [('rule', '-D' + rule[2:]) for rule in rules if rule.split()[-1] in dropped] + builtin
+        for op, rule in builtin:
+            if rule.split()[0] == '-D' and execute('ebtables -t %s %s' % (table, rule)) is None:
+                return False
+
+        # Read right before the restore, so that it keeps what changed since
+        if 'ebtables' in self.saved or [rule for op, rule in builtin if rule.split()[0] == '-D']:
+            saved = read_saved_tables('ebtables')
+        chains = OrderedDict((name, [':%s %s' % (name, policy)] + rules)
+                             for name, (policy, rules) in saved.get(table, {}).items())
+        if not chains:
+            return False
+        foreign = [name for name in chains if name not in EBTABLES_BUILTIN_CHAINS and name[:2] not in ['r-', 'i-', 's-', 'v-']]
+        if foreign:
+            logging.debug("Not restoring the ebtables %s table, it holds the chains %s" % (table, ', '.join(foreign)))
+            return False
+
+        for op, arg in ops:
+            if op == 'chain':
+                chains[arg] = [':%s RETURN' % arg]
+            elif op == 'drop':
+                chains.pop(arg, None)
+            elif (op, arg) in builtin:
+                continue
+            else:
+                vals = arg.split()
+                if vals[1] not in chains:
+                    return False
+                rules = chains[vals[1]]
+                if vals[0] == '-A':
+                    rules.append(' '.join(['-A'] + vals[1:]))
+                elif vals[0] == '-I':
+                    position = 1
+                    if vals[2].isdigit():
+                        position = int(vals.pop(2))
+                    rules.insert(min(position, len(rules)), ' '.join(['-A'] + vals[1:]))
+                elif vals[0] == '-D':
+                    # What ebtables-save prints may be spelt differently, ebtables then matches the rule itself
+                    rule = ' '.join(['-A'] + vals[1:])
+                    if rule not in rules:
+                        return False
+                    rules.remove(rule)
+                else:
+                    return False
+
+        lines = ['*' + table]
+        lines += [rules[0] for rules in chains.values()]
+        for rules in chains.values():
+            lines += rules[1:]
+        if not execute_stdin('ebtables-restore', '\n'.join(lines) + '\n'):
+            return False
+        for op, rule in builtin:
+            if rule.split()[0] != '-D' and execute('ebtables -t %s %s' % (table, rule)) is None:
+                return False
+        return True
+
+    def replay(self, tool, table, ops):
+        result = True
+        for op, arg in ops:
+            if op == 'chain':
+                if execute('%s -t %s -N %s' % (tool, table, arg)) is None:
+                    execute('%s -t %s -F %s' % (tool, table, arg))
+            elif op == 'drop':
+                if tool == 'ebtables':
+                    for builtin in ['PREROUTING', 'POSTROUTING']:
+                        jumps = execute("ebtables -t %s -L %s | grep -- '-j %s$'" % (table, builtin, arg)) or ''
+                        for jump in filter(None, jumps.split('\n')):
+                            execute('ebtables -t %s -D %s %s' % (table, builtin, jump))
+                execute('%s -t %s -F %s' % (tool, table, arg))
+                execute('%s -t %s -X %s' % (tool, table, arg))
+            elif execute('%s -t %s %s' % (tool, table, arg)) is None:
+                result = False
+        return result
+
+
 def can_bridge_firewall(privnic):
     try:
         execute("which iptables")
@@ -87,6 +326,26 @@ def can_bridge_firewall(privnic):
     return True
 
 
+def open_libvirt():
+    """ The connection kept by the daemon, reopened if libvirtd went away, or a new one """
+    global libvirt_conn
+    if libvirt_conn is not None and libvirt_conn.isAlive() == 1:
+        return libvirt_conn
+    conn = libvirt.openReadOnly(driver)
+    if not conn:
+       print('Failed to open connection to the hypervisor')
+       sys.exit(3)
+    if libvirt_conn is not None:
+        logging.debug("Connection to libvirt was lost, reconnected")
+        libvirt_conn = conn
+    return conn
+
+
+def close_libvirt(conn):
+    if conn is not libvirt_conn:
+        conn.close()
+
+
 def virshlist(states):
     libvirt_states={ 'running'  : libvirt.VIR_DOMAIN_RUNNING,
                      'shutoff'  : libvirt.VIR_DOMAIN_SHUTOFF,
@@ -99,10 +358,7 @@ def virshlist(states):
 
     searchstates = list(libvirt_states[state] for state in states)
 
-    conn = libvirt.openReadOnly(driver)
-    if not conn:
-       print('Failed to open connection to the hypervisor')
-       sys.exit(3)
+    conn = open_libvirt()
 
     alldomains = map(conn.lookupByID, conn.listDomainsID())
     alldomains += map(conn.lookupByName, conn.listDefinedDomains())
@@ -111,8 +367,10 @@ def virshlist(states):
     for domain in alldomains:
         if domain.info()[0] in searchstates:
             domains.append(domain.name())
+            # Saves looking the domain up again by name
+            domain_cache().setdefault(domain.name(), {'dom': domain, 'id': str(domain.ID()), 'nics': None})
 
-    conn.close()
+    close_libvirt(conn)
 
     return domains
 
@@ -127,10 +385,7 @@ def virshdomstate(domain):
                      libvirt.VIR_DOMAIN_CRASHED  : 'crashed',
     }
 
-    conn = libvirt.openReadOnly(driver)
-    if not conn:
-       print('Failed to open connection to the hypervisor')
-       sys.exit(3)
+    conn = open_libvirt()
 
     try:
         dom = (conn.lookupByName (domain))
@@ -138,26 +393,60 @@ def virshdomstate(domain):
         return None
 
     state = libvirt_states[dom.info()[0]]
-    conn.close()
+    close_libvirt(conn)
 
     return state
 
 
-def virshdumpxml(domain):
-    conn = libvirt.openReadOnly(driver)
-    if not conn:
-       print('Failed to open connection to the hypervisor')
-       sys.exit(3)
+def domain_cache():
+    if not hasattr(command_cache, 'domains'):
+        command_cache.domains = {}
+    return command_cache.domains
+
+
+def reset_command_cache():
+    """ Forget what the previous command of the thread looked up """
+    command_cache.__dict__.clear()
+
+
+def lookup_domain(vmName):
+    """ The domain, its id and its nics, looked up once per command """
+    domains = domain_cache()
+    if vmName in domains:
+        return domains[vmName]
+
+    conn = open_libvirt()
 
     try:
-        dom = (conn.lookupByName (domain))
+        dom = (conn.lookupByName (vmName))
     except libvirt.libvirtError:
         return None
 
-    xml = dom.XMLDesc(0)
-    conn.close()
+    close_libvirt(conn)
+
+    domains[vmName] = {'dom': dom, 'id': str(dom.ID()), 'nics': None}
+    return domains[vmName]
+
+
+def domain_nics(vmName):
+    """ The vif, bridge and mac address of each interface of a domain """
+    domain = lookup_domain(vmName)
+    if domain is None:
+        return []
 
-    return xml
+    if domain['nics'] is None:
+        domain['nics'] = []
+        dom = xml.dom.minidom.parseString(domain['dom'].XMLDesc(0))
+        for network in dom.getElementsByTagName("interface"):
+            nic = {'vif': None, 'bridge': None, 'mac': None}
+            for target in network.getElementsByTagName('target')[:1]:
+                nic['vif'] = target.getAttribute("dev").strip()
+            for source in network.getElementsByTagName('source')[:1]:
+                nic['bridge'] = source.getAttribute("bridge").strip()
+            for mac in network.getElementsByTagName('mac')[:1]:
+                nic['mac'] = mac.getAttribute("address").strip()
+            domain['nics'].append(nic)
+    return domain['nics']
 
 
 def ipv6_link_local_addr(mac=None):
@@ -172,45 +461,36 @@ def destroy_network_rules_for_vm(vm_name, vif=None):
     vmchain_egress = egress_chain_name(vm_name)
     vmchain_default = None
     vm_ipsetname=ipset_chain_name(vm_name)
+    rules = RuleSet()
 
-    delete_rules_for_vm_in_bridge_firewall_chain(vm_name)
+    delete_rules_for_vm_in_bridge_firewall_chain(vm_name, rules)
     if vm_name.startswith('i-'):
         vmchain_default = '-'.join(vm_name.split('-')[:-1]) + "-def"
 
-    destroy_ebtables_rules(vm_name, vif)
+    destroy_ebtables_rules(vm_name, vif, rules)
 
     chains = [vmchain_default, vmchain, vmchain_egress]
     for chain in filter(None, chains):
-        try:
-            execute("iptables -F " + chain)
-            execute('ip6tables -F ' + chain)
-        except:
-            logging.debug("Ignoring failure to flush chain: " + chain)
+        rules.drop('iptables', chain)
+        rules.drop('ip6tables', chain)
 
-    for chain in filter(None, chains):
-        try:
-            execute("iptables -X " + chain)
-            execute('ip6tables -X ' + chain)
-        except:
-            logging.debug("Ignoring failure to delete chain: " + chain)
+    if vif:
+        dnats = execute("""iptables -t nat -S | awk '/%s/ { sub(/-A/, "-D", $1) ; print }'""" % vif ) or ''
+        for dnat in filter(None, dnats.split("\n")):
+            rules.rule('iptables', dnat, table='nat')
+
+    if not rules.commit():
+        logging.debug("Ignoring failure to delete rules for vm " + vm_name)
 
+    # The sets can only be deleted once no rule references them
     try:
         for ipset in [vm_ipsetname, vm_ipsetname + '-6']:
             execute('ipset -F ' + ipset)
             execute('ipset -X ' + ipset)
     except:
         logging.debug("Ignoring failure to delete ipset " + vmchain)
+    destroy_ipsets(vm_name)
 
-    if vif:
-        try:
-            dnats = execute("""iptables -t nat -S | awk '/%s/ { sub(/-A/, "-D", $1) ; print }'""" % vif ).split("\n")
-            for dnat in filter(None, dnats):
-                try:
-                    execute("iptables -t nat " + dnat)
-                except:
-                    logging.debug("Ignoring failure to delete dnat: " + dnat)
-        except:
-            pass
     remove_rule_log_for_vm(vm_name)
     remove_secip_log_for_vm(vm_name)
 
@@ -220,100 +500,69 @@ def destroy_network_rules_for_vm(vm_name, vif=None):
     return True
 
 
-def destroy_ebtables_rules(vm_name, vif):
+def destroy_ebtables_rules(vm_name, vif, ruleset=None):
     eb_vm_chain=ebtables_chain_name(vm_name)
-    delcmd = "ebtables -t nat -L PREROUTING | grep " + eb_vm_chain
-    delcmds = []
-    try:
-        delcmds = filter(None, execute(delcmd).split('\n'))
-        delcmds = ["-D PREROUTING " + x for x in delcmds ]
-    except:
-        pass
-    postcmds = []
-    try:
-        postcmd = "ebtables -t nat -L POSTROUTING | grep " + eb_vm_chain
-        postcmds = filter(None, execute(postcmd).split('\n'))
-        postcmds = ["-D POSTROUTING " + x for x in postcmds]
-    except:
-        pass
-
-    delcmds += postcmds
+    rules = ruleset or RuleSet()
 
-    for cmd in delcmds:
-        try:
-            execute("ebtables -t nat " + cmd)
-        except:
-            logging.debug("Ignoring failure to delete ebtables rules for vm " + vm_name)
+    # Dropping the chains also deletes the PREROUTING and POSTROUTING rules jumping to them
     chains = [eb_vm_chain+"-in", eb_vm_chain+"-out", eb_vm_chain+"-in-ips", eb_vm_chain+"-out-ips"]
     for chain in chains:
-        try:
-            execute("ebtables -t nat -F " + chain)
-            execute("ebtables -t nat -X " + chain)
-        except:
-            logging.debug("Ignoring failure to delete ebtables chain for vm " + vm_name)
+        rules.drop('ebtables', chain, table='nat')
 
+    if ruleset is None and not rules.commit():
+        logging.debug("Ignoring failure to delete ebtables chain for vm " + vm_name)
 
-def default_ebtables_rules(vm_name, vm_ip, vm_mac, vif):
+
+def default_ebtables_rules(vm_name, vm_ip, vm_mac, vif, ruleset=None):
     eb_vm_chain=ebtables_chain_name(vm_name)
     vmchain_in = eb_vm_chain + "-in"
     vmchain_out = eb_vm_chain + "-out"
     vmchain_in_ips = eb_vm_chain + "-in-ips"
     vmchain_out_ips = eb_vm_chain + "-out-ips"
+    rules = ruleset or RuleSet()
 
     for chain in [vmchain_in, vmchain_out, vmchain_in_ips, vmchain_out_ips]:
-        try:
-            execute("ebtables -t nat -N " + chain)
-        except:
-            execute("ebtables -t nat -F " + chain)
+        rules.chain('ebtables', chain, table='nat')
 
-    try:
-        # -s ! 52:54:0:56:44:32 -j DROP
-        execute("ebtables -t nat -A PREROUTING -i " + vif + " -j " + vmchain_in)
-        execute("ebtables -t nat -A POSTROUTING -o " + vif + " -j " + vmchain_out)
-        execute("ebtables -t nat -A " + vmchain_in_ips + " -j DROP")
-        execute("ebtables -t nat -A " + vmchain_out_ips + " -j DROP")
-    except:
-        logging.debug("Failed to program default rules")
-        return False
+    # -s ! 52:54:0:56:44:32 -j DROP
+    rules.rule('ebtables', "-A PREROUTING -i " + vif + " -j " + vmchain_in, table='nat')
+    rules.rule('ebtables', "-A POSTROUTING -o " + vif + " -j " + vmchain_out, table='nat')
+    rules.rule('ebtables', "-A " + vmchain_in_ips + " -j DROP", table='nat')
+    rules.rule('ebtables', "-A " + vmchain_out_ips + " -j DROP", table='nat')
 
-    try:
-        execute("ebtables -t nat -A " + vmchain_in + " -s ! " + vm_mac + " -j DROP")
-        execute("ebtables -t nat -A " + vmchain_in + " -p ARP -s ! " + vm_mac + " -j DROP")
-        execute("ebtables -t nat -A " + vmchain_in + " -p ARP --arp-mac-src ! " + vm_mac + " -j DROP")
-        if vm_ip:
-            execute("ebtables -t nat -A " + vmchain_in + " -p ARP -j " + vmchain_in_ips)
-            execute("ebtables -t nat -I " + vmchain_in_ips + " -p ARP --arp-ip-src " + vm_ip + " -j RETURN")
-        execute("ebtables -t nat -A " + vmchain_in + " -p ARP --arp-op Request -j ACCEPT")
-        execute("ebtables -t nat -A " + vmchain_in + " -p ARP --arp-op Reply -j ACCEPT")
-        execute("ebtables -t nat -A " + vmchain_in + " -p ARP -j DROP")
-    except:
-        logging.exception("Failed to program default ebtables IN rules")
-        return False
+    rules.rule('ebtables', "-A " + vmchain_in + " -s ! " + vm_mac + " -j DROP", table='nat')
+    rules.rule('ebtables', "-A " + vmchain_in + " -p ARP -s ! " + vm_mac + " -j DROP", table='nat')
+    rules.rule('ebtables', "-A " + vmchain_in + " -p ARP --arp-mac-src ! " + vm_mac + " -j DROP", table='nat')
+    if vm_ip:
+        rules.rule('ebtables', "-A " + vmchain_in + " -p ARP -j " + vmchain_in_ips, table='nat')
+        rules.rule('ebtables', "-I " + vmchain_in_ips + " -p ARP --arp-ip-src " + vm_ip + " -j RETURN", table='nat')
+    rules.rule('ebtables', "-A " + vmchain_in + " -p ARP --arp-op Request -j ACCEPT", table='nat')
+    rules.rule('ebtables', "-A " + vmchain_in + " -p ARP --arp-op Reply -j ACCEPT", table='nat')
+    rules.rule('ebtables', "-A " + vmchain_in + " -p ARP -j DROP", table='nat')
 
-    try:
-        execute("ebtables -t nat -A " + vmchain_out + " -p ARP --arp-op Reply --arp-mac-dst ! " + vm_mac + " -j DROP")
-        if vm_ip:
-            execute("ebtables -t nat -A " + vmchain_out + " -p ARP -j " + vmchain_out_ips )
-            execute("ebtables -t nat -I " + vmchain_out_ips + " -p ARP --arp-ip-dst " + vm_ip + " -j RETURN")
-        execute("ebtables -t nat -A " + vmchain_out + " -p ARP --arp-op Request -j ACCEPT")
-        execute("ebtables -t nat -A " + vmchain_out + " -p ARP --arp-op Reply -j ACCEPT")
-        execute("ebtables -t nat -A " + vmchain_out + " -p ARP -j DROP")
-    except:
-        logging.debug("Failed to program default ebtables OUT rules")
+    rules.rule('ebtables', "-A " + vmchain_out + " -p ARP --arp-op Reply --arp-mac-dst ! " + vm_mac + " -j DROP", table='nat')
+    if vm_ip:
+        rules.rule('ebtables', "-A " + vmchain_out + " -p ARP -j " + vmchain_out_ips, table='nat')
+        rules.rule('ebtables', "-I " + vmchain_out_ips + " -p ARP --arp-ip-dst " + vm_ip + " -j RETURN", table='nat')
+    rules.rule('ebtables', "-A " + vmchain_out + " -p ARP --arp-op Request -j ACCEPT", table='nat')
+    rules.rule('ebtables', "-A " + vmchain_out + " -p ARP --arp-op Reply -j ACCEPT", table='nat')
+    rules.rule('ebtables', "-A " + vmchain_out + " -p ARP -j DROP", table='nat')
+
+    if ruleset is None and not rules.commit():
+        logging.debug("Failed to program default ebtables rules")
         return False
+    return True
 
 
 def default_network_rules_systemvm(vm_name, localbrname):
     bridges = getBridges(vm_name)
     domid = getvmId(vm_name)
     vmchain = iptables_chain_name(vm_name)
+    rules = RuleSet()
 
-    delete_rules_for_vm_in_bridge_firewall_chain(vm_name)
+    delete_rules_for_vm_in_bridge_firewall_chain(vm_name, rules)
 
-    try:
-        execute("iptables -N " + vmchain)
-    except:
-        execute("iptables -F " + vmchain)
+    rules.chain('iptables', vmchain)
 
     for bridge in bridges:
         if bridge != localbrname:
@@ -322,15 +571,15 @@ def default_network_rules_systemvm(vm_name, localbrname):
             brfw = getBrfw(bridge)
             vifs = getVifsForBridge(vm_name, bridge)
             for vif in vifs:
-                try:
-                    execute("iptables -A " + brfw + "-OUT" + " -m physdev --physdev-is-bridged --physdev-out " + vif + " -j " + vmchain)
-                    execute("iptables -A " + brfw + "-IN" + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -j " + vmchain)
-                    execute("iptables -A " + vmchain + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -j RETURN")
-                except:
-                    logging.debug("Failed to program default rules")
-                    return False
+                rules.rule('iptables', "-A " + brfw + "-OUT" + " -m physdev --physdev-is-bridged --physdev-out " + vif + " -j " + vmchain)
+                rules.rule('iptables', "-A " + brfw + "-IN" + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -j " + vmchain)
+                rules.rule('iptables', "-A " + vmchain + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -j RETURN")
 
-    execute("iptables -A " + vmchain + " -j ACCEPT")
+    rules.rule('iptables', "-A " + vmchain + " -j ACCEPT")
+
+    if not rules.commit():
+        logging.debug("Failed to program default rules")
+        return False
 
     if not write_rule_log_for_vm(vm_name, '-1', '_ignore_', domid, '_initial_', '-1'):
         logging.debug("Failed to log default network rules for systemvm, ignoring")
@@ -338,37 +587,22 @@ def default_network_rules_systemvm(vm_name, localbrname):
 
 
 def remove_secip_log_for_vm(vmName):
-    vm_name = vmName
-    logfilename = logpath + vm_name + ".ip"
-
-    result = True
-    try:
-        os.remove(logfilename)
-    except:
-        logging.debug("Failed to delete rule log file " + logfilename)
-        result = False
+    with global_lock():
+        entry = load_rule_logs().get(vmName)
+        if entry is None or 'secips' not in entry:
+            return False
 
-    return result
+        del entry['secips']
+        if not entry:
+            del rule_logs[vmName]
+        return save_rule_logs()
 
 
 def write_secip_log_for_vm (vmName, secIps, vmId):
-    vm_name = vmName
-    logfilename = logpath + vm_name + ".ip"
-    logging.debug("Writing log to " + logfilename)
-    logf = open(logfilename, 'w')
-    output = ','.join([vmName, secIps, vmId])
-    result = True
-
-    try:
-        logf.write(output)
-        logf.write('\n')
-    except:
-        logging.debug("Failed to write to rule log file " + logfilename)
-        result = False
-
-    logf.close()
-
-    return result
+    logging.debug("Writing the secondary ips of " + vmName + " to " + rule_log_file)
+    with global_lock():
+        load_rule_logs().setdefault(vmName, {})['secips'] = secIps
+        return save_rule_logs()
 
 
 def create_ipset_forvm(ipsetname, type='iphash', family='inet'):
@@ -385,6 +619,44 @@ def create_ipset_forvm(ipsetname, type='iphash', family='inet'):
     return result
 
 
+def ipset_vm_prefix(vm_name):
+    """ The start of the names of the sets of a vm, a hash of its full name tells apart the vms with the same prefix """
+    return iptables_chain_name(vm_name)[:16] + '-' + hashlib.md5(vm_name).hexdigest()[:6]
+
+
+def ipset_group_name(vm_name, group):
+    """ The set holding the cidrs of one group of network rules, at most 30 characters to leave room for the swap set """
+    return ipset_vm_prefix(vm_name) + '-' + hashlib.md5(repr(group)).hexdigest()[:6]
+
+
+def restore_ipsets(sets):
+    """
+    Fill the hash:net sets with one ipset restore, sets is a {name: (family, cidrs)} dict.
+    Each set is filled as a temporary set that is then swapped with it, so it is never
+    seen partially filled.
+    """
+    if not sets:
+        return True
+    lines = []
+    for name, (family, cidrs) in sets.items():
+        tmpname = name + 'T'
+        lines.append('create %s hash:net family %s -exist' % (name, family))
+        lines.append('create %s hash:net family %s -exist' % (tmpname, family))
+        lines.append('flush ' + tmpname)
+        lines += ['add %s %s -exist' % (tmpname, cidr) for cidr in cidrs]
+        lines.append('swap %s %s' % (tmpname, name))
+        lines.append('destroy ' + tmpname)
+    return execute_stdin('ipset restore', '\n'.join(lines) + '\n')
+
+
+def destroy_ipsets(vm_name, keep=()):
+    """ Destroy the sets of the network rules of a vm, except the ones to keep """
+    pattern = re.compile('^%s-[0-9a-f]{6}$' % re.escape(ipset_vm_prefix(vm_name)))
+    for name in (execute('ipset list -n') or '').split('\n'):
+        if pattern.match(name) and name not in keep:
+            execute('ipset destroy ' + name)
+
+
 def add_to_ipset(ipsetname, ips, action):
     result = True
     for ip in ips:
@@ -413,10 +685,11 @@ def network_rules_vmSecondaryIp(vm_name, ip_secondary, action):
     return True
 
 
-def ebtables_rules_vmip (vmname, ips, action):
+def ebtables_rules_vmip (vmname, ips, action, ruleset=None):
     eb_vm_chain=ebtables_chain_name(vmname)
     vmchain_inips = eb_vm_chain + "-in-ips"
     vmchain_outips = eb_vm_chain + "-out-ips"
+    rules = ruleset or RuleSet()
 
     if action and action.strip() == "-A":
         action = "-I"
@@ -425,38 +698,32 @@ def ebtables_rules_vmip (vmname, ips, action):
         logging.debug("ip = " + ip)
         if ip == 0 or ip == "0":
             continue
-        try:
-            execute("ebtables -t nat " + action + " " + vmchain_inips + " -p ARP --arp-ip-src " + ip + " -j RETURN")
-            execute("ebtables -t nat " + action + " " + vmchain_outips + " -p ARP --arp-ip-dst " + ip + " -j RETURN")
-        except:
-            logging.debug("Failed to program ebtables rules for secondary ip %s for vm %s with action %s" % (ip, vmname, action))
+        rules.rule('ebtables', action + " " + vmchain_inips + " -p ARP --arp-ip-src " + ip + " -j RETURN", table='nat')
+        rules.rule('ebtables', action + " " + vmchain_outips + " -p ARP --arp-ip-dst " + ip + " -j RETURN", table='nat')
+
+    if ruleset is None and not rules.commit():
+        logging.debug("Failed to program ebtables rules for secondary ips %s for vm %s with action %s" % (ips, vmname, action))
 
 
-def default_network_rules(vm_name, vm_id, vm_ip, vm_ip6, vm_mac, vif, brname, sec_ips):
+def default_network_rules(vm_name, vm_id, vm_ip, vm_ip6, vm_mac, vif, brname, sec_ips, ruleset=None):
     if not addFWFramework(brname):
         return False
 
     vmName = vm_name
     brfw = getBrfw(brname)
     domID = getvmId(vm_name)
-    delete_rules_for_vm_in_bridge_firewall_chain(vmName)
+    rules = ruleset or RuleSet()
+    delete_rules_for_vm_in_bridge_firewall_chain(vmName, rules)
     vmchain = iptables_chain_name(vm_name)
     vmchain_egress = egress_chain_name(vm_name)
     vmchain_default = '-'.join(vmchain.split('-')[:-1]) + "-def"
     ipv6_link_local = ipv6_link_local_addr(vm_mac)
 
-    destroy_ebtables_rules(vm_name, vif)
+    destroy_ebtables_rules(vm_name, vif, rules)
 
     for chain in [vmchain, vmchain_egress, vmchain_default]:
-        try:
-            execute('iptables -N ' + chain)
-        except:
-            execute('iptables -F ' + chain)
-
-        try:
-            execute('ip6tables -N ' + chain)
-        except:
-            execute('ip6tables -F ' + chain)
+        rules.chain('iptables', chain)
+        rules.chain('ip6tables', chain)
 
     action = "-A"
     vmipsetName = ipset_chain_name(vm_name)
@@ -483,33 +750,25 @@ def default_network_rules(vm_name, vm_id, vm_ip, vm_ip6, vm_mac, vif, brname, se
         if not write_secip_log_for_vm(vm_name, sec_ips, vm_id):
             logging.debug("Failed to log default network rules, ignoring")
 
-    try:
-        execute("iptables -A " + brfw + "-OUT" + " -m physdev --physdev-is-bridged --physdev-out " + vif + " -j " + vmchain_default)
-        execute("iptables -A " + brfw + "-IN" + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -j " + vmchain_default)
-        execute("iptables -A " + vmchain_default + " -m state --state RELATED,ESTABLISHED -j ACCEPT")
-        #allow dhcp
-        execute("iptables -A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -p udp --dport 67 --sport 68 -j ACCEPT")
-        execute("iptables -A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-out " + vif + " -p udp --dport 68 --sport 67  -j ACCEPT")
-
-        #don't let vm spoof its ip address
-        if vm_ip:
-            execute("iptables -A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -m set ! --set " + vmipsetName + " src -j DROP")
-            execute("iptables -A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -m set --set " + vmipsetName + " src -p udp --dport 53  -j RETURN ")
-            execute("iptables -A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -m set --set " + vmipsetName + " src -p tcp --dport 53  -j RETURN ")
-            execute("iptables -A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -m set --set " + vmipsetName + " src -j " + vmchain_egress)
-        execute("iptables -A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-out " + vif + " -j " + vmchain)
-        execute("iptables -A " + vmchain + " -j DROP")
-    except:
-        logging.debug("Failed to program default rules for vm " + vm_name)
-        return False
-
-    default_ebtables_rules(vm_name, vm_ip, vm_mac, vif)
-    #default ebtables rules for vm secondary ips
-    ebtables_rules_vmip(vm_name, ips, "-I")
+    rules.rule('iptables', "-A " + brfw + "-OUT" + " -m physdev --physdev-is-bridged --physdev-out " + vif + " -j " + vmchain_default)
+    rules.rule('iptables', "-A " + brfw + "-IN" + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -j " + vmchain_default)
+    rules.rule('iptables', "-A " + vmchain_default + " -m state --state RELATED,ESTABLISHED -j ACCEPT")
+    #allow dhcp
+    rules.rule('iptables', "-A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -p udp --dport 67 --sport 68 -j ACCEPT")
+    rules.rule('iptables', "-A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-out " + vif + " -p udp --dport 68 --sport 67  -j ACCEPT")
 
+    #don't let vm spoof its ip address
     if vm_ip:
-        if not write_rule_log_for_vm(vmName, vm_id, vm_ip, domID, '_initial_', '-1'):
-            logging.debug("Failed to log default network rules, ignoring")
+        rules.rule('iptables', "-A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -m set ! --set " + vmipsetName + " src -j DROP")
+        rules.rule('iptables', "-A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -m set --set " + vmipsetName + " src -p udp --dport 53  -j RETURN ")
+        rules.rule('iptables', "-A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -m set --set " + vmipsetName + " src -p tcp --dport 53  -j RETURN ")
+        rules.rule('iptables', "-A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -m set --set " + vmipsetName + " src -j " + vmchain_egress)
+    rules.rule('iptables', "-A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-out " + vif + " -j " + vmchain)
+    rules.rule('iptables', "-A " + vmchain + " -j DROP")
+
+    default_ebtables_rules(vm_name, vm_ip, vm_mac, vif, rules)
+    #default ebtables rules for vm secondary ips
+    ebtables_rules_vmip(vm_name, ips, "-I", rules)
 
     vm_ip6_set_name = vm_name + '-6'
 
@@ -527,61 +786,69 @@ def default_network_rules(vm_name, vm_id, vm_ip, vm_ip6, vm_mac, vif, brname, se
 
     add_to_ipset(vm_ip6_set_name, vm_ip6_addr, action)
 
-    try:
-        execute('ip6tables -A ' + brfw + '-OUT' + ' -m physdev --physdev-is-bridged --physdev-out ' + vif + ' -j ' + vmchain_default)
-        execute('ip6tables -A ' + brfw + '-IN' + ' -m physdev --physdev-is-bridged --physdev-in ' + vif + ' -j ' + vmchain_default)
-        execute('ip6tables -A ' + vmchain_default + ' -m state --state RELATED,ESTABLISHED -j ACCEPT')
+    rules.rule('ip6tables', '-A ' + brfw + '-OUT' + ' -m physdev --physdev-is-bridged --physdev-out ' + vif + ' -j ' + vmchain_default)
+    rules.rule('ip6tables', '-A ' + brfw + '-IN' + ' -m physdev --physdev-is-bridged --physdev-in ' + vif + ' -j ' + vmchain_default)
+    rules.rule('ip6tables', '-A ' + vmchain_default + ' -m state --state RELATED,ESTABLISHED -j ACCEPT')
 
-        # Allow Instances to receive Router Advertisements, send out solicitations, but block any outgoing Advertisement from a Instance
-        execute('ip6tables -A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-out ' + vif + ' --src fe80::/64 --dst ff02::1 -p icmpv6 --icmpv6-type router-advertisement -m hl --hl-eq 255 -j ACCEPT')
-        execute('ip6tables -A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-in ' + vif + ' --dst ff02::2 -p icmpv6 --icmpv6-type router-solicitation -m hl --hl-eq 255 -j RETURN')
-        execute('ip6tables -A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-in ' + vif + ' -p icmpv6 --icmpv6-type router-advertisement -j DROP')
+    # Allow Instances to receive Router Advertisements, send out solicitations, but block any outgoing Advertisement from a Instance
+    rules.rule('ip6tables', '-A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-out ' + vif + ' --src fe80::/64 --dst ff02::1 -p icmpv6 --icmpv6-type router-advertisement -m hl --hl-eq 255 -j ACCEPT')
+    rules.rule('ip6tables', '-A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-in ' + vif + ' --dst ff02::2 -p icmpv6 --icmpv6-type router-solicitation -m hl --hl-eq 255 -j RETURN')
+    rules.rule('ip6tables', '-A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-in ' + vif + ' -p icmpv6 --icmpv6-type router-advertisement -j DROP')
 
-        # Allow neighbor solicitations and advertisements
-        execute('ip6tables -A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-in ' + vif + ' -p icmpv6 --icmpv6-type neighbor-solicitation -m hl --hl-eq 255 -j RETURN')
-        execute('ip6tables -A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-out ' + vif + ' -p icmpv6 --icmpv6-type neighbor-solicitation -m hl --hl-eq 255 -j ACCEPT')
-        execute('ip6tables -A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-in ' + vif + ' -p icmpv6 --icmpv6-type neighbor-advertisement -m set --match-set ' + vm_ip6_set_name + ' src -m hl --hl-eq 255 -j RETURN')
-        execute('ip6tables -A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-out ' + vif + ' -p icmpv6 --icmpv6-type neighbor-advertisement -m hl --hl-eq 255 -j ACCEPT')
+    # Allow neighbor solicitations and advertisements
+    rules.rule('ip6tables', '-A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-in ' + vif + ' -p icmpv6 --icmpv6-type neighbor-solicitation -m hl --hl-eq 255 -j RETURN')
+    rules.rule('ip6tables', '-A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-out ' + vif + ' -p icmpv6 --icmpv6-type neighbor-solicitation -m hl --hl-eq 255 -j ACCEPT')
+    rules.rule('ip6tables', '-A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-in ' + vif + ' -p icmpv6 --icmpv6-type neighbor-advertisement -m set --match-set ' + vm_ip6_set_name + ' src -m hl --hl-eq 255 -j RETURN')
+    rules.rule('ip6tables', '-A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-out ' + vif + ' -p icmpv6 --icmpv6-type neighbor-advertisement -m hl --hl-eq 255 -j ACCEPT')
 
-        # Packets to allow as per RFC4890
-        execute('ip6tables -A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-in ' + vif + ' -p icmpv6 --icmpv6-type packet-too-big -m set --match-set ' + vm_ip6_set_name + ' src -j RETURN')
-        execute('ip6tables -A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-out ' + vif + ' -p icmpv6 --icmpv6-type packet-too-big -j ACCEPT')
+    # Packets to allow as per RFC4890
+    rules.rule('ip6tables', '-A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-in ' + vif + ' -p icmpv6 --icmpv6-type packet-too-big -m set --match-set ' + vm_ip6_set_name + ' src -j RETURN')
+    rules.rule('ip6tables', '-A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-out ' + vif + ' -p icmpv6 --icmpv6-type packet-too-big -j ACCEPT')
 
-        execute('ip6tables -A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-in ' + vif + ' -p icmpv6 --icmpv6-type destination-unreachable -m set --match-set ' + vm_ip6_set_name + ' src -j RETURN')
-        execute('ip6tables -A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-out ' + vif + ' -p icmpv6 --icmpv6-type destination-unreachable -j ACCEPT')
+    rules.rule('ip6tables', '-A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-in ' + vif + ' -p icmpv6 --icmpv6-type destination-unreachable -m set --match-set ' + vm_ip6_set_name + ' src -j RETURN')
+    rules.rule('ip6tables', '-A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-out ' + vif + ' -p icmpv6 --icmpv6-type destination-unreachable -j ACCEPT')
 
-        execute('ip6tables -A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-in ' + vif + ' -p icmpv6 --icmpv6-type time-exceeded -m set --match-set ' + vm_ip6_set_name + ' src -j RETURN')
-        execute('ip6tables -A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-out ' + vif + ' -p icmpv6 --icmpv6-type time-exceeded -j ACCEPT')
+    rules.rule('ip6tables', '-A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-in ' + vif + ' -p icmpv6 --icmpv6-type time-exceeded -m set --match-set ' + vm_ip6_set_name + ' src -j RETURN')
+    rules.rule('ip6tables', '-A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-out ' + vif + ' -p icmpv6 --icmpv6-type time-exceeded -j ACCEPT')
 
-        execute('ip6tables -A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-in ' + vif + ' -p icmpv6 --icmpv6-type parameter-problem -m set --match-set ' + vm_ip6_set_name + ' src -j RETURN')
-        execute('ip6tables -A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-out ' + vif + ' -p icmpv6 --icmpv6-type parameter-problem -j ACCEPT')
+    rules.rule('ip6tables', '-A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-in ' + vif + ' -p icmpv6 --icmpv6-type parameter-problem -m set --match-set ' + vm_ip6_set_name + ' src -j RETURN')
+    rules.rule('ip6tables', '-A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-out ' + vif + ' -p icmpv6 --icmpv6-type parameter-problem -j ACCEPT')
 
-        # MLDv2 discovery packets
-        execute('ip6tables -A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-in ' + vif + ' -p icmpv6 --dst ff02::16 -j RETURN')
+    # MLDv2 discovery packets
+    rules.rule('ip6tables', '-A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-in ' + vif + ' -p icmpv6 --dst ff02::16 -j RETURN')
 
-        # Allow Instances to send out DHCPv6 client messages, but block server messages
-        execute('ip6tables -A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-in ' + vif + ' -p udp --sport 546 --dst ff02::1:2 --src ' + str(ipv6_link_local) + ' -j RETURN')
-        execute('ip6tables -A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-out ' + vif + ' -p udp --src fe80::/64 --dport 546 --dst ' + str(ipv6_link_local) + ' -j ACCEPT')
-        execute('ip6tables -A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-in ' + vif + ' -p udp --sport 547 ! --dst fe80::/64 -j DROP')
+    # Allow Instances to send out DHCPv6 client messages, but block server messages
+    rules.rule('ip6tables', '-A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-in ' + vif + ' -p udp --sport 546 --dst ff02::1:2 --src ' + str(ipv6_link_local) + ' -j RETURN')
+    rules.rule('ip6tables', '-A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-out ' + vif + ' -p udp --src fe80::/64 --dport 546 --dst ' + str(ipv6_link_local) + ' -j ACCEPT')
+    rules.rule('ip6tables', '-A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-in ' + vif + ' -p udp --sport 547 ! --dst fe80::/64 -j DROP')
 
-        # Always allow outbound DNS over UDP and TCP
-        execute('ip6tables -A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-in ' + vif + ' -p udp --dport 53 -m set --match-set ' + vm_ip6_set_name + ' src -j RETURN')
-        execute('ip6tables -A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-in ' + vif + ' -p tcp --dport 53 -m set --match-set ' + vm_ip6_set_name + ' src -j RETURN')
+    # Always allow outbound DNS over UDP and TCP
+    rules.rule('ip6tables', '-A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-in ' + vif + ' -p udp --dport 53 -m set --match-set ' + vm_ip6_set_name + ' src -j RETURN')
+    rules.rule('ip6tables', '-A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-in ' + vif + ' -p tcp --dport 53 -m set --match-set ' + vm_ip6_set_name + ' src -j RETURN')
 
-        # Prevent source address spoofing
-        execute('ip6tables -A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-in ' + vif + ' -m set ! --match-set ' + vm_ip6_set_name + ' src -j DROP')
+    # Prevent source address spoofing
+    rules.rule('ip6tables', '-A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-in ' + vif + ' -m set ! --match-set ' + vm_ip6_set_name + ' src -j DROP')
 
-        # Send proper traffic to the egress chain of the Instance
-        execute('ip6tables -A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-in ' + vif + ' -m set --match-set ' + vm_ip6_set_name + ' src -j ' + vmchain_egress)
+    # Send proper traffic to the egress chain of the Instance
+    rules.rule('ip6tables', '-A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-in ' + vif + ' -m set --match-set ' + vm_ip6_set_name + ' src -j ' + vmchain_egress)
 
-        execute('ip6tables -A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-out ' + vif + ' -j ' + vmchain)
+    rules.rule('ip6tables', '-A ' + vmchain_default + ' -m physdev --physdev-is-bridged --physdev-out ' + vif + ' -j ' + vmchain)
 
-        # Drop all other traffic into the Instance
-        execute('ip6tables -A ' + vmchain + ' -j DROP')
-    except:
+    # Drop all other traffic into the Instance
+    rules.rule('ip6tables', '-A ' + vmchain + ' -j DROP')
+
+    # When a rule set is given the caller applies it and logs the rules
+    if ruleset is not None:
+        return True
+
+    if not rules.commit():
         logging.debug('Failed to program default rules for vm ' + vm_name)
         return False
 
+    if vm_ip:
+        if not write_rule_log_for_vm(vmName, vm_id, vm_ip, domID, '_initial_', '-1'):
+            logging.debug("Failed to log default network rules, ignoring")
+
     logging.debug("Programmed default rules for vm " + vm_name)
     return True
 
@@ -592,83 +859,140 @@ def post_default_network_rules(vm_name, vm_id, vm_ip, vm_mac, vif, brname, dhcpS
     vmchain_in = iptables_vmchain + "-in"
     vmchain_out = iptables_vmchain + "-out"
     domID = getvmId(vm_name)
-    try:
-        execute("iptables -I " + vmchain_default + " 4 -m physdev --physdev-is-bridged --physdev-in " + vif + " --source " + vm_ip + " -j ACCEPT")
-    except:
-        pass
-    try:
-        execute("iptables -t nat -A PREROUTING -p tcp -m physdev --physdev-in " + vif + " -m tcp --dport 80 -d " + dhcpSvr + " -j DNAT --to-destination " + hostIp + ":80")
-    except:
-        pass
+    rules = RuleSet()
 
-    try:
-        execute("ebtables -t nat -I " + vmchain_in + " -p IPv4 --ip-protocol tcp --ip-destination-port 80 --ip-dst " + dhcpSvr + " -j dnat --to-destination " + hostMacAddr)
-    except:
-        pass
+    rules.rule('iptables', "-I " + vmchain_default + " 4 -m physdev --physdev-is-bridged --physdev-in " + vif + " --source " + vm_ip + " -j ACCEPT")
+    rules.rule('iptables', "-A PREROUTING -p tcp -m physdev --physdev-in " + vif + " -m tcp --dport 80 -d " + dhcpSvr + " -j DNAT --to-destination " + hostIp + ":80", table='nat')
 
-    try:
-        execute("ebtables -t nat -I " + vmchain_in + " 4 -p ARP --arp-ip-src ! " + vm_ip + " -j DROP")
-    except:
-        pass
-    try:
-        execute("ebtables -t nat -I " + vmchain_out + " 2 -p ARP --arp-ip-dst ! " + vm_ip + " -j DROP")
-    except:
-        pass
+    rules.rule('ebtables', "-I " + vmchain_in + " -p IPv4 --ip-protocol tcp --ip-destination-port 80 --ip-dst " + dhcpSvr + " -j dnat --to-destination " + hostMacAddr, table='nat')
+    rules.rule('ebtables', "-I " + vmchain_in + " 4 -p ARP --arp-ip-src ! " + vm_ip + " -j DROP", table='nat')
+    rules.rule('ebtables', "-I " + vmchain_out + " 2 -p ARP --arp-ip-dst ! " + vm_ip + " -j DROP", table='nat')
+
+    rules.commit()
     if not write_rule_log_for_vm(vm_name, vm_id, vm_ip, domID, '_initial_', '-1'):
             logging.debug("Failed to log default network rules, ignoring")
 
 
-def delete_rules_for_vm_in_bridge_firewall_chain(vmName):
+def delete_rules_for_vm_in_bridge_firewall_chain(vmName, ruleset=None):
     vm_name = vmName
     if vm_name.startswith('i-'):
         vm_name=iptables_chain_name(vm_name)
         vm_name = '-'.join(vm_name.split('-')[:-1]) + "-def"
 
     vmchain = iptables_chain_name(vm_name)
+    rules = ruleset or RuleSet()
+
+    for tool in ['iptables', 'ip6tables']:
+        delcmd = """%s-save | awk '/BF(.*)physdev-is-bridged(.*)%s/ { sub(/-A/, "-D", $1) ; print }'""" % (tool, vmchain)
+        delcmds = filter(None, (execute(delcmd) or '').split('\n'))
+        for cmd in delcmds:
+            rules.rule(tool, cmd)
+
+    if ruleset is None and not rules.commit():
+        logging.debug("Ignoring failure to delete rules for vm " + vmName)
 
-    delcmd = """iptables-save | awk '/BF(.*)physdev-is-bridged(.*)%s/ { sub(/-A/, "-D", $1) ; print }'""" % vmchain
-    delcmds = filter(None, execute(delcmd).split('\n'))
-    for cmd in delcmds:
-        try:
-            execute("iptables " + cmd)
-        except:
-              logging.exception("Ignoring failure to delete rules for vm " + vmName)
 
-    delcmd = """ip6tables-save | awk '/BF(.*)physdev-is-bridged(.*)%s/ { sub(/-A/, "-D", $1) ; print }'""" % vmchain
-    delcmds = filter(None, execute(delcmd).split('\n'))
-    for cmd in delcmds:
+def load_rule_logs():
+    """
+    The rule logs of all the vms, read from rule_log_file again only when another
+    process replaced it. The logs of the older releases, one <vm>.log and <vm>.ip
+    file per vm, are moved into it.
+    """
+    global rule_logs, rule_logs_stat
+    try:
+        stat = os.stat(rule_log_file)
+        stat = (stat.st_ino, stat.st_mtime, stat.st_size)
+    except OSError:
+        stat = None
+    if rule_logs is not None and stat == rule_logs_stat:
+        return rule_logs
+
+    rule_logs = {}
+    rule_logs_stat = stat
+    if stat is not None:
         try:
-            execute('ip6tables ' + cmd)
-        except:
-              logging.exception("Ignoring failure to delete rules for vm " + vmName)
+            with open(rule_log_file) as logf:
+                rule_logs = json.load(logf)
+        except (IOError, ValueError):
+            logging.warning("Ignoring the unreadable rule log file " + rule_log_file)
+        return rule_logs
+
+    with global_lock():
+        if os.path.exists(rule_log_file):
+            # Another process moved the old logs in the meantime
+            return load_rule_logs()
+        legacy = []
+        for filename in (os.listdir(logpath) if os.path.isdir(logpath) else []):
+            vm_name, ext = os.path.splitext(filename)
+            if ext not in ['.log', '.ip'] or vm_name[:2] not in ['r-', 'i-', 's-', 'v-']:
+                continue
+            legacy.append(logpath + filename)
+            try:
+                line = open(logpath + filename).readline().rstrip()
+            except IOError:
+                continue
+            entry = rule_logs.setdefault(vm_name, {})
+            if ext == '.ip':
+                # The secondary ips are ; separated, the name and id around them
+                entry['secips'] = ','.join(line.split(',')[1:-1])
+            elif len(line.split(',')) == len(RULE_LOG_FIELDS):
+                entry.update(zip(RULE_LOG_FIELDS, line.split(',')))
+
+        if legacy and save_rule_logs():
+            logging.debug("Moved %s rule log files into %s" % (len(legacy), rule_log_file))
+            for filename in legacy:
+                os.remove(filename)
+    return rule_logs
+
+
+def save_rule_logs():
+    """
+    Replace rule_log_file atomically, a crash leaves either the old or the new logs.
+    The callers changing the logs hold the global lock from load_rule_logs() on.
+    """
+    global rule_logs_stat
+    tmpfile = rule_log_file + '.tmp'
+    try:
+        with global_lock():
+            if not os.path.exists(logpath):
+                os.makedirs(logpath)
+            with open(tmpfile, 'w') as logf:
+                json.dump(rule_logs, logf, sort_keys=True)
+                logf.flush()
+                os.fsync(logf.fileno())
+            os.rename(tmpfile, rule_log_file)
+            stat = os.stat(rule_log_file)
+            rule_logs_stat = (stat.st_ino, stat.st_mtime, stat.st_size)
+    except (IOError, OSError):
+        logging.exception("Failed to write the rule log file " + rule_log_file)
+        return False
+    return True
+
+
+def read_rule_log(vmName):
+    """ The fields of the rule log of a vm, None if there is no log """
+    entry = load_rule_logs().get(vmName, {})
+    if 'seqno' not in entry:
+        return None
+    return [entry[field] for field in RULE_LOG_FIELDS]
 
 
 def rewrite_rule_log_for_vm(vm_name, new_domid):
-    logfilename = logpath + vm_name + ".log"
-    if not os.path.exists(logfilename):
+    fields = read_rule_log(vm_name)
+    if fields is None:
         return
-    lines = (line.rstrip() for line in open(logfilename))
 
-    [_vmName,_vmID,_vmIP,_domID,_signature,_seqno] = ['_', '-1', '_', '-1', '_', '-1']
-    for line in lines:
-        [_vmName,_vmID,_vmIP,_domID,_signature,_seqno] = line.split(',')
-        break
+    [_vmName,_vmID,_vmIP,_domID,_signature,_seqno] = fields or EMPTY_RULE_LOG
 
     write_rule_log_for_vm(_vmName, _vmID, '0.0.0.0', new_domid, _signature, '-1')
 
 
 def get_rule_log_for_vm(vmName):
-    vm_name = vmName
-    logfilename = logpath + vm_name + ".log"
-    if not os.path.exists(logfilename):
+    fields = read_rule_log(vmName)
+    if fields is None:
         return ''
 
-    lines = (line.rstrip() for line in open(logfilename))
-
-    [_vmName,_vmID,_vmIP,_domID,_signature,_seqno] = ['_', '-1', '_', '-1', '_', '-1']
-    for line in lines:
-        [_vmName,_vmID,_vmIP,_domID,_signature,_seqno] = line.split(',')
-        break
+    [_vmName,_vmID,_vmIP,_domID,_signature,_seqno] = fields or EMPTY_RULE_LOG
 
     return ','.join([_vmName, _vmID, _vmIP, _domID, _signature, _seqno])
 
@@ -678,17 +1002,11 @@ def check_domid_changed(vmName):
     if (curr_domid is None) or (not curr_domid.isdigit()):
         curr_domid = '-1'
 
-    vm_name = vmName
-    logfilename = logpath + vm_name + ".log"
-    if not os.path.exists(logfilename):
+    fields = read_rule_log(vmName)
+    if fields is None:
         return ['-1', curr_domid]
 
-    lines = (line.rstrip() for line in open(logfilename))
-
-    [_vmName,_vmID,_vmIP,old_domid,_signature,_seqno] = ['_', '-1', '_', '-1', '_', '-1']
-    for line in lines:
-        [_vmName,_vmID,_vmIP,old_domid,_signature,_seqno] = line.split(',')
-        break
+    [_vmName,_vmID,_vmIP,old_domid,_signature,_seqno] = fields or EMPTY_RULE_LOG
 
     return [curr_domid, old_domid]
 
@@ -708,15 +1026,13 @@ def network_rules_for_rebooted_vm(vmName):
 
     logging.debug("Found a rebooted VM -- reprogramming rules for " + vm_name)
 
-    delete_rules_for_vm_in_bridge_firewall_chain(vm_name)
+    rules = RuleSet()
+    delete_rules_for_vm_in_bridge_firewall_chain(vm_name, rules)
 
-    brName = execute("iptables-save | awk -F '-j ' '/FORWARD -o(.*)physdev-is-bridged(.*)BF/ {print $2}'").strip()
-    if brName is None or brName is "":
-        brName = "cloudbr0"
-    else:
-        brName = execute("iptables-save |grep physdev-is-bridged |grep FORWARD |grep BF |grep '\-o' |awk '{print $4}' | head -1").strip()
+    brName = next(iter(bridge_firewall_chains()), "cloudbr0")
 
     if 1 in [ vm_name.startswith(c) for c in ['r-', 's-', 'v-'] ]:
+        rules.commit()
         default_network_rules_systemvm(vm_name, brName)
         return True
 
@@ -724,24 +1040,21 @@ def network_rules_for_rebooted_vm(vmName):
     vmchain_default = '-'.join(vmchain.split('-')[:-1]) + "-def"
 
     vifs = getVifs(vmName)
-    logging.debug(vifs, brName)
+    logging.debug("Vifs of vm %s on bridge %s: %s" % (vm_name, brName, vifs))
+    brfw = getBrfw(brName)
     for v in vifs:
-        execute("iptables -A " + getBrfw(brName) + "-IN " + " -m physdev --physdev-is-bridged --physdev-in " + v + " -j "+ vmchain_default)
-        execute("iptables -A " + getBrfw(brName) + "-OUT " + " -m physdev --physdev-is-bridged --physdev-out " + v + " -j "+ vmchain_default)
-        execute("ip6tables -A " + getBrfw(brName) + "-IN " + " -m physdev --physdev-is-bridged --physdev-in " + v + " -j " + vmchain_default)
-        execute("ip6tables -A " + getBrfw(brName) + "-OUT " + " -m physdev --physdev-is-bridged --physdev-out " + v + " -j " + vmchain_default)
+        for tool in ['iptables', 'ip6tables']:
+            rules.rule(tool, "-A " + brfw + "-IN " + " -m physdev --physdev-is-bridged --physdev-in " + v + " -j " + vmchain_default)
+            rules.rule(tool, "-A " + brfw + "-OUT " + " -m physdev --physdev-is-bridged --physdev-out " + v + " -j " + vmchain_default)
+    if not rules.commit():
+        logging.debug("Failed to program the bridge firewall rules for vm " + vm_name)
 
     #change antispoof rule in vmchain
     try:
-        delcmd = """iptables-save | awk '/-A %s(.*)physdev/ { sub(/-A/, "-D", $1) ; print }'""" % vmchain_default
-        inscmd = """iptables-save | awk '/-A %s(.*)physdev/ { gsub(/vnet[0-9]+/, "%s") ; sub(/-A/, "-D", $1) ; print }'""" % ( vmchain_default,vifs[0] )
-        ipts = []
-        for cmd in [delcmd, inscmd]:
-            logging.debug(cmd)
-            cmds = filter(None, execute(cmd).split('\n'))
-            for c in cmds:
-                    ipt = "iptables " + c
-                    ipts.append(ipt)
+        saved = read_saved_tables('iptables').get('filter', {}).get(vmchain_default, ('-', []))[1]
+        saved = [rule for rule in saved if 'physdev' in rule]
+        ipts = ["iptables -D" + rule[2:] for rule in saved]
+        ipts += ["iptables -D" + re.sub(r'vnet[0-9]+', vifs[0], rule)[2:] for rule in saved]
 
         for ipt in ipts:
             try:
@@ -765,10 +1078,11 @@ def get_rule_logs_for_vms():
             name = name.rstrip()
             if 1 not in [ name.startswith(c) for c in ['r-', 's-', 'v-', 'i-'] ]:
                 continue
-            network_rules_for_rebooted_vm(name)
-            if name.startswith('i-'):
-                log = get_rule_log_for_vm(name)
-                result.append(log)
+            with vm_lock(name):
+                network_rules_for_rebooted_vm(name)
+                if name.startswith('i-'):
+                    log = get_rule_log_for_vm(name)
+                    result.append(log)
     except:
         logging.exception("Failed to get rule logs, better luck next time!")
 
@@ -808,78 +1122,164 @@ def cleanup_bridge(bridge):
 
 
 def cleanup_rules():
+    """
+    Delete the rules, chains and sets of the vms that are not running or paused anymore.
+    The tables are read once and everything is deleted with one restore per table.
+    """
     try:
+        start = time.time()
         states=['running','paused']
         vmsInHost = virshlist(states)
 
         logging.debug(" Vms on the host : %s ", vmsInHost)
 
-        cleanup = []
-        chainscmd = """iptables-save | grep -P '^:(?!.*-(def|eg))' | awk '{sub(/^:/, "", $1) ; print $1}' | sort | uniq"""
-        chains = execute(chainscmd).split('\n')
-
-        logging.debug(" iptables chains in the host :%s ", chains)
-
-        for chain in chains:
-            if 1 in [ chain.startswith(c) for c in ['r-', 'i-', 's-', 'v-'] ]:
-                vm_name = chain
-                vmpresent=False
-
-                for vm in vmsInHost:
-                    if vm_name  in vm:
-                        vmpresent=True
-                        break
-
-                if vmpresent is False:
-                    logging.debug("vm " + vm_name + " is not running or paused, cleaning up iptables rules")
-                    cleanup.append(vm_name)
-
-        bridge_tables = execute("""grep -E '^ebtable_' /proc/modules | cut -f1 -d' ' | sed s/ebtable_//""").split('\n')
-        for table in filter(None, bridge_tables):
-            chainscmd = """ebtables -t %s -L | awk '/chain:/ { gsub(/(^.*chain: |-(in|out|ips).*)/, ""); print $1}' | sort | uniq""" % table
-            chains = execute(chainscmd).split('\n')
-
-        logging.debug(" ebtables chains in the host: %s ", chains)
+        # The chains are named after the vm, truncated
+        present = set()
+        for vm in vmsInHost:
+            present.update([vm, iptables_chain_name(vm), ebtables_chain_name(vm)])
+
+        saved = {}
+        for tool in ['iptables', 'ip6tables', 'ebtables']:
+            saved[tool] = read_saved_tables(tool)
+        ipsets = set(filter(None, (execute('ipset list -n') or '').split('\n')))
+        read_time = time.time() - start
+
+        # The names the chains of each stopped vm go by, under the prefix its lock is named after
+        stale = {}
+        for tool in ['iptables', 'ip6tables']:
+            for chain in saved[tool].get('filter', {}):
+                if chain[:2] in ['r-', 'i-', 's-', 'v-'] and not re.search('-(def|eg)', chain) and chain not in present:
+                    names = stale.setdefault(ebtables_chain_name(chain), set())
+                    if chain not in names:
+                        logging.debug("vm " + chain + " is not running or paused, cleaning up " + tool + " rules")
+                        names.add(chain)
+
+        for table in saved['ebtables'].values():
+            for chain in table:
+                vm_name = re.sub('-(in|out|ips).*', '', chain)
+                if vm_name[:2] in ['r-', 'i-', 's-', 'v-'] and vm_name not in present:
+                    names = stale.setdefault(ebtables_chain_name(vm_name), set())
+                    if vm_name not in names:
+                        logging.debug("vm " + vm_name + " is not running or paused, cleaning up ebtables rules")
+                        names.add(vm_name)
+
+        # The chains are named after a prefix of the vm name, the rule logs after the full name
+        for vm_name in load_rule_logs().keys():
+            if vm_name not in present and ebtables_chain_name(vm_name) in stale:
+                stale[ebtables_chain_name(vm_name)].add(vm_name)
+
+        # The vms being programmed are left for the next run
+        locks = []
+        for prefix in list(stale):
+            handle = open_vm_lock(prefix, blocking=False)
+            if handle is None:
+                logging.debug("Rules of vm " + prefix + " are being programmed, not cleaning them up")
+                del stale[prefix]
+            else:
+                locks.append(handle)
+        cleanup = set()
+        for names in stale.values():
+            cleanup.update(names)
 
-        for chain in filter(None, chains):
-            if 1 in [ chain.startswith(c) for c in ['r-', 'i-', 's-', 'v-'] ]:
-                vm_name = chain
-                vmpresent=False
-                for vm in vmsInHost:
-                    if vm_name  in vm:
-                        vmpresent=True
-                        break
+        try:
+            clean_up_vms(cleanup, present, saved, ipsets, start, read_time)
+        finally:
+            for handle in locks:
+                handle.close()
+    except:
+        logging.debug("Failed to cleanup rules !")
 
-                if vmpresent is False:
-                    logging.debug("vm " + vm_name + " is not running or paused, cleaning up ebtables rules")
-                    cleanup.append(vm_name)
 
-        cleanup = list(set(cleanup))  # remove duplicates
-        for vmname in cleanup:
-            destroy_network_rules_for_vm(vmname)
+def clean_up_vms(cleanup, present, saved, ipsets, start, read_time):
+    """
+    Delete the rules, chains and sets of the stopped vms, whose locks are held, from the saved tables.
+    present are the names of the vms still running and of their chains.
+    """
+    if not cleanup:
+        logging.debug("No rules to clean up, read the tables in %.3fs" % read_time)
+        return
 
-        logging.debug("Cleaned up rules for " + str(len(cleanup)) + " chains")
-    except:
-        logging.debug("Failed to cleanup rules !")
+    stale_chains = set()
+    for vm_name in cleanup:
+        if vm_name.startswith('i-'):
+            stale_chains.add('-'.join(vm_name.split('-')[:-1]) + "-def")
+        stale_chains.update([vm_name, egress_chain_name(vm_name)])
+
+    rules = RuleSet(saved)
+    chains = 0
+    vif_chains = {}
+    for tool in ['iptables', 'ip6tables']:
+        filter_table = saved[tool].get('filter', {})
+        for chain, (policy, chain_rules) in filter_table.items():
+            if 'BF' not in chain:
+                continue
+            for rule in chain_rules:
+                vals = rule.split()
+                if '--physdev-is-bridged' not in vals or vals[-2] != '-j':
+                    continue
+                for opt in ['--physdev-in', '--physdev-out']:
+                    if opt in vals:
+                        vif_chains.setdefault(vals[vals.index(opt) + 1], set()).add(vals[-1])
+                if vals[-1] in stale_chains:
+                    rules.rule(tool, '-D' + rule[2:])
+        for chain in stale_chains & set(filter_table):
+            rules.drop(tool, chain)
+            chains += 1
+
+    # The dnat rules of the vifs that only the stopped vms were plugged in
+    stale_vifs = set(vif for vif, targets in vif_chains.items() if targets <= stale_chains)
+    dnats = 0
+    for chain, (policy, chain_rules) in saved['iptables'].get('nat', {}).items():
+        for rule in chain_rules:
+            if stale_vifs & set(rule.split()):
+                rules.rule('iptables', '-D' + rule[2:], table='nat')
+                dnats += 1
+
+    for table, table_chains in saved['ebtables'].items():
+        for vm_name in cleanup:
+            eb_vm_chain = ebtables_chain_name(vm_name)
+            for chain in [eb_vm_chain + "-in", eb_vm_chain + "-out", eb_vm_chain + "-in-ips", eb_vm_chain + "-out-ips"]:
+                if chain in table_chains:
+                    rules.drop('ebtables', chain, table=table)
+                    chains += 1
+
+    restore_start = time.time()
+    if not rules.commit():
+        logging.debug("Ignoring failure to delete the rules of the stopped vms")
+
+    # The sets can only be deleted once no rule references them
+    # The chains only keep a prefix of the name of a vm, the sets of the running vms with the same prefix are kept
+    prefixes = set(iptables_chain_name(vm_name)[:16] for vm_name in cleanup)
+    live = set(ipset_vm_prefix(vm_name) for vm_name in present)
+    stale_sets = []
+    for name in ipsets:
+        group_set = re.match('^(.+)-[0-9a-f]{6}-[0-9a-f]{6}$', name)
+        if name in cleanup or (name.endswith('-6') and name[:-2] in cleanup) or \
+                (group_set and group_set.group(1) in prefixes and name[:-7] not in live):
+            stale_sets.append(name)
+    if stale_sets and not execute_stdin('ipset restore', ''.join('destroy %s\n' % name for name in stale_sets)):
+        logging.debug("Ignoring failure to delete the sets of the stopped vms")
+    restore_time = time.time() - restore_start
+
+    remove_rule_logs(cleanup)
+
+    logging.info("Cleaned up rules for %s vms: %s chains, %s dnat rules and %s sets; read the tables in %.3fs, deleted in %.3fs, %.3fs in total"
+                 % (len(cleanup), chains, dnats, len(stale_sets), read_time, restore_time, time.time() - start))
 
 
 def check_rule_log_for_vm(vmName, vmId, vmIP, domID, signature, seqno):
     vm_name = vmName
-    logfilename = logpath + vm_name + ".log"
-    if not os.path.exists(logfilename):
-        return [True, True, True, True, True, True]
-
     try:
-        lines = (line.rstrip() for line in open(logfilename))
+        fields = read_rule_log(vm_name)
     except:
-        logging.debug("failed to open " + logfilename)
+        logging.debug("failed to open the rule log of " + vm_name)
+        return [True, True, True, True, True, True]
+
+    if fields is None:
         return [True, True, True, True, True, True]
 
-    [_vmName,_vmID,_vmIP,_domID,_signature,_seqno] = ['_', '-1', '_', '-1', '_', '-1']
     try:
-        for line in lines:
-            [_vmName,_vmID,_vmIP,_domID,_signature,_seqno] = line.split(',')
-            break
+        [_vmName,_vmID,_vmIP,_domID,_signature,_seqno] = fields or EMPTY_RULE_LOG
     except:
         logging.debug("Failed to parse log file for vm " + vm_name)
         remove_rule_log_for_vm(vm_name)
@@ -888,37 +1288,39 @@ def check_rule_log_for_vm(vmName, vmId, vmIP, domID, signature, seqno):
     return [(vm_name != _vmName), (vmId != _vmID), (vmIP != _vmIP), (domID != _domID), (signature != _signature),(seqno != _seqno)]
 
 
-def write_rule_log_for_vm(vmName, vmID, vmIP, domID, signature, seqno):
-    vm_name = vmName
-    logfilename = logpath + vm_name + ".log"
-    logging.debug("Writing log to " + logfilename)
-    logf = open(logfilename, 'w')
-    output = ','.join([vmName, vmID, vmIP, str(domID), signature, seqno])
-    result = True
-    try:
-        logf.write(output)
-        logf.write('\n')
-    except:
-        logging.debug("Failed to write to rule log file " + logfilename)
-        result = False
-
-    logf.close()
-
-    return result
+def write_rule_log_for_vm(vmName, vmID, vmIP, domID, signature, seqno, applied=None):
+    """ applied are the rules and sets of the security groups now in place, if known """
+    logging.debug("Writing the rule log of " + vmName + " to " + rule_log_file)
+    with global_lock():
+        entry = load_rule_logs().setdefault(vmName, {})
+        entry.update(zip(RULE_LOG_FIELDS, [vmName, vmID, vmIP, str(domID), signature, seqno]))
+        entry.pop('applied', None)
+        if applied is not None:
+            entry['applied'] = applied
+        return save_rule_logs()
 
 
 def remove_rule_log_for_vm(vmName):
-    vm_name = vmName
-    logfilename = logpath + vm_name + ".log"
+    with global_lock():
+        entry = load_rule_logs().get(vmName)
+        if entry is None or 'seqno' not in entry:
+            return False
 
-    result = True
-    try:
-        os.remove(logfilename)
-    except:
-        logging.debug("Failed to delete rule log file " + logfilename)
-        result = False
+        for field in RULE_LOG_FIELDS + ['applied']:
+            entry.pop(field, None)
+        if not entry:
+            del rule_logs[vmName]
+        return save_rule_logs()
 
-    return result
+
+def remove_rule_logs(vmNames):
+    """ Remove the rule logs and the secondary ips of vms, with one write """
+    with global_lock():
+        logs = load_rule_logs()
+        removed = [vm_name for vm_name in vmNames if logs.pop(vm_name, None) is not None]
+        if not removed:
+            return False
+        return save_rule_logs()
 
 
 #ebtables chain max len 31 char
@@ -983,6 +1385,63 @@ def parse_network_rules(rules):
   return ret
 
 
+def count_network_rules(rules):
+    """ The number of iptables rules and of cidrs the parsed rules make """
+    count = 0
+    cidrs = 0
+    for rule in rules:
+        for family in ['ipv4', 'ipv6']:
+            if rule[family]:
+                count += 1
+                cidrs += len(rule[family])
+    return count, cidrs
+
+
+def optimize_network_rules(rules):
+    """
+    Merge the parsed rules that can be matched by fewer iptables rules: the rules of
+    a direction, protocol and family with the same ports share their cidrs, the cidrs
+    are collapsed with cidr_merge and, for tcp and udp, the contiguous or overlapping
+    port ranges of the rules with the same cidrs are merged. The rules keep the order
+    in which they were first given.
+    """
+    # Identical ports: one rule per family with the union of the cidrs
+    by_ports = OrderedDict()
+    for rule in rules:
+        for family in ['ipv4', 'ipv6']:
+            if not rule[family]:
+                continue
+            key = (rule['ruletype'], rule['protocol'], rule['start'], rule['end'], family)
+            by_ports.setdefault(key, []).extend(rule[family])
+
+    # Identical cidrs: the port ranges are merged
+    by_cidrs = OrderedDict()
+    for (ruletype, protocol, start, end, family), cidrs in by_ports.items():
+        cidrs = tuple(str(cidr) for cidr in cidr_merge(cidrs))
+        if protocol in ['tcp', 'udp']:
+            by_cidrs.setdefault((ruletype, protocol, family, cidrs), []).append((start, end))
+        else:
+            by_cidrs[(ruletype, protocol, family, cidrs, start, end)] = [(start, end)]
+
+    ret = []
+    for key, ranges in by_cidrs.items():
+        ruletype, protocol, family, cidrs = key[:4]
+        merged = []
+        for start, end in sorted(ranges) if protocol in ['tcp', 'udp'] else ranges:
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        for start, end in merged:
+            rule = {'ipv4': [], 'ipv6': [], 'ruletype': ruletype,
+                    'start': start, 'end': end, 'protocol': protocol}
+            rule[family] = list(cidrs)
+            ret.append(rule)
+
+    logging.debug("Optimized %s network rules with %s cidrs to %s rules with %s cidrs" % (count_network_rules(rules) + count_network_rules(ret)))
+    return ret
+
+
 def add_network_rules(vm_name, vm_id, vm_ip, vm_ip6, signature, seqno, vmMac, rules, vif, brname, sec_ips):
   try:
     vmName = vm_name
@@ -994,34 +1453,26 @@ def add_network_rules(vm_name, vm_id, vm_ip, vm_ip6, signature, seqno, vmMac, ru
         logging.debug("Rules already programmed for vm " + vm_name)
         return True
 
-    if changes[0] or changes[1] or changes[2] or changes[3]:
-        default_network_rules(vmName, vm_id, vm_ip, vm_ip6, vmMac, vif, brname, sec_ips)
-
     logging.debug("    programming network rules for IP: " + vm_ip + " vmname=" + vm_name)
 
-    egress_chain_name(vm_name)
     vmchain = iptables_chain_name(vm_name)
     egress_vmchain = egress_chain_name(vm_name)
 
-    try:
-      for chain in [vmchain, egress_vmchain]:
-          execute('iptables -F ' + chain)
-          execute('ip6tables -F ' + chain)
-    except:
-      logging.debug("Error flushing iptables rules for " + vm_name + ". Presuming firewall rules deleted, re-initializing." )
-      default_network_rules(vm_name, vm_id, vm_ip, vm_ip6, vmMac, vif, brname, sec_ips)
-
     egressrule_v4 = 0
     egressrule_v6 = 0
+    # Each rule used to be inserted at the top of its chain, they are appended in reverse order
+    inserted = []
+    # The cidrs of each rule are matched through a hash:net set
+    sets = OrderedDict()
 
-    for rule in parse_network_rules(rules):
+    for rule in optimize_network_rules(parse_network_rules(rules)):
         start = rule['start']
         end = rule['end']
         protocol = rule['protocol']
 
         if rule['ruletype'] == 'E':
-            vmchain = egress_vmchain
-            direction = "-d"
+            chain = egress_vmchain
+            direction = "dst"
             action = "RETURN"
             if rule['ipv4']:
                 egressrule_v4 =+ 1
@@ -1030,9 +1481,9 @@ def add_network_rules(vm_name, vm_id, vm_ip, vm_ip6, signature, seqno, vmMac, ru
                 egressrule_v6 +=1
 
         else:
-            vmchain = vm_name
+            chain = vmchain
             action = "ACCEPT"
-            direction = "-s"
+            direction = "src"
 
         range = str(start) + ':' + str(end)
         if 'icmp' == protocol:
@@ -1040,43 +1491,87 @@ def add_network_rules(vm_name, vm_id, vm_ip, vm_ip6, signature, seqno, vmMac, ru
             if start == -1:
                 range = 'any'
 
-        for ip in rule['ipv4']:
+        for tool, family, cidrs in [('iptables', 'inet', rule['ipv4']), ('ip6tables', 'inet6', rule['ipv6'])]:
+            if not cidrs:
+                continue
+
             if protocol == 'all':
-                execute('iptables -I ' + vmchain + ' -m state --state NEW ' + direction + ' ' + ip + ' -j ' + action)
+                match = ' -m state --state NEW'
             elif protocol != 'icmp':
-                execute('iptables -I ' + vmchain + ' -p ' + protocol + ' -m ' + protocol + ' --dport ' + range + ' -m state --state NEW ' + direction + ' ' + ip + ' -j ' + action)
+                match = ' -p ' + protocol + ' -m ' + protocol + ' --dport ' + range + ' -m state --state NEW'
+            elif tool == 'iptables':
+                match = ' -p icmp --icmp-type ' + range
+            # ip6tables does not allow '--icmpv6-type any', allowing all ICMPv6 is done by not allowing a specific type
+            elif range == 'any':
+                match = ' -p icmpv6'
             else:
-                execute('iptables -I ' + vmchain + ' -p icmp --icmp-type ' + range + ' ' + direction + ' ' + ip + ' -j ' + action)
+                match = ' -p icmpv6 --icmpv6-type ' + range
 
-        for ip in rule['ipv6']:
-            if protocol == 'all':
-                execute('ip6tables -I ' + vmchain + ' -m state --state NEW ' + direction + ' ' + ip + ' -j ' + action)
-            elif 'icmp' != protocol:
-                execute('ip6tables -I ' + vmchain + ' -p ' + protocol + ' -m ' + protocol + ' --dport ' + range + ' -m state --state NEW ' + direction + ' ' + ip + ' -j ' + action)
-            else:
-                # ip6tables does not allow '--icmpv6-type any', allowing all ICMPv6 is done by not allowing a specific type
-                if range == 'any':
-                    execute('ip6tables -I ' + vmchain + ' -p icmpv6 ' + direction + ' ' + ip + ' -j ' + action)
-                else:
-                    execute('ip6tables -I ' + vmchain + ' -p icmpv6 --icmpv6-type ' + range + ' ' + direction + ' ' + ip + ' -j ' + action)
+            # A set cannot hold a /0 network, which matches every address anyway
+            if not [cidr for cidr in cidrs if IPNetwork(cidr).prefixlen == 0]:
+                setname = ipset_group_name(vm_name, (rule['ruletype'], protocol, range, family))
+                if setname in sets:
+                    sets[setname][1].extend(cidrs)
+                    continue
+                sets[setname] = [family, list(cidrs)]
+                match += ' -m set --match-set ' + setname + ' ' + direction
+
+            inserted.append((tool, '-A ' + chain + match + ' -j ' + action))
+
+    applied = {'iptables': [], 'ip6tables': [], 'sets': sets}
+    for tool, rule in reversed(inserted):
+        applied[tool].append(rule)
 
-    egress_vmchain = egress_chain_name(vm_name)
     if egressrule_v4 == 0 :
-        execute('iptables -A ' + egress_vmchain + ' -j RETURN')
+        applied['iptables'].append('-A ' + egress_vmchain + ' -j RETURN')
     else:
-        execute('iptables -A ' + egress_vmchain + ' -j DROP')
+        applied['iptables'].append('-A ' + egress_vmchain + ' -j DROP')
 
     if egressrule_v6 == 0 :
-        execute('ip6tables -A ' + egress_vmchain + ' -j RETURN')
+        applied['ip6tables'].append('-A ' + egress_vmchain + ' -j RETURN')
     else:
-        execute('ip6tables -A ' + egress_vmchain + ' -j DROP')
+        applied['ip6tables'].append('-A ' + egress_vmchain + ' -j DROP')
+
+    applied['iptables'].append('-A ' + vmchain + ' -j DROP')
+    applied['ip6tables'].append('-A ' + vmchain + ' -j DROP')
+
+    # Only the security group rules changed, the difference with the rules in place is applied
+    previous = load_rule_logs().get(vmName, {}).get('applied')
+    if not (changes[0] or changes[1] or changes[2] or changes[3]) and previous is not None:
+        if chains_in_sync(vm_name, previous):
+            if update_network_rules(vm_name, previous, applied):
+                return write_rule_log_for_vm(vmName, vm_id, vm_ip, domId, signature, seqno, applied)
+            logging.debug("Failed to update the network rules of vm " + vm_name + ", programming them again")
+        else:
+            logging.debug("The chains of vm " + vm_name + " are not as last programmed, programming them again")
 
-    vmchain = iptables_chain_name(vm_name)
+    # The default rules, if needed, and the security group rules are applied in one transaction
+    ruleset = RuleSet()
+    if changes[0] or changes[1] or changes[2] or changes[3]:
+        if not default_network_rules(vmName, vm_id, vm_ip, vm_ip6, vmMac, vif, brname, sec_ips, ruleset):
+            logging.debug("Failed to program the default network rules for vm " + vm_name)
+            return False
+
+    for chain in [vmchain, egress_vmchain]:
+        ruleset.chain('iptables', chain)
+        ruleset.chain('ip6tables', chain)
+
+    for tool in ['iptables', 'ip6tables']:
+        for rule in applied[tool]:
+            ruleset.rule(tool, rule)
+
+    # The sets must exist before the rules referencing them are applied
+    if not restore_ipsets(sets):
+        logging.debug("Failed to program the ipsets of the network rules for vm " + vm_name)
+        return False
 
-    execute('iptables -A ' + vmchain + ' -j DROP')
-    execute('ip6tables -A ' + vmchain + ' -j DROP')
+    if not ruleset.commit():
+        logging.debug("Failed to program network rules for vm " + vm_name)
+        return False
+
+    destroy_ipsets(vm_name, keep=sets.keys())
 
-    if not write_rule_log_for_vm(vmName, vm_id, vm_ip, domId, signature, seqno):
+    if not write_rule_log_for_vm(vmName, vm_id, vm_ip, domId, signature, seqno, applied):
         return False
 
     return True
@@ -1084,160 +1579,180 @@ def add_network_rules(vm_name, vm_id, vm_ip, vm_ip6, signature, seqno, vmMac, ru
     logging.exception("Failed to network rule !")
 
 
-def getVifs(vmName):
-    vifs = []
-    xmlfile = virshdumpxml(vmName)
-    if not xmlfile:
-        return vifs
+def chains_in_sync(vm_name, applied):
+    """
+    Whether the chains of a vm still hold the rules last applied to them. iptables-save
+    does not print the rules as they were given, their number and sets are compared.
+    """
+    for tool in ['iptables', 'ip6tables']:
+        saved = read_saved_tables(tool).get('filter', {})
+        for chain in [iptables_chain_name(vm_name), egress_chain_name(vm_name)]:
+            if chain not in saved:
+                return False
+            current = saved[chain][1]
+            expected = [rule for rule in applied[tool] if rule.split()[1] == chain]
+            if len(current) != len(expected):
+                return False
+            if sorted(re.findall(r'--match-set (\S+)', ' '.join(current))) != sorted(re.findall(r'--match-set (\S+)', ' '.join(expected))):
+                return False
+    return True
 
-    dom = xml.dom.minidom.parseString(xmlfile)
-    for network in dom.getElementsByTagName("interface"):
-        target = network.getElementsByTagName('target')[0]
-        nicdev = target.getAttribute("dev").strip()
-        vifs.append(nicdev)
-    return vifs
 
+def update_network_rules(vm_name, previous, applied):
+    """ Apply the difference between the rules last applied to a vm and its new rules """
+    changed = OrderedDict((name, members) for name, members in applied['sets'].items()
+                          if previous['sets'].get(name) != members)
+    if not restore_ipsets(changed):
+        return False
 
-def getVifsForBridge(vmName, brname):
-    vifs = []
-    xmlfile = virshdumpxml(vmName)
-    if not xmlfile:
-        return vifs
-
-    dom = xml.dom.minidom.parseString(xmlfile)
-    for network in dom.getElementsByTagName("interface"):
-        source = network.getElementsByTagName('source')[0]
-        bridge = source.getAttribute("bridge").strip()
-        if bridge == brname:
-            target = network.getElementsByTagName('target')[0]
-            nicdev = target.getAttribute("dev").strip()
-            vifs.append(nicdev)
-    return list(set(vifs))
+    ruleset = RuleSet()
+    count = 0
+    for tool in ['iptables', 'ip6tables']:
+        old = set(previous[tool])
+        new = set(applied[tool])
+        for rule in previous[tool]:
+            if rule not in new:
+                ruleset.rule(tool, '-D' + rule[2:])
+                count += 1
+        for rule in applied[tool]:
+            if rule in old:
+                continue
+            vals = rule.split()
+            if len(vals) == 4:
+                # The last rule of the chain, whose action is the default one
+                ruleset.rule(tool, rule)
+            else:
+                ruleset.rule(tool, ' '.join(['-I', vals[1], '1'] + vals[2:]))
+            count += 1
+
+    if count and not ruleset.commit():
+        return False
 
+    for name in set(previous['sets']) - set(applied['sets']):
+        execute('ipset destroy ' + name)
 
-def getBridges(vmName):
-    bridges = []
-    xmlfile = virshdumpxml(vmName)
-    if not xmlfile:
-        return bridges
+    logging.debug("Updated the network rules of vm %s: %s rules and %s sets changed" % (vm_name, count, len(changed)))
+    return True
 
-    dom = xml.dom.minidom.parseString(xmlfile)
-    for network in dom.getElementsByTagName("interface"):
-        for source in network.getElementsByTagName('source'):
-            bridge = source.getAttribute("bridge").strip()
-            bridges.append(bridge)
-    return list(set(bridges))
 
+def getVifs(vmName):
+    return [nic['vif'] for nic in domain_nics(vmName) if nic['vif'] is not None]
 
-def getvmId(vmName):
 
-    conn = libvirt.openReadOnly(driver)
-    if not conn:
-       print('Failed to open connection to the hypervisor')
-       sys.exit(3)
+def getVifsForBridge(vmName, brname):
+    return list(set(nic['vif'] for nic in domain_nics(vmName) if nic['bridge'] == brname and nic['vif'] is not None))
 
-    try:
-        dom = (conn.lookupByName (vmName))
-    except libvirt.libvirtError:
+
+def getBridges(vmName):
+    return list(set(nic['bridge'] for nic in domain_nics(vmName) if nic['bridge'] is not None))
+
+
+def getvmId(vmName):
+    domain = lookup_domain(vmName)
+    if domain is None:
         return None
+    return domain['id']
 
-    conn.close()
 
-    res = dom.ID()
-    if isinstance(res, int):
-        res = str(res)
-    return res
+def bridge_firewall_chains():
+    """ The bridge firewall chain of each bridge, as jumped to from FORWARD, read once per command """
+    brfw_cache = getattr(command_cache, 'brfw', None)
+    if brfw_cache is None:
+        brfw_cache = command_cache.brfw = OrderedDict()
+        forward = read_saved_tables('iptables').get('filter', {}).get('FORWARD', ('-', []))[1]
+        for rule in forward:
+            vals = rule.split()
+            if len(vals) > 4 and vals[2] == '-o' and '--physdev-is-bridged' in vals and vals[-2] == '-j' and 'BF' in vals[-1]:
+                brfw_cache.setdefault(vals[3], vals[-1])
+    return brfw_cache
 
 
 def getBrfw(brname):
-    cmd = "iptables-save |grep physdev-is-bridged |grep FORWARD |grep BF |grep '\-o' | grep -w " + brname  + "|awk '{print $9}' | head -1"
-    brfwname = bash("-c", cmd).stdout.strip()
-    if brfwname == "":
-        brfwname = "BF-" + brname
-    return brfwname
+    return bridge_firewall_chains().get(brname, "BF-" + brname)
 
 
 def addFWFramework(brname):
-    try:
-        execute("sysctl -w net.bridge.bridge-nf-call-arptables=1")
-        execute("sysctl -w net.bridge.bridge-nf-call-iptables=1")
-        execute("sysctl -w net.bridge.bridge-nf-call-ip6tables=1")
-    except:
-        logging.warn("failed to turn on bridge netfilter")
-
-    brfw = getBrfw(brname)
-    try:
-        execute("iptables -L " + brfw)
-    except:
-        execute("iptables -N " + brfw)
+    # The bridge firewall chains and the FORWARD rules are shared by the vms of the bridge
+    with global_lock():
+        try:
+            execute("sysctl -w net.bridge.bridge-nf-call-arptables=1")
+            execute("sysctl -w net.bridge.bridge-nf-call-iptables=1")
+            execute("sysctl -w net.bridge.bridge-nf-call-ip6tables=1")
+        except:
+            logging.warn("failed to turn on bridge netfilter")
 
-    brfwout = brfw + "-OUT"
-    try:
-        execute("iptables -L " + brfwout)
-    except:
-        execute("iptables -N " + brfwout)
+        brfw = getBrfw(brname)
+        try:
+            execute("iptables -L " + brfw)
+        except:
+            execute("iptables -N " + brfw)
 
-    brfwin = brfw + "-IN"
-    try:
-        execute("iptables -L " + brfwin)
-    except:
-        execute("iptables -N " + brfwin)
+        brfwout = brfw + "-OUT"
+        try:
+            execute("iptables -L " + brfwout)
+        except:
+            execute("iptables -N " + brfwout)
 
-    try:
-        execute('ip6tables -L ' + brfw)
-    except:
-        execute('ip6tables -N ' + brfw)
+        brfwin = brfw + "-IN"
+        try:
+            execute("iptables -L " + brfwin)
+        except:
+            execute("iptables -N " + brfwin)
 
-    brfwout = brfw + "-OUT"
-    try:
-        execute('ip6tables -L ' + brfwout)
-    except:
-        execute('ip6tables -N ' + brfwout)
+        try:
+            execute('ip6tables -L ' + brfw)
+        except:
+            execute('ip6tables -N ' + brfw)
 
-    brfwin = brfw + "-IN"
-    try:
-        execute('ip6tables -L ' + brfwin)
-    except:
-        execute('ip6tables -N ' + brfwin)
+        brfwout = brfw + "-OUT"
+        try:
+            execute('ip6tables -L ' + brfwout)
+        except:
+            execute('ip6tables -N ' + brfwout)
 
-    try:
-        refs = int(execute("""iptables -n -L %s | awk '/%s(.*)references/ {gsub(/\(/, "") ;print $3}'""" % (brfw,brfw)).strip())
-        refs6 = int(execute("""ip6tables -n -L %s | awk '/%s(.*)references/ {gsub(/\(/, "") ;print $3}'""" % (brfw,brfw)).strip())
-
-        if refs == 0:
-            execute("iptables -I FORWARD -i " + brname + " -j DROP")
-            execute("iptables -I FORWARD -o " + brname + " -j DROP")
-            execute("iptables -I FORWARD -i " + brname + " -m physdev --physdev-is-bridged -j " + brfw)
-            execute("iptables -I FORWARD -o " + brname + " -m physdev --physdev-is-bridged -j " + brfw)
-            phydev = execute("brctl show | awk '/^%s[ \t]/ {print $4}'" % brname ).strip()
-            execute("iptables -A " + brfw + " -m state --state RELATED,ESTABLISHED -j ACCEPT")
-            execute("iptables -A " + brfw + " -m physdev --physdev-is-bridged --physdev-is-in -j " + brfwin)
-            execute("iptables -A " + brfw + " -m physdev --physdev-is-bridged --physdev-is-out -j " + brfwout)
-            execute("iptables -A " + brfw + " -m physdev --physdev-is-bridged --physdev-out " + phydev + " -j ACCEPT")
-
-        if refs6 == 0:
-            execute('ip6tables -I FORWARD -i ' + brname + ' -j DROP')
-            execute('ip6tables -I FORWARD -o ' + brname + ' -j DROP')
-            execute('ip6tables -I FORWARD -i ' + brname + ' -m physdev --physdev-is-bridged -j ' + brfw)
-            execute('ip6tables -I FORWARD -o ' + brname + ' -m physdev --physdev-is-bridged -j ' + brfw)
-            phydev = execute("brctl show | awk '/^%s[ \t]/ {print $4}'" % brname ).strip()
-            execute('ip6tables -A ' + brfw + ' -m state --state RELATED,ESTABLISHED -j ACCEPT')
-            execute('ip6tables -A ' + brfw + ' -m physdev --physdev-is-bridged --physdev-is-in -j ' + brfwin)
-            execute('ip6tables -A ' + brfw + ' -m physdev --physdev-is-bridged --physdev-is-out -j ' + brfwout)
-            execute('ip6tables -A ' + brfw + ' -m physdev --physdev-is-bridged --physdev-out ' + phydev + ' -j ACCEPT')
+        brfwin = brfw + "-IN"
+        try:
+            execute('ip6tables -L ' + brfwin)
+        except:
+            execute('ip6tables -N ' + brfwin)
 
-        return True
-    except:
         try:
-            execute("iptables -F " + brfw)
-            execute('ip6tables -F ' + brfw)
+            refs = int(execute("""iptables -n -L %s | awk '/%s(.*)references/ {gsub(/\(/, "") ;print $3}'""" % (brfw,brfw)).strip())
+            refs6 = int(execute("""ip6tables -n -L %s | awk '/%s(.*)references/ {gsub(/\(/, "") ;print $3}'""" % (brfw,brfw)).strip())
+
+            if refs == 0:
+                execute("iptables -I FORWARD -i " + brname + " -j DROP")
+                execute("iptables -I FORWARD -o " + brname + " -j DROP")
+                execute("iptables -I FORWARD -i " + brname + " -m physdev --physdev-is-bridged -j " + brfw)
+                execute("iptables -I FORWARD -o " + brname + " -m physdev --physdev-is-bridged -j " + brfw)
+                phydev = execute("brctl show | awk '/^%s[ \t]/ {print $4}'" % brname ).strip()
+                execute("iptables -A " + brfw + " -m state --state RELATED,ESTABLISHED -j ACCEPT")
+                execute("iptables -A " + brfw + " -m physdev --physdev-is-bridged --physdev-is-in -j " + brfwin)
+                execute("iptables -A " + brfw + " -m physdev --physdev-is-bridged --physdev-is-out -j " + brfwout)
+                execute("iptables -A " + brfw + " -m physdev --physdev-is-bridged --physdev-out " + phydev + " -j ACCEPT")
+
+            if refs6 == 0:
+                execute('ip6tables -I FORWARD -i ' + brname + ' -j DROP')
+                execute('ip6tables -I FORWARD -o ' + brname + ' -j DROP')
+                execute('ip6tables -I FORWARD -i ' + brname + ' -m physdev --physdev-is-bridged -j ' + brfw)
+                execute('ip6tables -I FORWARD -o ' + brname + ' -m physdev --physdev-is-bridged -j ' + brfw)
+                phydev = execute("brctl show | awk '/^%s[ \t]/ {print $4}'" % brname ).strip()
+                execute('ip6tables -A ' + brfw + ' -m state --state RELATED,ESTABLISHED -j ACCEPT')
+                execute('ip6tables -A ' + brfw + ' -m physdev --physdev-is-bridged --physdev-is-in -j ' + brfwin)
+                execute('ip6tables -A ' + brfw + ' -m physdev --physdev-is-bridged --physdev-is-out -j ' + brfwout)
+                execute('ip6tables -A ' + brfw + ' -m physdev --physdev-is-bridged --physdev-out ' + phydev + ' -j ACCEPT')
+
+            return True
         except:
+            try:
+                execute("iptables -F " + brfw)
+                execute('ip6tables -F ' + brfw)
+            except:
+                return False
             return False
-        return False
 
 
-if __name__ == '__main__':
-    logging.basicConfig(filename="/var/log/cloudstack/agent/security_group.log", format="%(asctime)s - %(message)s", level=logging.DEBUG)
+def get_parser():
     parser = OptionParser()
     parser.add_option("--vmname", dest="vmName")
     parser.add_option("--vmip", dest="vmIP")
@@ -1255,38 +1770,296 @@ if __name__ == '__main__':
     parser.add_option("--hostMacAddr", dest="hostMacAddr")
     parser.add_option("--nicsecips", dest="nicSecIps")
     parser.add_option("--action", dest="action")
-    (option, args) = parser.parse_args()
-    if len(args) == 0:
-        logging.debug("No command to execute")
-        sys.exit(1)
+    parser.add_option("--file", dest="file")
+    parser.add_option("--workers", dest="workers", type="int", default=8)
+    return parser
+
+
+# The commands changing only the rules of the vm given with --vmname
+VM_COMMANDS = ['default_network_rules', 'destroy_network_rules_for_vm', 'default_network_rules_systemvm',
+               'add_network_rules', 'network_rules_vmSecondaryIp', 'post_default_network_rules']
+
+
+def run_command(option, args):
+    """
+    Run a command under the lock of its vm, or under the global lock for the ones
+    changing the rules of every vm, and return its result
+    """
     cmd = args[0]
-    logging.debug("Executing command: " + str(cmd))
+    if cmd in VM_COMMANDS and option.vmName:
+        with vm_lock(option.vmName):
+            return dispatch_command(option, args)
+    if cmd in ['can_bridge_firewall', 'cleanup_rules']:
+        with global_lock():
+            return dispatch_command(option, args)
+    return dispatch_command(option, args)
 
-    for i in range(0, 30):
-        if obtain_file_lock(lock_file) is False:
-            logging.warning("Lock on %s is being held by other process. Waiting for release." % lock_file)
-            time.sleep(0.5)
-        else:
-            break
 
+def dispatch_command(option, args):
+    cmd = args[0]
     if cmd == "can_bridge_firewall":
-        can_bridge_firewall(args[1])
+        return can_bridge_firewall(args[1])
     elif cmd == "default_network_rules":
-        default_network_rules(option.vmName, option.vmID, option.vmIP, option.vmIP6, option.vmMAC, option.vif, option.brname, option.nicSecIps)
+        return default_network_rules(option.vmName, option.vmID, option.vmIP, option.vmIP6, option.vmMAC, option.vif, option.brname, option.nicSecIps)
     elif cmd == "destroy_network_rules_for_vm":
-        destroy_network_rules_for_vm(option.vmName, option.vif)
+        return destroy_network_rules_for_vm(option.vmName, option.vif)
     elif cmd == "default_network_rules_systemvm":
-        default_network_rules_systemvm(option.vmName, option.localbrname)
+        return default_network_rules_systemvm(option.vmName, option.localbrname)
     elif cmd == "get_rule_logs_for_vms":
-        get_rule_logs_for_vms()
+        return get_rule_logs_for_vms()
     elif cmd == "add_network_rules":
-        add_network_rules(option.vmName, option.vmID, option.vmIP, option.vmIP6, option.sig, option.seq, option.vmMAC, option.rules, option.vif, option.brname, option.nicSecIps)
+        return add_network_rules(option.vmName, option.vmID, option.vmIP, option.vmIP6, option.sig, option.seq, option.vmMAC, option.rules, option.vif, option.brname, option.nicSecIps)
     elif cmd == "network_rules_vmSecondaryIp":
-        network_rules_vmSecondaryIp(option.vmName, option.nicSecIps, option.action)
+        return network_rules_vmSecondaryIp(option.vmName, option.nicSecIps, option.action)
     elif cmd == "cleanup_rules":
-        cleanup_rules()
+        return cleanup_rules()
     elif cmd == "post_default_network_rules":
-        post_default_network_rules(option.vmName, option.vmID, option.vmIP, option.vmMAC, option.vif, option.brname, option.dhcpSvr, option.hostIp, option.hostMacAddr)
+        return post_default_network_rules(option.vmName, option.vmID, option.vmIP, option.vmMAC, option.vif, option.brname, option.dhcpSvr, option.hostIp, option.hostMacAddr)
+    elif cmd == "bulk":
+        return run_bulk(option.file, option.workers)
     else:
         logging.debug("Unknown command: " + cmd)
         sys.exit(1)
+
+
+def run_status(option, args, strict=False):
+    """
+    Run a command, returns its exit status: the one it exits with, 1 if it raises and 0
+    otherwise, as the agent expects of a single command. With strict, as in bulk, a
+    command returning False fails as well.
+    """
+    try:
+        return 1 if run_command(option, args) is False and strict else 0
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else 1
+    except:
+        logging.exception("Failed to execute " + str(args[0]))
+        return 1
+
+
+def run_bulk_group(requests):
+    return [(option.vmName, args[0], run_status(option, args, strict=True)) for option, args in requests]
+
+
+def run_bulk(path, workers):
+    """
+    Run the commands of a file holding one json list of arguments per line, for
+    instance when the host starts or the agent reconnects. The commands of a vm run
+    in their order, the vms are programmed in parallel by a pool of workers.
+    """
+    start = time.time()
+    groups = OrderedDict()
+    for line in open(path):
+        if not line.strip():
+            continue
+        (option, args) = get_parser().parse_args([str(arg) for arg in json.loads(line)])
+        if not args or args[0] == "bulk":
+            continue
+        groups.setdefault(option.vmName, []).append((option, args))
+
+    pool = ThreadPool(max(1, workers))
+    try:
+        results = sum(pool.map(run_bulk_group, groups.values()), [])
+    finally:
+        pool.close()
+        pool.join()
+
+    failed = [(vm_name, cmd) for vm_name, cmd, status in results if status != 0]
+    for vm_name, cmd in failed:
+        print("%s failed for vm %s" % (cmd, vm_name))
+    logging.info("Ran %s commands for %s vms with %s workers in %.3fs, %s failed" % (len(results), len(groups), workers, time.time() - start, len(failed)))
+    if failed:
+        sys.exit(1)
+    return True
+
+
+class RequestOutput(object):
+    """ The stdout of the daemon, what is printed for a request goes to the buffer of its thread """
+
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.local = threading.local()
+
+    def write(self, data):
+        getattr(self.local, 'buffer', self.stdout).write(data)
+
+    def flush(self):
+        self.stdout.flush()
+
+
+def run_request(option, args):
+    """ Run a command for a client of the daemon, returns its exit status and output """
+    reset_command_cache()
+    output = StringIO()
+    sys.stdout.local.buffer = output
+    try:
+        logging.debug("Executing command: " + str(args[0]))
+        status = run_status(option, args)
+    finally:
+        del sys.stdout.local.buffer
+    return status, output.getvalue()
+
+
+class RequestQueues(object):
+    """
+    Run the requests of the daemon in a pool of workers, the requests of a vm one
+    after the other and in the order they came, as do the host wide ones. The rules
+    of a vm that are still waiting when newer ones come are not applied.
+    """
+
+    def __init__(self, workers):
+        self.pool = ThreadPool(max(1, workers))
+        self.lock = threading.Lock()
+        self.queues = {}
+
+    def submit(self, conn, option, args):
+        key = option.vmName if args[0] in VM_COMMANDS else None
+        with self.lock:
+            if key in self.queues:
+                if not self.supersede(self.queues[key], conn, option, args):
+                    self.queues[key].append((conn, option, args))
+                return
+            self.queues[key] = deque([(conn, option, args)])
+        self.pool.apply_async(self.drain, (key,))
+
+    @staticmethod
+    def supersede(queue, conn, option, args):
+        """
+        Of two add_network_rules waiting one after the other for a vm, only the one with
+        the highest seqno is applied. Returns True if the new request is superseded.
+        """
+        if not queue or args[0] != 'add_network_rules' or not (option.seq or '').isdigit():
+            return False
+        queued_conn, queued_option, queued_args = queue[-1]
+        if queued_args[0] != 'add_network_rules' or not (queued_option.seq or '').isdigit():
+            return False
+        if int(queued_option.seq) > int(option.seq):
+            logging.debug("Rules with seqno %s for vm %s superseded by seqno %s" % (option.seq, option.vmName, queued_option.seq))
+            send_response(conn, 0, '')
+            return True
+        logging.debug("Rules with seqno %s for vm %s superseded by seqno %s" % (queued_option.seq, option.vmName, option.seq))
+        send_response(queued_conn, 0, '')
+        queue.pop()
+        return False
+
+    def drain(self, key):
+        while True:
+            with self.lock:
+                if not self.queues[key]:
+                    del self.queues[key]
+                    return
+                conn, option, args = self.queues[key].popleft()
+            status, output = run_request(option, args)
+            send_response(conn, status, output)
+
+
+def read_request(conn):
+    """ Read the request of a client until it half-closes, returns its options and arguments """
+    conn.settimeout(request_timeout)
+    data = ''
+    try:
+        while True:
+            chunk = conn.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+        argv = [str(arg) for arg in json.loads(data)]
+        (option, args) = get_parser().parse_args(argv)
+    except (socket.error, ValueError, TypeError, SystemExit):
+        return None, []
+    conn.settimeout(None)
+    return option, args
+
+
+def serve_connection(queues, conn):
+    option, args = read_request(conn)
+    if not args:
+        send_response(conn, 1, '')
+        return
+    queues.submit(conn, option, args)
+
+
+def send_response(conn, status, output):
+    try:
+        conn.sendall(json.dumps({'status': status, 'output': output}))
+    except socket.error:
+        logging.debug("Client went away before its response was sent")
+    conn.close()
+
+
+def run_daemon(workers):
+    """
+    Serve the commands of the agent over a unix socket, with one libvirt connection
+    and the rule logs kept in memory. The requests of different vms run in parallel,
+    see RequestQueues.
+    """
+    global libvirt_conn
+    libvirt_conn = open_libvirt()
+    sys.stdout = RequestOutput(sys.stdout)
+    queues = RequestQueues(workers)
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    os.chmod(socket_path, 0o600)
+    server.listen(128)
+    logging.info("Security group daemon listening on " + socket_path)
+
+    while True:
+        conn = server.accept()[0]
+        reader = threading.Thread(target=serve_connection, args=(queues, conn))
+        reader.daemon = True
+        reader.start()
+
+
+def forward_to_daemon(argv):
+    """
+    Run the command in the daemon if one is running, returns its exit status or None.
+    Once the command is sent it is not run again locally, the daemon may have applied it.
+    """
+    if not os.path.exists(socket_path):
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(client_timeout)
+    try:
+        try:
+            client.connect(socket_path)
+        except socket.error:
+            logging.debug("No security group daemon on " + socket_path + ", running the command locally")
+            return None
+        try:
+            client.sendall(json.dumps(argv))
+            client.shutdown(socket.SHUT_WR)
+            data = ''
+            while True:
+                chunk = client.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+            response = json.loads(data)
+        except (socket.error, ValueError):
+            logging.exception("No response of the security group daemon to " + str(argv[:1]))
+            return 1
+    finally:
+        client.close()
+    sys.stdout.write(response['output'])
+    return response['status']
+
+
+if __name__ == '__main__':
+    logging.basicConfig(filename="/var/log/cloudstack/agent/security_group.log", format="%(asctime)s - %(message)s", level=logging.DEBUG)
+    (option, args) = get_parser().parse_args()
+    if len(args) == 0:
+        logging.debug("No command to execute")
+        sys.exit(1)
+    cmd = args[0]
+
+    if cmd == "daemon":
+        run_daemon(option.workers)
+
+    status = forward_to_daemon(sys.argv[1:])
+    if status is not None:
+        sys.exit(status)
+
+    logging.debug("Executing command: " + str(cmd))
+    sys.exit(run_status(option, args))
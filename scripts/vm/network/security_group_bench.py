@@ -0,0 +1,1076 @@
+#!/usr/bin/python
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+"""
+Benchmark of security_group.py without a hypervisor
+
+The iptables, ip6tables, ebtables, ipset, brctl and sysctl commands run by
+security_group.py are replaced by stand-ins: launchers put first in the PATH
+that run this script. They keep the tables and the sets in a state file,
+fail as the real tools do for what security_group.py relies on (missing or
+referenced chains and sets, rules that do not exist, names too long) and
+record every invocation. libvirt is replaced by a module listing the domains
+of the benchmark.
+
+A workload starts vms with their security group rules, sends the same rules
+again, changes them, reboots some vms, stops some and cleans up after the
+ones that went away. Each phase reports the commands security_group.py ran,
+the processes of each tool and the time it took. The final ruleset is
+written in a canonical form, to check that two versions or two modes of
+security_group.py program the same rules:
+
+    ./security_group_bench.py --vms 100 --rules 50 --cidrs 20 --dump cli.txt
+    ./security_group_bench.py --vms 100 --rules 50 --cidrs 20 --mode daemon --compare cli.txt
+"""
+
+import difflib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import types
+from binascii import hexlify, unhexlify
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from optparse import OptionParser
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# Where the stand-ins find the state and record their invocations
+STATE_ENV = "SG_BENCH_STATE"
+RECORD_ENV = "SG_BENCH_RECORD"
+# The bridges printed by brctl, as bridge=interface,...
+BRIDGES_ENV = "SG_BENCH_BRIDGES"
+
+TOOLS = ['iptables', 'ip6tables', 'ebtables', 'iptables-save', 'ip6tables-save', 'ebtables-save',
+         'iptables-restore', 'ip6tables-restore', 'ebtables-restore', 'ipset', 'brctl', 'sysctl']
+
+BUILTIN_CHAINS = {
+    'iptables': OrderedDict([('filter', ['INPUT', 'FORWARD', 'OUTPUT']),
+                             ('nat', ['PREROUTING', 'INPUT', 'OUTPUT', 'POSTROUTING']),
+                             ('mangle', ['PREROUTING', 'INPUT', 'FORWARD', 'OUTPUT', 'POSTROUTING']),
+                             ('raw', ['PREROUTING', 'OUTPUT'])]),
+    'ebtables': OrderedDict([('filter', ['INPUT', 'FORWARD', 'OUTPUT']),
+                             ('nat', ['PREROUTING', 'OUTPUT', 'POSTROUTING']),
+                             ('broute', ['BROUTING'])]),
+}
+BUILTIN_CHAINS['ip6tables'] = BUILTIN_CHAINS['iptables']
+TARGETS = set(['ACCEPT', 'DROP', 'RETURN', 'REJECT', 'LOG', 'DNAT', 'SNAT', 'MASQUERADE', 'REDIRECT',
+               'MARK', 'CONNMARK', 'NOTRACK', 'CT', 'CHECKSUM', 'TCPMSS', 'CONTINUE',
+               'dnat', 'snat', 'redirect', 'mark', 'arpreply'])
+MAX_CHAIN_NAME = {'iptables': 28, 'ip6tables': 28, 'ebtables': 31}
+MAX_SET_NAME = 31
+# iptables-save prints the options by their short name
+ALIASES = {'--source': '-s', '--src': '-s', '--destination': '-d', '--dst': '-d', '--protocol': '-p',
+           '--jump': '-j', '--in-interface': '-i', '--out-interface': '-o', '--set': '--match-set'}
+IPSET_COMMANDS = {'-N': 'create', '-F': 'flush', '-X': 'destroy', '-A': 'add', '-D': 'del',
+                  '-L': 'list', '-W': 'swap', '-S': 'save', '-R': 'restore'}
+IPSET_TYPES = {'iphash': 'hash:ip', 'nethash': 'hash:net'}
+
+
+class ToolError(Exception):
+    def __init__(self, message, status=1):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class Netfilter(object):
+    """
+    The tables of iptables, ip6tables and ebtables and the sets of ipset. A table is
+    {chain: [policy, rules]}, the rules without "-A chain"; a set is {'type', 'family', 'members'}.
+    """
+
+    def __init__(self, state=None):
+        if state is None:
+            state = {'ipset': OrderedDict()}
+            for tool in ['iptables', 'ip6tables', 'ebtables']:
+                state[tool] = OrderedDict((table, OrderedDict((chain, ['ACCEPT', []]) for chain in chains))
+                                          for table, chains in BUILTIN_CHAINS[tool].items())
+        self.state = state
+        self.changed = False
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as fh:
+            return cls(pickle.load(fh))
+
+    def save(self, path):
+        with open(path + '.tmp', 'wb') as fh:
+            pickle.dump(self.state, fh, pickle.HIGHEST_PROTOCOL)
+        os.rename(path + '.tmp', path)
+
+    def table(self, tool, table):
+        if table not in self.state[tool]:
+            raise ToolError("can't initialize %s table `%s': Table does not exist" % (tool, table), 3)
+        return self.state[tool][table]
+
+    @staticmethod
+    def chain(chains, name):
+        if name not in chains:
+            raise ToolError("No chain/target/match by that name.")
+        return chains[name]
+
+    @staticmethod
+    def canonical(tool, spec):
+        vals = spec.split()
+        if tool != 'ebtables':
+            vals = [ALIASES.get(val, val) for val in vals]
+        return ' '.join(vals)
+
+    @staticmethod
+    def references(chains, name):
+        count = 0
+        for policy, rules in chains.values():
+            for rule in rules:
+                vals = rule.split()
+                if '-j' in vals[:-1] and vals[vals.index('-j') + 1] == name:
+                    count += 1
+        return count
+
+    def set_in_use(self, name):
+        for tool in ['iptables', 'ip6tables']:
+            for chains in self.state[tool].values():
+                for policy, rules in chains.values():
+                    for rule in rules:
+                        if (' --match-set %s ' % name) in (' %s ' % rule):
+                            return True
+        return False
+
+    def check_rule(self, tool, chains, spec):
+        vals = spec.split()
+        if '-j' in vals[:-1]:
+            target = vals[vals.index('-j') + 1]
+            if target not in TARGETS and target not in chains:
+                raise ToolError("Couldn't load target `%s':No such file or directory" % target, 2)
+        if tool == 'ebtables':
+            return
+        family = 'inet' if tool == 'iptables' else 'inet6'
+        for i, val in enumerate(vals[:-1]):
+            if val != '--match-set':
+                continue
+            ipset = self.state['ipset'].get(vals[i + 1])
+            if ipset is None:
+                raise ToolError("Set %s doesn't exist." % vals[i + 1], 2)
+            if ipset['family'] != family:
+                raise ToolError("The protocol family of set %s is %s, which is not applicable." % (vals[i + 1], ipset['family']), 2)
+
+    def apply(self, tool, table, chains, cmd, chain, args):
+        """ One command of iptables, ip6tables or ebtables on the chains of a table, returns its output """
+        builtin = BUILTIN_CHAINS[tool][table]
+        if cmd == '-L':
+            return self.list_chains(tool, table, chains, chain)
+        if cmd == '-S':
+            return self.list_rules(chains, chain)
+        if cmd == '-N':
+            if chain in chains:
+                raise ToolError("Chain already exists.")
+            if len(chain) > MAX_CHAIN_NAME[tool]:
+                raise ToolError("chain name `%s' too long (must be under %s chars)" % (chain, MAX_CHAIN_NAME[tool] + 1), 2)
+            chains[chain] = ['RETURN' if tool == 'ebtables' else '-', []]
+        elif cmd == '-F':
+            for name in [chain] if chain else list(chains):
+                self.chain(chains, name)[1][:] = []
+        elif cmd == '-X':
+            for name in [chain] if chain else [name for name in chains if name not in builtin]:
+                rules = self.chain(chains, name)[1]
+                if name in builtin:
+                    raise ToolError("Can't delete built-in chain")
+                if self.references(chains, name):
+                    raise ToolError("Too many links.")
+                if rules and tool != 'ebtables':
+                    raise ToolError("Directory not empty.")
+                del chains[name]
+        elif cmd == '-P':
+            if chain not in builtin:
+                raise ToolError("Bad built-in chain name.")
+            chains[chain][0] = args[0]
+        elif cmd in ['-A', '-I', '-D']:
+            rules = self.chain(chains, chain)[1]
+            position = 1
+            if cmd in ['-I', '-D'] and args and args[0].isdigit():
+                position = int(args.pop(0))
+                if cmd == '-D':
+                    if position > len(rules):
+                        raise ToolError("Index of deletion too big.")
+                    del rules[position - 1]
+                    self.changed = True
+                    return ''
+            spec = self.canonical(tool, ' '.join(args))
+            if cmd == '-D':
+                if spec not in rules:
+                    raise ToolError("Bad rule (does a matching rule exist in that chain?).")
+                rules.remove(spec)
+            else:
+                self.check_rule(tool, chains, spec)
+                if cmd == '-A':
+                    rules.append(spec)
+                elif position > len(rules) + 1:
+                    raise ToolError("Index of insertion too big.")
+                else:
+                    rules.insert(position - 1, spec)
+        else:
+            raise ToolError("Unknown command %s" % cmd, 2)
+        self.changed = True
+        return ''
+
+    def ordered(self, tool, table, chains):
+        """ The chains in the order the *-save commands print them """
+        builtin = [name for name in BUILTIN_CHAINS[tool][table] if name in chains]
+        user = [name for name in chains if name not in builtin]
+        return builtin + (user if tool == 'ebtables' else sorted(user))
+
+    def list_chains(self, tool, table, chains, chain):
+        lines = []
+        if tool == 'ebtables':
+            lines += ["Bridge table: %s" % table, ""]
+        for name in [chain] if chain else self.ordered(tool, table, chains):
+            policy, rules = self.chain(chains, name)
+            if tool == 'ebtables':
+                lines.append("Bridge chain: %s, entries: %s, policy: %s" % (name, len(rules), policy))
+                lines += rules
+            else:
+                if policy == '-':
+                    lines.append("Chain %s (%s references)" % (name, self.references(chains, name)))
+                else:
+                    lines.append("Chain %s (policy %s)" % (name, policy))
+                lines.append("target     prot opt source               destination")
+                lines += rules
+            lines.append("")
+        return '\n'.join(lines) + '\n'
+
+    def list_rules(self, chains, chain):
+        names = [chain] if chain else list(chains)
+        lines = []
+        for name in names:
+            policy = self.chain(chains, name)[0]
+            lines.append("-N %s" % name if policy == '-' else "-P %s %s" % (name, policy))
+        for name in names:
+            lines += ["-A %s %s" % (name, rule) for rule in chains[name][1]]
+        return '\n'.join(lines) + '\n'
+
+    def save_tables(self, tool):
+        lines = []
+        for table, chains in self.state[tool].items():
+            names = self.ordered(tool, table, chains)
+            lines.append('*' + table)
+            for name in names:
+                lines.append((":%s %s" if tool == 'ebtables' else ":%s %s [0:0]") % (name, chains[name][0]))
+            for name in names:
+                lines += ["-A %s %s" % (name, rule) for rule in chains[name][1]]
+            if tool != 'ebtables':
+                lines.append('COMMIT')
+        return '\n'.join(lines) + '\n'
+
+    def run_rules_command(self, tool, argv):
+        """ iptables, ip6tables or ebtables with one command """
+        table = 'filter'
+        vals = list(argv)
+        cmd = None
+        while vals and cmd is None:
+            val = vals.pop(0)
+            if val == '-t' and vals:
+                table = vals.pop(0)
+            elif val in ['-n', '-v', '-x', '-w', '--wait', '--numeric', '--line-numbers', '--concurrent']:
+                continue
+            else:
+                cmd = val
+        if cmd is None:
+            raise ToolError("no command specified", 2)
+        chain = vals.pop(0) if vals and not vals[0].startswith('-') else None
+        if chain is None and cmd in ['-A', '-I', '-D', '-N', '-P']:
+            raise ToolError("option \"%s\" requires a chain" % cmd, 2)
+        return self.apply(tool, table, self.table(tool, table), cmd, chain, vals)
+
+    def iptables_restore(self, tool, data, noflush):
+        """ Each table is changed at its COMMIT, or not at all """
+        current = None
+        for number, line in enumerate(data.split('\n'), 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                if line.startswith('*'):
+                    name = line[1:]
+                    chains = OrderedDict((chain, [policy, list(rules)])
+                                         for chain, (policy, rules) in self.table(tool, name).items())
+                    if not noflush:
+                        builtin = BUILTIN_CHAINS[tool][name]
+                        chains = OrderedDict((chain, [chains[chain][0], []]) for chain in builtin)
+                    current = (name, chains)
+                elif current is None:
+                    raise ToolError("no table specified")
+                elif line == 'COMMIT':
+                    self.state[tool][current[0]] = current[1]
+                    self.changed = True
+                    current = None
+                elif line.startswith(':'):
+                    name, chains = current
+                    vals = line[1:].split()
+                    if vals[0] in BUILTIN_CHAINS[tool][name]:
+                        if vals[1] != '-':
+                            chains[vals[0]][0] = vals[1]
+                    elif vals[0] in chains:
+                        chains[vals[0]][1][:] = []
+                    else:
+                        self.apply(tool, name, chains, '-N', vals[0], [])
+                else:
+                    vals = line.split()
+                    chain = vals[1] if len(vals) > 1 and not vals[1].startswith('-') else None
+                    self.apply(tool, current[0], current[1], vals[0], chain, vals[2 if chain else 1:])
+            except ToolError as e:
+                raise ToolError("line %s failed: %s" % (number, e))
+        if current is not None:
+            raise ToolError("COMMIT expected at line %s" % number)
+        return ''
+
+    def ebtables_restore(self, data):
+        """ The tables given replace the current ones """
+        tables = OrderedDict()
+        chains = None
+        for number, line in enumerate(data.split('\n'), 1):
+            line = line.strip()
+            if not line or line.startswith('#') or line == 'COMMIT':
+                continue
+            if line.startswith('*'):
+                name = line[1:]
+                self.table('ebtables', name)
+                chains = tables[name] = OrderedDict((chain, ['ACCEPT', []]) for chain in BUILTIN_CHAINS['ebtables'][name])
+            elif chains is None:
+                raise ToolError("no table specified on line %s" % number)
+            elif line.startswith(':'):
+                vals = line[1:].split()
+                if len(vals[0]) > MAX_CHAIN_NAME['ebtables']:
+                    raise ToolError("Chain name length can't exceed %s characters on line %s" % (MAX_CHAIN_NAME['ebtables'], number))
+                chains.setdefault(vals[0], ['RETURN', []])[0] = vals[1] if len(vals) > 1 else 'RETURN'
+            elif line.startswith('-A '):
+                vals = line.split()
+                if vals[1] not in chains:
+                    raise ToolError("Chain '%s' doesn't exist on line %s" % (vals[1], number))
+                chains[vals[1]][1].append(self.canonical('ebtables', ' '.join(vals[2:])))
+            else:
+                raise ToolError("Unsupported line %s: %s" % (number, line))
+        for chains in tables.values():
+            for policy, rules in chains.values():
+                for rule in rules:
+                    self.check_rule('ebtables', chains, rule)
+        self.state['ebtables'].update(tables)
+        self.changed = True
+        return ''
+
+    @staticmethod
+    def member(ipset, member):
+        """ A member as ipset lists it, the network address of a cidr without the host prefix """
+        address, sep, prefix = member.partition('/')
+        family, af, bits = ('inet6', socket.AF_INET6, 128) if ':' in address else ('inet', socket.AF_INET, 32)
+        try:
+            value = int(hexlify(socket.inet_pton(af, address)), 16)
+            prefix = int(prefix) if sep else bits
+        except (socket.error, ValueError):
+            raise ToolError("Syntax error: cannot parse %s: resolving to IP address failed" % member)
+        if family != ipset['family']:
+            raise ToolError("Syntax error: cannot parse %s: resolving to IPv%s address failed" % (member, 4 if ipset['family'] == 'inet' else 6))
+        if prefix < 1 or prefix > bits or (ipset['type'] == 'hash:ip' and prefix != bits):
+            raise ToolError("The value of the CIDR parameter of the IP address is invalid")
+        value &= ((1 << bits) - 1) ^ ((1 << (bits - prefix)) - 1)
+        address = socket.inet_ntop(af, unhexlify('%0*x' % (bits // 4, value)))
+        return address if prefix == bits else '%s/%s' % (address, prefix)
+
+    def ipset(self, vals, exist=False, names=False):
+        """ One ipset command, as given on the command line or to ipset restore """
+        cmd = IPSET_COMMANDS.get(vals[0], vals[0])
+        exist = exist or '-exist' in vals or '-!' in vals
+        vals = [val for val in vals[1:] if val not in ['-exist', '-!', '-q', '-quiet', '-n', '-name']]
+        sets = self.state['ipset']
+
+        def get(name):
+            if name not in sets:
+                raise ToolError("The set with the given name does not exist")
+            return sets[name]
+
+        if cmd == 'create':
+            name = vals[0]
+            if len(name) > MAX_SET_NAME:
+                raise ToolError("Syntax error: setname '%s' is longer than %s characters" % (name, MAX_SET_NAME))
+            settype = IPSET_TYPES.get(vals[1], vals[1])
+            family = vals[vals.index('family') + 1] if 'family' in vals[:-1] else 'inet'
+            if name in sets:
+                if exist and (sets[name]['type'], sets[name]['family']) == (settype, family):
+                    return ''
+                raise ToolError("Set cannot be created: set with the same name already exists")
+            sets[name] = {'type': settype, 'family': family, 'members': []}
+        elif cmd in ['flush', 'destroy']:
+            for name in vals[:1] or list(sets):
+                get(name)
+                if cmd == 'flush':
+                    sets[name]['members'] = []
+                elif self.set_in_use(name):
+                    raise ToolError("Set cannot be destroyed: it is in use by a kernel component")
+                else:
+                    del sets[name]
+        elif cmd in ['add', 'del']:
+            ipset = get(vals[0])
+            member = self.member(ipset, vals[1])
+            if (member in ipset['members']) == (cmd == 'add'):
+                if exist:
+                    return ''
+                if cmd == 'add':
+                    raise ToolError("Element cannot be added to the set: it's already added")
+                raise ToolError("Element cannot be deleted from the set: it's not added")
+            if cmd == 'add':
+                ipset['members'].append(member)
+            else:
+                ipset['members'].remove(member)
+        elif cmd == 'swap':
+            first, second = get(vals[0]), get(vals[1])
+            if (first['type'], first['family']) != (second['type'], second['family']):
+                raise ToolError("The sets cannot be swapped: their type does not match")
+            sets[vals[0]], sets[vals[1]] = second, first
+        elif cmd in ['list', 'save']:
+            selected = vals[:1] or list(sets)
+            for name in selected:
+                get(name)
+            if names:
+                return ''.join(name + '\n' for name in selected)
+            lines = []
+            for name in selected:
+                ipset = sets[name]
+                if cmd == 'save':
+                    lines.append("create %s %s family %s" % (name, ipset['type'], ipset['family']))
+                    lines += ["add %s %s" % (name, member) for member in ipset['members']]
+                else:
+                    lines += ["Name: %s" % name, "Type: %s" % ipset['type'], "Header: family %s" % ipset['family'],
+                              "Number of entries: %s" % len(ipset['members']), "Members:"] + ipset['members'] + [""]
+            return '\n'.join(lines) + '\n'
+        else:
+            raise ToolError("Unknown command %s" % cmd, 2)
+        self.changed = True
+        return ''
+
+    def ipset_command(self, argv, data):
+        if not argv:
+            raise ToolError("No command specified", 2)
+        exist = '-exist' in argv or '-!' in argv
+        if IPSET_COMMANDS.get(argv[0], argv[0]) != 'restore':
+            return self.ipset(argv, exist, '-n' in argv or '-name' in argv)
+        for number, line in enumerate(data.split('\n'), 1):
+            line = line.split()
+            if not line or line[0] == 'COMMIT':
+                continue
+            try:
+                self.ipset(line, exist)
+            except ToolError as e:
+                raise ToolError("Error in line %s: %s" % (number, e))
+        return ''
+
+    def command(self, tool, argv, data=''):
+        """ Run one command of a stand-in tool, returns its output """
+        if tool in ['iptables', 'ip6tables', 'ebtables']:
+            return self.run_rules_command(tool, argv)
+        if tool.endswith('-save'):
+            return self.save_tables(tool[:-len('-save')])
+        if tool == 'ebtables-restore':
+            return self.ebtables_restore(data)
+        if tool.endswith('-restore'):
+            return self.iptables_restore(tool[:-len('-restore')], data, '--noflush' in argv or '-n' in argv)
+        if tool == 'ipset':
+            return self.ipset_command(argv, data)
+        if tool == 'brctl':
+            lines = ["bridge name\tbridge id\t\tSTP enabled\tinterfaces"]
+            for bridge in filter(None, os.environ.get(BRIDGES_ENV, '').split(',')):
+                name, interface = bridge.split('=')
+                lines.append("%s\t\t8000.000000000000\tno\t\t%s" % (name, interface))
+            return '\n'.join(lines) + '\n'
+        if tool == 'sysctl':
+            return ''.join(arg.replace('=', ' = ') + '\n' for arg in argv if '=' in arg)
+        raise ToolError("%s is not a stand-in tool" % tool, 127)
+
+    def dump(self):
+        """
+        The ruleset in a canonical form. The rules of the chains every vm adds to, the
+        built-in and bridge firewall ones, are sorted as their order depends on the order
+        in which the vms were programmed.
+        """
+        lines = []
+        for tool in ['iptables', 'ip6tables', 'ebtables']:
+            for table in sorted(self.state[tool]):
+                chains = self.state[tool][table]
+                lines.append("%s *%s" % (tool, table))
+                for name in sorted(chains):
+                    policy, rules = chains[name]
+                    if name in BUILTIN_CHAINS[tool][table] or name.startswith('BF-'):
+                        rules = sorted(rules)
+                    lines.append("%s :%s %s" % (tool, name, policy))
+                    lines += ["%s -A %s %s" % (tool, name, rule) for rule in rules]
+        for name in sorted(self.state['ipset']):
+            ipset = self.state['ipset'][name]
+            lines.append("ipset create %s %s family %s" % (name, ipset['type'], ipset['family']))
+            lines += ["ipset add %s %s" % (name, member) for member in sorted(ipset['members'])]
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        chains = rules = 0
+        for tool in ['iptables', 'ip6tables', 'ebtables']:
+            for table in self.state[tool].values():
+                chains += len(table)
+                rules += sum(len(chain_rules) for policy, chain_rules in table.values())
+        return OrderedDict([('digest', hashlib.sha1(self.dump()).hexdigest()), ('chains', chains), ('rules', rules),
+                            ('sets', len(self.state['ipset'])),
+                            ('members', sum(len(ipset['members']) for ipset in self.state['ipset'].values()))])
+
+
+def run_tool(tool, argv):
+    """ The main of a stand-in tool, called by its launcher """
+    start = time.time()
+    data = ''
+    if tool.endswith('-restore') or (tool == 'ipset' and argv and IPSET_COMMANDS.get(argv[0], argv[0]) == 'restore'):
+        data = sys.stdin.read()
+    path = os.environ[STATE_ENV]
+    output = error = ''
+    status = 0
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        netfilter = Netfilter.load(path)
+        try:
+            output = netfilter.command(tool, argv, data) or ''
+        except ToolError as e:
+            status = e.status
+            error = "%s: %s\n" % (tool, e)
+        if netfilter.changed:
+            netfilter.save(path)
+        if os.environ.get(RECORD_ENV):
+            with open(os.environ[RECORD_ENV], 'a') as fh:
+                fh.write(json.dumps({'tool': tool, 'args': argv, 'status': status, 'lines': len(data.splitlines()),
+                                     'seconds': round(time.time() - start, 6)}) + '\n')
+    sys.stdout.write(output)
+    sys.stderr.write(error)
+    return status
+
+
+LAUNCHER = """#!%(python)s -SB
+import sys
+sys.path.insert(0, %(path)r)
+import security_group_bench
+sys.exit(security_group_bench.run_tool(%(tool)r, sys.argv[1:]))
+"""
+
+
+class Hypervisor(object):
+    """ The domains of the benchmark, seen by security_group.py through the module returned by libvirt() """
+
+    RUNNING = 1
+    SHUTOFF = 5
+
+    def __init__(self):
+        self.domains = OrderedDict()
+        self.lock = threading.Lock()
+        self.next_id = 1
+        self.calls = 0
+        self.connections = 0
+
+    def call(self):
+        with self.lock:
+            self.calls += 1
+
+    def start(self, name, nics):
+        """ nics are (vif, bridge, mac) tuples """
+        with self.lock:
+            self.domains[name] = {'id': self.next_id, 'state': self.RUNNING, 'nics': nics}
+            self.next_id += 1
+
+    def reboot(self, name):
+        """ A rebooted domain has a new id """
+        self.start(name, self.domains[name]['nics'])
+
+    def stop(self, name, undefine=False):
+        with self.lock:
+            if undefine:
+                del self.domains[name]
+            else:
+                self.domains[name].update(id=-1, state=self.SHUTOFF)
+
+    def libvirt(self):
+        hypervisor = self
+        module = types.ModuleType('libvirt')
+        for value, state in enumerate(['NOSTATE', 'RUNNING', 'BLOCKED', 'PAUSED', 'SHUTDOWN', 'SHUTOFF', 'CRASHED']):
+            setattr(module, 'VIR_DOMAIN_' + state, value)
+
+        class libvirtError(Exception):
+            pass
+
+        class Domain(object):
+            def __init__(self, name):
+                self.domain_name = name
+                self.domain = hypervisor.domains[name]
+
+            def name(self):
+                return self.domain_name
+
+            def ID(self):
+                hypervisor.call()
+                return self.domain['id']
+
+            def info(self):
+                hypervisor.call()
+                return [self.domain['state'], 1048576, 1048576, 1, 0]
+
+            def XMLDesc(self, flags=0):
+                hypervisor.call()
+                interfaces = ''.join("<interface type='bridge'><mac address='%s'/><source bridge='%s'/><target dev='%s'/></interface>"
+                                     % (mac, bridge, vif) for vif, bridge, mac in self.domain['nics'])
+                return "<domain type='kvm' id='%s'><name>%s</name><devices>%s</devices></domain>" % (self.domain['id'], self.domain_name, interfaces)
+
+        class Connection(object):
+            def __init__(self):
+                self.alive = 1
+                with hypervisor.lock:
+                    hypervisor.connections += 1
+
+            def listDomainsID(self):
+                hypervisor.call()
+                return [domain['id'] for domain in hypervisor.domains.values() if domain['id'] != -1]
+
+            def listDefinedDomains(self):
+                hypervisor.call()
+                return [name for name, domain in hypervisor.domains.items() if domain['id'] == -1]
+
+            def lookupByID(self, domid):
+                hypervisor.call()
+                for name, domain in hypervisor.domains.items():
+                    if domain['id'] == domid:
+                        return Domain(name)
+                raise libvirtError("Domain not found: no domain with matching id %s" % domid)
+
+            def lookupByName(self, name):
+                hypervisor.call()
+                if name not in hypervisor.domains:
+                    raise libvirtError("Domain not found: no domain with matching name '%s'" % name)
+                return Domain(name)
+
+            def isAlive(self):
+                return self.alive
+
+            def close(self):
+                self.alive = 0
+
+        module.libvirtError = libvirtError
+        module.openReadOnly = lambda uri=None: Connection()
+        module.open = module.openReadOnly
+        return module
+
+
+class Workload(object):
+    """ The vms of a host and the rules of their security groups, generated from a seed """
+
+    PORTS = [22, 25, 53, 80, 110, 143, 443, 993, 995, 1433, 3306, 3389, 5432, 6379, 8080, 8443, 9200, 27017]
+
+    def __init__(self, vms=20, rules=10, cidrs=5, groups=4, seed=1, bridge='cloudbr0'):
+        self.random = random.Random(seed)
+        self.cidrs = cidrs
+        self.groups = [[self.make_rule() for i in range(rules)] for group in range(groups)]
+        self.vms = []
+        for i in range(vms):
+            vmid = 100 + i
+            self.vms.append({'name': 'i-2-%s-VM' % vmid, 'id': str(vmid), 'ip': '10.1.%s.%s' % (i // 250, i % 250 + 2),
+                             'ip6': 'fd00::%x' % (i + 2), 'mac': '52:54:00:%02x:%02x:%02x' % (i >> 16 & 255, i >> 8 & 255, i & 255),
+                             'vif': 'vnet%s' % i, 'bridge': bridge, 'group': i % groups, 'seq': 0,
+                             'secips': '10.2.%s.%s;' % (i // 250, i % 250 + 2) if i % 10 == 9 else '0;'})
+
+    def make_cidrs(self):
+        r = self.random
+        if r.random() < 0.05:
+            return ['0.0.0.0/0']
+        cidrs = []
+        for i in range(self.cidrs):
+            if r.random() < 0.1:
+                cidrs.append('fd%02x:%x::/64' % (r.randint(0, 3), r.randint(0, 255)))
+            else:
+                # From a small pool, the groups and the rules share networks
+                cidrs.append('172.%s.%s.%s/%s' % (16 + r.randint(0, 3), r.randint(0, 15), r.choice([0, 0, 0, r.randint(1, 254)]),
+                                                  r.choice([24, 24, 24, 32, 16])))
+        return cidrs
+
+    def make_rule(self):
+        r = self.random
+        ruletype = 'I' if r.random() < 0.7 else 'E'
+        protocol = r.choice(['tcp'] * 5 + ['udp'] * 3 + ['icmp', 'all'])
+        if protocol in ['tcp', 'udp']:
+            start = r.choice(self.PORTS) if r.random() < 0.7 else r.randint(1024, 60000)
+            end = start if r.random() < 0.8 else start + r.randint(1, 100)
+        elif protocol == 'icmp':
+            start, end = r.choice([(-1, -1), (8, 0), (0, 0), (3, 4)])
+        else:
+            start = end = -1
+        return [ruletype, protocol, start, end, self.make_cidrs()]
+
+    def change_group(self, group):
+        """ Like a user editing a security group: a rule changes, one is added and one removed """
+        rules = self.groups[group]
+        r = self.random
+        if rules:
+            rules[r.randrange(len(rules))][4] = self.make_cidrs()
+            rules.pop(r.randrange(len(rules)))
+        rules.append(self.make_rule())
+
+    def rules(self, vm):
+        return ''.join('%s:%s;%s;%s;%sNEXT;' % (ruletype, protocol, start, end, ','.join(cidrs))
+                       for ruletype, protocol, start, end, cidrs in self.groups[vm['group']])
+
+    @staticmethod
+    def default_rules(vm):
+        return ['default_network_rules', '--vmname', vm['name'], '--vmid', vm['id'], '--vmip', vm['ip'],
+                '--vmip6', vm['ip6'], '--vmmac', vm['mac'], '--vif', vm['vif'], '--brname', vm['bridge'],
+                '--nicsecips', vm['secips']]
+
+    def add_rules(self, vm, resend=False):
+        """ The rules of the group of a vm, as sent by the management server, resend keeps the seqno """
+        if not resend:
+            vm['seq'] += 1
+        rules = self.rules(vm)
+        return ['add_network_rules', '--vmname', vm['name'], '--vmid', vm['id'], '--vmip', vm['ip'],
+                '--vmip6', vm['ip6'], '--vmmac', vm['mac'], '--vif', vm['vif'], '--brname', vm['bridge'],
+                '--sig', hashlib.md5(rules).hexdigest(), '--seq', str(vm['seq']), '--rules', rules,
+                '--nicsecips', vm['secips']]
+
+    @staticmethod
+    def destroy_rules(vm):
+        return ['destroy_network_rules_for_vm', '--vmname', vm['name'], '--vif', vm['vif']]
+
+
+def load_security_group(hypervisor, workdir):
+    """ A fresh security_group module using the libvirt of hypervisor and keeping its files in workdir """
+    import imp
+    lib = os.path.join(HERE, '..', '..', '..', 'python', 'lib')
+    if os.path.isdir(lib) and lib not in sys.path:
+        sys.path.append(lib)
+    sys.modules['libvirt'] = hypervisor.libvirt()
+    previous = sys.dont_write_bytecode
+    sys.dont_write_bytecode = True
+    try:
+        sg = imp.load_source('security_group', os.path.join(HERE, 'security_group.py'))
+    finally:
+        sys.dont_write_bytecode = previous
+    sg.logpath = os.path.join(workdir, 'run') + '/'
+    sg.lock_file = os.path.join(workdir, 'security_group.lock')
+    sg.vm_lock_dir = os.path.join(workdir, 'lock') + '/'
+    sg.rule_log_file = sg.logpath + 'security_group_rules.json'
+    sg.socket_path = sg.logpath + 'security_group.sock'
+    if not os.path.exists(sg.logpath):
+        os.makedirs(sg.logpath)
+    return sg
+
+
+class Benchmark(object):
+    """
+    A host running security_group.py against the stand-in tools. The commands run as
+    the agent runs them: each in a new process (cli, the state of the module is reset),
+    all the commands of a phase in one bulk command (bulk), or sent to the daemon by
+    concurrent clients (daemon).
+    """
+
+    def __init__(self, mode='cli', workers=8, bridges=None, workdir=None):
+        self.mode = mode
+        self.workers = workers
+        self.bridges = bridges or OrderedDict([('cloudbr0', 'eth0')])
+        self.workdir = workdir or tempfile.mkdtemp(prefix='sg-bench-')
+        self.state = os.path.join(self.workdir, 'netfilter.state')
+        self.record = os.path.join(self.workdir, 'commands.log')
+        self.environ = dict((name, os.environ.get(name)) for name in ['PATH', STATE_ENV, RECORD_ENV, BRIDGES_ENV])
+        self.install_tools()
+
+        # The bridge firewall chains are there, addFWFramework fills them
+        netfilter = Netfilter()
+        for bridge in self.bridges:
+            for tool in ['iptables', 'ip6tables']:
+                for suffix in ['', '-IN', '-OUT']:
+                    netfilter.command(tool, ['-N', 'BF-' + bridge + suffix])
+        netfilter.save(self.state)
+        open(self.record, 'w').close()
+
+        self.hypervisor = Hypervisor()
+        self.sg = load_security_group(self.hypervisor, self.workdir)
+        self.lock = threading.Lock()
+        self.executed = 0
+        for name in ['execute', 'execute_stdin']:
+            setattr(self.sg, name, self.counted(getattr(self.sg, name)))
+        self.daemon = None
+        if mode == 'daemon':
+            self.start_daemon()
+
+    def install_tools(self):
+        bindir = os.path.join(self.workdir, 'bin')
+        os.makedirs(bindir)
+        for tool in TOOLS:
+            path = os.path.join(bindir, tool)
+            with open(path, 'w') as fh:
+                fh.write(LAUNCHER % {'python': sys.executable, 'path': HERE, 'tool': tool})
+            os.chmod(path, 0o755)
+        os.environ['PATH'] = bindir + os.pathsep + os.environ.get('PATH', '')
+        os.environ[STATE_ENV] = self.state
+        os.environ[RECORD_ENV] = self.record
+        os.environ[BRIDGES_ENV] = ','.join('%s=%s' % bridge for bridge in self.bridges.items())
+
+    def counted(self, function):
+        def run(*args):
+            with self.lock:
+                self.executed += 1
+            return function(*args)
+        return run
+
+    def start_daemon(self):
+        self.daemon = threading.Thread(target=self.sg.run_daemon, args=(self.workers,))
+        self.daemon.daemon = True
+        self.daemon.start()
+        for i in range(500):
+            if os.path.exists(self.sg.socket_path):
+                return
+            time.sleep(0.01)
+        raise RuntimeError("The security group daemon did not start")
+
+    def close(self, keep=False):
+        for name, value in self.environ.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        if not keep:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def netfilter(self):
+        return Netfilter.load(self.state)
+
+    def records(self):
+        with open(self.record) as fh:
+            return [json.loads(line) for line in fh]
+
+    def run(self, argv):
+        """ Run one command of the agent, returns its exit status """
+        if self.mode == 'daemon':
+            return self.sg.forward_to_daemon(argv)
+        # A new process
+        self.sg.libvirt_conn = None
+        self.sg.rule_logs = None
+        self.sg.rule_logs_stat = None
+        self.sg.reset_command_cache()
+        (option, args) = self.sg.get_parser().parse_args(argv)
+        # The commands returning False are counted as failed, as in bulk
+        return self.sg.run_status(option, args, strict=True)
+
+    def run_group(self, commands):
+        return [self.run(argv) for argv in commands]
+
+    def run_phase(self, name, commands):
+        """ Run the commands, lists of arguments of security_group.py, returns the statistics of the phase """
+        records = len(self.records())
+        executed = self.executed
+        calls = self.hypervisor.calls
+        start = time.time()
+        if self.mode == 'bulk' and len(commands) > 1:
+            path = os.path.join(self.workdir, name + '.bulk')
+            with open(path, 'w') as fh:
+                fh.write(''.join(json.dumps(argv) + '\n' for argv in commands))
+            statuses = [self.run(['bulk', '--file', path, '--workers', str(self.workers)])]
+        elif self.mode == 'daemon' and len(commands) > 1:
+            groups = OrderedDict()
+            for argv in commands:
+                vm_name = argv[argv.index('--vmname') + 1] if '--vmname' in argv else None
+                groups.setdefault(vm_name, []).append(argv)
+            pool = ThreadPool(self.workers)
+            try:
+                statuses = sum(pool.map(self.run_group, groups.values()), [])
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            statuses = self.run_group(commands)
+        seconds = time.time() - start
+
+        tools = OrderedDict((tool, 0) for tool in TOOLS)
+        failures = 0
+        tool_seconds = 0.0
+        for record in self.records()[records:]:
+            tools[record['tool']] += 1
+            failures += record['status'] != 0
+            tool_seconds += record['seconds']
+        return OrderedDict([('phase', name), ('commands', len(commands)),
+                            ('failed', len([status for status in statuses if status != 0])),
+                            ('seconds', round(seconds, 3)), ('executed', self.executed - executed),
+                            ('processes', sum(tools.values())), ('tool_seconds', round(tool_seconds, 3)),
+                            ('tool_failures', failures),
+                            ('libvirt_calls', self.hypervisor.calls - calls),
+                            ('tools', OrderedDict((tool, count) for tool, count in tools.items() if count))])
+
+    def check(self, running, stopped):
+        """ The running vms without their chains, and the stopped ones whose chains or sets are left """
+        netfilter = self.netfilter()
+        filter_chains = netfilter.state['iptables']['filter']
+        eb_chains = netfilter.state['ebtables']['nat']
+        names = ' '.join(list(filter_chains) + list(eb_chains) + list(netfilter.state['ipset']))
+        missing = [vm['name'] for vm in running
+                   if self.sg.iptables_chain_name(vm['name']) not in filter_chains
+                   or self.sg.ebtables_chain_name(vm['name']) + '-in' not in eb_chains]
+        stale = [vm['name'] for vm in stopped
+                 if self.sg.iptables_chain_name(vm['name'])[:23] in names or self.sg.ipset_vm_prefix(vm['name']) in names]
+        return missing, stale
+
+
+PHASES = ['start', 'resend', 'update', 'reboot', 'stop', 'cleanup']
+
+
+def run_workload(benchmark, workload, phases=PHASES, reboot=0.2, stop=0.2):
+    """ Run the phases of a workload, returns their statistics and the vms left running and stopped """
+    vms = workload.vms
+    running = []
+    stopped = []
+    results = []
+    rebooted = vms[:int(len(vms) * reboot)]
+    # The vms stopped by the agent, and those whose domain went away without it
+    stopping = vms[len(vms) - int(len(vms) * stop):]
+    destroyed = stopping[:len(stopping) // 2]
+    crashed = stopping[len(stopping) // 2:]
+
+    for phase in phases:
+        if phase == 'start':
+            commands = []
+            for vm in vms:
+                benchmark.hypervisor.start(vm['name'], [(vm['vif'], vm['bridge'], vm['mac'])])
+                commands += [workload.default_rules(vm), workload.add_rules(vm)]
+            running = list(vms)
+        elif phase == 'resend':
+            commands = [workload.add_rules(vm, resend=True) for vm in running]
+        elif phase == 'update':
+            for group in range(len(workload.groups)):
+                workload.change_group(group)
+            commands = [workload.add_rules(vm) for vm in running]
+        elif phase == 'reboot':
+            for vm in rebooted:
+                if vm in running:
+                    benchmark.hypervisor.reboot(vm['name'])
+            commands = [['get_rule_logs_for_vms']]
+        elif phase == 'stop':
+            commands = []
+            for vm in destroyed:
+                if vm in running:
+                    benchmark.hypervisor.stop(vm['name'])
+                    commands.append(workload.destroy_rules(vm))
+                    running.remove(vm)
+                    stopped.append(vm)
+        elif phase == 'cleanup':
+            for vm in crashed:
+                if vm in running:
+                    benchmark.hypervisor.stop(vm['name'], undefine=True)
+                    running.remove(vm)
+                    stopped.append(vm)
+            commands = [['cleanup_rules']]
+        else:
+            raise ValueError("Unknown phase " + phase)
+        results.append(benchmark.run_phase(phase, commands))
+    return results, running, stopped
+
+
+class NullOutput(object):
+    """ What security_group.py prints for the agent """
+
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+
+def get_parser():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--vms", dest="vms", type="int", default=20)
+    parser.add_option("--rules", dest="rules", type="int", default=10, help="rules per security group")
+    parser.add_option("--cidrs", dest="cidrs", type="int", default=5, help="cidrs per rule")
+    parser.add_option("--groups", dest="groups", type="int", default=4, help="security groups the vms are spread over")
+    parser.add_option("--seed", dest="seed", type="int", default=1)
+    parser.add_option("--mode", dest="mode", default="cli", choices=['cli', 'bulk', 'daemon'])
+    parser.add_option("--workers", dest="workers", type="int", default=8)
+    parser.add_option("--phases", dest="phases", default=','.join(PHASES))
+    parser.add_option("--reboot", dest="reboot", type="float", default=0.2, help="share of the vms rebooted")
+    parser.add_option("--stop", dest="stop", type="float", default=0.2, help="share of the vms stopped")
+    parser.add_option("--dump", dest="dump", help="write the final ruleset to this file")
+    parser.add_option("--compare", dest="compare", help="compare the final ruleset with the one dumped to this file")
+    parser.add_option("--record", dest="record", help="write the commands run by the stand-in tools to this file")
+    parser.add_option("--log", dest="log", help="the log of security_group.py")
+    parser.add_option("--keep", dest="keep", action="store_true", default=False, help="keep the working directory")
+    return parser
+
+
+def main(argv):
+    (option, args) = get_parser().parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix='sg-bench-')
+    logging.basicConfig(filename=option.log or os.path.join(workdir, 'security_group.log'),
+                        format="%(asctime)s - %(message)s", level=logging.DEBUG)
+    out = sys.stdout
+    sys.stdout = NullOutput()
+    benchmark = Benchmark(option.mode, option.workers, workdir=workdir)
+    try:
+        workload = Workload(option.vms, option.rules, option.cidrs, option.groups, option.seed)
+        phases, running, stopped = run_workload(benchmark, workload, option.phases.split(','), option.reboot, option.stop)
+        netfilter = benchmark.netfilter()
+        dump = netfilter.dump()
+        missing, stale = benchmark.check(running, stopped)
+        report = OrderedDict([('mode', option.mode), ('workers', option.workers), ('vms', option.vms),
+                              ('rules', option.rules), ('cidrs', option.cidrs), ('groups', option.groups),
+                              ('seed', option.seed), ('phases', phases)])
+        report['total'] = OrderedDict((key, round(sum(phase[key] for phase in phases), 3))
+                                      for key in ['commands', 'failed', 'seconds', 'executed', 'processes', 'tool_seconds',
+                                                  'tool_failures', 'libvirt_calls'])
+        report['ruleset'] = netfilter.summary()
+        report['ruleset']['missing'] = missing
+        report['ruleset']['stale'] = stale
+        status = 1 if report['total']['failed'] or missing or stale else 0
+
+        if option.dump:
+            with open(option.dump, 'w') as fh:
+                fh.write(dump)
+        if option.record:
+            shutil.copy(benchmark.record, option.record)
+        if option.compare:
+            with open(option.compare) as fh:
+                expected = fh.read()
+            report['ruleset']['same'] = expected == dump
+            if expected != dump:
+                status = 1
+                sys.stderr.writelines(list(difflib.unified_diff(expected.splitlines(True), dump.splitlines(True),
+                                                                option.compare, 'ruleset'))[:200])
+        if option.keep:
+            report['workdir'] = benchmark.workdir
+        out.write(json.dumps(report, indent=2) + '\n')
+        return status
+    finally:
+        sys.stdout = out
+        benchmark.close(option.keep)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
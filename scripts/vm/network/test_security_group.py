@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+from security_group_bench import Benchmark, Hypervisor, Netfilter, ToolError, Workload, load_security_group, run_workload
+
+import json
+import logging
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from StringIO import StringIO
+
+
+class TestNetfilter(unittest.TestCase):
+
+    def setUp(self):
+        self.netfilter = Netfilter()
+
+    def test_chains(self):
+        self.netfilter.command('iptables', ['-N', 'BF-cloudbr0'])
+        self.assertRaises(ToolError, self.netfilter.command, 'iptables', ['-N', 'BF-cloudbr0'])
+        self.netfilter.command('iptables', ['-I', 'FORWARD', '-o', 'cloudbr0', '-j', 'BF-cloudbr0'])
+        self.assertTrue('(1 references)' in self.netfilter.command('iptables', ['-n', '-L', 'BF-cloudbr0']))
+        self.assertRaises(ToolError, self.netfilter.command, 'iptables', ['-X', 'BF-cloudbr0'])
+        self.assertRaises(ToolError, self.netfilter.command, 'iptables', ['-A', 'FORWARD', '-j', 'BF-cloudbr1'])
+        self.netfilter.command('iptables', ['-D', 'FORWARD', '--out-interface', 'cloudbr0', '-j', 'BF-cloudbr0'])
+        self.netfilter.command('iptables', ['-X', 'BF-cloudbr0'])
+
+    def test_restore(self):
+        self.netfilter.command('iptables-restore', ['--noflush'], "*filter\n:i-2-3-VM - [0:0]\n-A i-2-3-VM -j DROP\nCOMMIT\n")
+        self.assertTrue("-A i-2-3-VM -j DROP" in self.netfilter.command('iptables-save', []))
+        # Nothing of a table is applied when a line fails
+        self.assertRaises(ToolError, self.netfilter.command, 'iptables-restore', ['--noflush'],
+                          "*filter\n:i-2-3-VM - [0:0]\n-A i-2-3-VM -m set --match-set i-2-3-VM src -j ACCEPT\nCOMMIT\n")
+        self.assertTrue("-A i-2-3-VM -j DROP" in self.netfilter.command('iptables-save', []))
+
+    def test_ipset(self):
+        self.netfilter.command('ipset', ['restore'], "create s hash:net family inet -exist\nadd s 10.1.1.7/24 -exist\n")
+        self.assertEqual(self.netfilter.command('ipset', ['list', '-n']), "s\n")
+        self.assertTrue("10.1.1.0/24" in self.netfilter.command('ipset', ['list', 's']))
+        self.assertRaises(ToolError, self.netfilter.command, 'ipset', ['add', 's', '0.0.0.0/0'])
+        self.netfilter.command('iptables', ['-A', 'INPUT', '-m', 'set', '--set', 's', 'src', '-j', 'ACCEPT'])
+        self.assertRaises(ToolError, self.netfilter.command, 'ipset', ['destroy', 's'])
+        self.assertRaises(ToolError, self.netfilter.command, 'ip6tables', ['-A', 'INPUT', '-m', 'set', '--match-set', 's', 'src'])
+
+
+class TestOptimizeNetworkRules(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.sg = load_security_group(Hypervisor(), self.workdir)
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+        shutil.rmtree(self.workdir)
+
+    def optimize(self, rules):
+        parsed = self.sg.parse_network_rules(''.join(rule + 'NEXT;' for rule in rules))
+        return [(rule['ruletype'], rule['protocol'], rule['start'], rule['end'], rule['ipv4'], rule['ipv6'])
+                for rule in self.sg.optimize_network_rules(parsed)]
+
+    def test_port_ranges(self):
+        self.assertEqual(self.optimize(['I:tcp;80;90;10.0.0.0/24', 'I:udp;53;53;10.0.0.0/24', 'I:tcp;91;100;10.0.0.0/24',
+                                        'I:tcp;200;300;10.0.0.0/24', 'I:tcp;95;120;10.0.0.0/24', 'I:udp;54;60;10.0.0.0/24']),
+                         [('I', 'tcp', 80, 120, ['10.0.0.0/24'], []),
+                          ('I', 'tcp', 200, 300, ['10.0.0.0/24'], []),
+                          ('I', 'udp', 53, 60, ['10.0.0.0/24'], [])])
+        # Only the ranges of the same cidrs are merged
+        self.assertEqual(self.optimize(['I:tcp;80;80;10.0.0.0/24', 'I:tcp;81;81;10.0.1.0/24']),
+                         [('I', 'tcp', 80, 80, ['10.0.0.0/24'], []), ('I', 'tcp', 81, 81, ['10.0.1.0/24'], [])])
+
+    def test_icmp(self):
+        self.assertEqual(self.optimize(['I:icmp;8;0;10.0.0.0/24', 'I:icmp;9;0;10.0.0.0/24', 'I:icmp;8;1;10.0.0.0/24',
+                                        'I:icmp;-1;-1;10.0.0.0/24', 'I:icmp;8;0;10.0.1.0/24']),
+                         [('I', 'icmp', 8, 0, ['10.0.0.0/23'], []),
+                          ('I', 'icmp', 9, 0, ['10.0.0.0/24'], []),
+                          ('I', 'icmp', 8, 1, ['10.0.0.0/24'], []),
+                          ('I', 'icmp', -1, -1, ['10.0.0.0/24'], [])])
+
+    def test_cidrs(self):
+        self.assertEqual(self.optimize(['I:tcp;22;22;10.0.0.0/32,10.0.0.1/32,10.0.0.2/32', 'I:tcp;22;22;10.0.0.3/32,10.0.0.1/32']),
+                         [('I', 'tcp', 22, 22, ['10.0.0.0/30'], [])])
+        self.assertEqual(self.optimize(['I:tcp;22;22;10.0.0.0/24,fd00::/64,10.0.1.0/24', 'I:tcp;22;22;fd00:0:0:1::/64']),
+                         [('I', 'tcp', 22, 22, ['10.0.0.0/23'], []), ('I', 'tcp', 22, 22, [], ['fd00::/63'])])
+
+    def test_directions(self):
+        self.assertEqual(self.optimize(['E:tcp;22;22;10.0.0.0/24', 'I:tcp;22;22;10.0.0.0/24', 'I:tcp;23;23;10.0.0.0/24',
+                                        'E:tcp;23;23;10.0.0.0/24']),
+                         [('E', 'tcp', 22, 23, ['10.0.0.0/24'], []), ('I', 'tcp', 22, 23, ['10.0.0.0/24'], [])])
+
+    def test_order(self):
+        self.assertEqual(self.optimize(['I:udp;53;53;10.0.0.0/24', 'E:all;-1;-1;0.0.0.0/0', 'I:tcp;22;22;10.0.0.0/24',
+                                        'I:icmp;-1;-1;10.0.0.0/24', 'I:udp;53;53;10.0.1.0/24']),
+                         [('I', 'udp', 53, 53, ['10.0.0.0/23'], []),
+                          ('E', 'all', -1, -1, ['0.0.0.0/0'], []),
+                          ('I', 'tcp', 22, 22, ['10.0.0.0/24'], []),
+                          ('I', 'icmp', -1, -1, ['10.0.0.0/24'], [])])
+
+
+class TestIpsetNames(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.sg = load_security_group(Hypervisor(), self.workdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_group_names(self):
+        group = ('I', 'tcp', '22:22', 'inet')
+        # The chains of these vms have the same first 23 characters
+        names = [self.sg.ipset_group_name(vm_name, group) for vm_name in ['i-2-100-VM-a-long-hostnaX', 'i-2-100-VM-a-long-hostnaY']]
+        self.assertNotEqual(names[0], names[1])
+        self.assertTrue(max(len(name) for name in names) <= 30)
+        self.assertTrue(names[0].startswith(self.sg.ipset_vm_prefix('i-2-100-VM-a-long-hostnaX') + '-'))
+        self.assertNotEqual(self.sg.ipset_group_name('i-2-100-VM', group), self.sg.ipset_group_name('i-2-100-VM', ('E',) + group[1:]))
+
+
+class Connection(object):
+    """ The connection of a client of the daemon, keeps the response """
+
+    def __init__(self):
+        self.response = None
+
+    def sendall(self, data):
+        self.response = json.loads(data)
+
+    def close(self):
+        pass
+
+
+class Pool(object):
+    """ A pool of workers that runs the jobs when told to """
+
+    def __init__(self):
+        self.jobs = []
+
+    def apply_async(self, function, args):
+        self.jobs.append((function, args))
+
+    def run(self):
+        while self.jobs:
+            function, args = self.jobs.pop(0)
+            function(*args)
+
+
+class TestDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.sg = load_security_group(Hypervisor(), self.workdir)
+        self.stdout = sys.stdout
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        logging.disable(logging.NOTSET)
+        shutil.rmtree(self.workdir)
+
+    def request(self, *argv):
+        return self.sg.get_parser().parse_args(list(argv))
+
+    def test_superseded_rules(self):
+        applied = []
+        # The requests that come while one is applied
+        arriving = []
+
+        def run_request(option, args):
+            applied.append((args[0], option.vmName, option.seq))
+            while arriving:
+                conn, seq = arriving.pop()
+                queues.submit(conn, *self.request('add_network_rules', '--vmname', 'i-2-3-VM', '--seq', seq))
+            return 0, ''
+        self.sg.run_request = run_request
+        queues = self.sg.RequestQueues(1)
+        queues.pool.close()
+        queues.pool = Pool()
+
+        conns = [Connection() for i in range(5)]
+        queues.submit(conns[0], *self.request('add_network_rules', '--vmname', 'i-2-3-VM', '--seq', '1'))
+        # Newer than the waiting rules, which are acknowledged and never applied
+        queues.submit(conns[1], *self.request('add_network_rules', '--vmname', 'i-2-3-VM', '--seq', '3'))
+        self.assertEqual(conns[0].response, {'status': 0, 'output': ''})
+        # Older than the waiting rules
+        queues.submit(conns[2], *self.request('add_network_rules', '--vmname', 'i-2-3-VM', '--seq', '2'))
+        self.assertEqual(conns[2].response, {'status': 0, 'output': ''})
+        queues.submit(conns[3], *self.request('add_network_rules', '--vmname', 'i-2-3-VM', '--seq', '4'))
+        self.assertEqual(conns[1].response, {'status': 0, 'output': ''})
+        queues.submit(conns[4], *self.request('add_network_rules', '--vmname', 'i-2-4-VM', '--seq', '1'))
+
+        self.assertEqual((conns[3].response, conns[4].response), (None, None))
+        queues.pool.run()
+        self.assertEqual(applied, [('add_network_rules', 'i-2-3-VM', '4'), ('add_network_rules', 'i-2-4-VM', '1')])
+        self.assertEqual([conn.response['status'] for conn in conns], [0] * 5)
+        # The rules being applied are not superseded, newer ones are applied after them
+        arriving.append((Connection(), '6'))
+        queues.submit(conns[0], *self.request('add_network_rules', '--vmname', 'i-2-3-VM', '--seq', '5'))
+        queues.pool.run()
+        self.assertEqual(applied[2:], [('add_network_rules', 'i-2-3-VM', '5'), ('add_network_rules', 'i-2-3-VM', '6')])
+        self.assertEqual(queues.queues, {})
+
+    def test_request_output(self):
+        def run_status(option, args):
+            for i in range(3):
+                print("%s %s" % (option.vmName, i))
+                time.sleep(0.01)
+            return 0 if option.vmName != 'i-2-4-VM' else 1
+        self.sg.run_status = run_status
+        sys.stdout = self.sg.RequestOutput(StringIO())
+
+        results = {}
+
+        def run(vm_name):
+            results[vm_name] = self.sg.run_request(*self.request('add_network_rules', '--vmname', vm_name))
+        threads = [threading.Thread(target=run, args=(vm_name,)) for vm_name in ['i-2-3-VM', 'i-2-4-VM']]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, {'i-2-3-VM': (0, "i-2-3-VM 0\ni-2-3-VM 1\ni-2-3-VM 2\n"),
+                                   'i-2-4-VM': (1, "i-2-4-VM 0\ni-2-4-VM 1\ni-2-4-VM 2\n")})
+        self.assertEqual(sys.stdout.stdout.getvalue(), '')
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def setUp(self):
+        self.stdout = sys.stdout
+        sys.stdout = StringIO()
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        logging.disable(logging.NOTSET)
+
+    def run_benchmark(self, mode):
+        benchmark = Benchmark(mode, workers=2)
+        try:
+            workload = Workload(vms=4, rules=3, cidrs=2, groups=2, seed=3)
+            phases, running, stopped = run_workload(benchmark, workload, stop=0.5)
+            self.assertEqual(benchmark.check(running, stopped), ([], []))
+            return phases, benchmark.netfilter().dump()
+        finally:
+            benchmark.close()
+
+    def test_workload(self):
+        phases, cli = self.run_benchmark('cli')
+        self.assertEqual([phase['phase'] for phase in phases], ['start', 'resend', 'update', 'reboot', 'stop', 'cleanup'])
+        self.assertEqual(sum(phase['failed'] for phase in phases), 0)
+        # The rules sent again are already programmed
+        self.assertEqual(phases[1]['processes'], 0)
+        self.assertTrue(phases[2]['processes'] > 0)
+
+        phases, bulk = self.run_benchmark('bulk')
+        self.assertEqual(sum(phase['failed'] for phase in phases), 0)
+        self.assertEqual(cli, bulk)
+
+    def program(self, groups, updates):
+        """ The ruleset of a host with one vm whose rules were set to each of groups in turn """
+        benchmark = Benchmark('cli')
+        try:
+            workload = Workload(vms=1, groups=1)
+            vm = workload.vms[0]
+            benchmark.hypervisor.start(vm['name'], [(vm['vif'], vm['bridge'], vm['mac'])])
+            update_network_rules = benchmark.sg.update_network_rules
+
+            def update(*args):
+                updates.append(args[0])
+                return update_network_rules(*args)
+            benchmark.sg.update_network_rules = update
+            self.assertEqual(benchmark.run(workload.default_rules(vm)), 0)
+            for rules in groups:
+                workload.groups[0] = rules
+                self.assertEqual(benchmark.run(workload.add_rules(vm)), 0)
+
+            # Updated rules are inserted at the top of the chains, the order of the accepting rules does not matter
+            netfilter = benchmark.netfilter()
+            for tool in ['iptables', 'ip6tables']:
+                for chain in [benchmark.sg.iptables_chain_name(vm['name']), benchmark.sg.egress_chain_name(vm['name'])]:
+                    rules = netfilter.state[tool]['filter'][chain][1]
+                    rules[:] = sorted(rules[:-1]) + rules[-1:]
+            return netfilter.dump()
+        finally:
+            benchmark.close()
+
+    def test_update(self):
+        first = [['I', 'tcp', 22, 22, ['10.0.0.0/24']], ['I', 'udp', 53, 53, ['10.1.0.0/16', 'fd00::/64']],
+                 ['I', 'icmp', 8, 0, ['10.2.0.0/24']]]
+        # With egress rules, the default egress action becomes DROP
+        second = [['I', 'tcp', 22, 22, ['10.0.0.0/24', '10.0.1.0/24']], ['I', 'tcp', 80, 80, ['10.3.0.0/24']],
+                  ['E', 'tcp', 443, 443, ['0.0.0.0/0']], ['E', 'udp', 53, 53, ['fd01::/64']]]
+        for groups in [[first, second], [second, first]]:
+            updates = []
+            updated = self.program(groups, updates)
+            self.assertEqual(len(updates), 1)
+            programmed = self.program(groups[1:], updates)
+            self.assertEqual(len(updates), 1)
+            self.assertEqual(updated, programmed)
+            action = 'DROP' if groups[1] is second else 'RETURN'
+            for tool in ['iptables', 'ip6tables']:
+                egress = [line for line in updated.split('\n') if line.startswith(tool + ' -A i-2-100-VM-eg ')]
+                self.assertEqual(egress[-1], '%s -A i-2-100-VM-eg -j %s' % (tool, action))
+
+    def test_ebtables(self):
+        benchmark = Benchmark('cli')
+        try:
+            sg = benchmark.sg
+            rules = sg.RuleSet()
+            rules.chain('ebtables', 'i-2-3-VM-in-ips', table='nat')
+            rules.rule('ebtables', '-A PREROUTING -i vnet0 -j i-2-3-VM-in-ips', table='nat')
+            rules.rule('ebtables', '-A i-2-3-VM-in-ips -p ARP --arp-ip-src 10.1.1.2 -j RETURN', table='nat')
+            self.assertTrue(rules.commit())
+            # Deleting a rule that is not there fails, in the restore and then one command at a time
+            rules.rule('ebtables', '-D i-2-3-VM-in-ips -p ARP --arp-ip-src 10.1.1.3 -j RETURN', table='nat')
+            self.assertFalse(rules.ebtables_restore('nat', rules.get('ebtables', 'nat')))
+            self.assertFalse(rules.commit())
+            # The chains and rules of the rest of the host are kept
+            sg.execute('ebtables -t nat -N other')
+            sg.execute('ebtables -t nat -A PREROUTING -i eth0 -j other')
+            rules.drop('ebtables', 'i-2-3-VM-in-ips', table='nat')
+            self.assertTrue(rules.commit())
+            nat = benchmark.netfilter().state['ebtables']['nat']
+            self.assertEqual(nat['PREROUTING'][1], ['-i eth0 -j other'])
+            self.assertEqual([chain in nat for chain in ['other', 'i-2-3-VM-in-ips']], [True, False])
+        finally:
+            benchmark.close()
+
+    def test_long_names(self):
+        benchmark = Benchmark('cli', workers=2)
+        try:
+            workload = Workload(vms=4, rules=3, cidrs=2, groups=2, seed=3)
+            # Longer than the chain names, the iptables and ebtables chains of a vm differ
+            for vm in workload.vms:
+                vm['name'] += '-a-long-hostname'
+            phases, running, stopped = run_workload(benchmark, workload, stop=0.5)
+            self.assertEqual(sum(phase['failed'] for phase in phases), 0)
+            self.assertEqual(benchmark.check(running, stopped), ([], []))
+            benchmark.sg.rule_logs = None
+            self.assertEqual(sorted(benchmark.sg.load_rule_logs()), sorted(vm['name'] for vm in running))
+        finally:
+            benchmark.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -35,6 +35,8 @@ OVS_PID_PATH = "/var/run/openvswitch/ovs-vswitchd.pid"
 OVS_DAEMON_PATH = "ovs-vswitchd"
 VSCTL_PATH = "/usr/bin/ovs-vsctl"
 OFCTL_PATH = "/usr/bin/ovs-ofctl"
+# IP protocol numbers of the protocols of the network ACL items, all protocols are matched with a wildcard
+ACL_PROTOCOLS = {"all": "*", "tcp": "6", "udp": "17", "icmp": "1"}
 
 class PluginError(Exception):
     """Base Exception class for all plugin errors."""
@@ -176,9 +178,11 @@ def _build_flow_expr(**kwargs):
     nw_dst = 'nw_dst' in kwargs and ",nw_dst=%s" % kwargs['nw_dst'] or ''
     table = 'table' in kwargs and ",table=%s" % kwargs['table'] or ''
     proto = 'proto' in kwargs and ",%s" % kwargs['proto'] or ''
-    ip = ('nw_src' in kwargs or 'nw_dst' in kwargs) and ',ip' or ''
+    nw_proto = 'nw_proto' in kwargs and ",nw_proto=%s" % kwargs['nw_proto'] or ''
+    tp_dst = 'tp_dst' in kwargs and ",tp_dst=%s" % kwargs['tp_dst'] or ''
+    ip = ('nw_src' in kwargs or 'nw_dst' in kwargs or 'nw_proto' in kwargs) and ',ip' or ''
     flow = (flow + in_port + dl_type + dl_src + dl_dst +
-            (ip or proto) + nw_src + nw_dst)
+            (ip or proto) + nw_src + nw_dst + nw_proto + tp_dst + table)
     return flow
 
 
@@ -379,6 +383,28 @@ def get_acl(vpcconfig, required_acl_id):
             return acl
     return None
 
+def get_port_range_matches(port_start, port_end):
+    """
+    Returns the tp_dst matches covering the ports port_start to port_end with the fewest flows, each one a port or
+    a value/mask prefix. For instance 1024-65535 is matched by 0x0400/0xfc00, 0x0800/0xf800, 0x1000/0xf000,
+    0x2000/0xe000, 0x4000/0xc000 and 0x8000/0x8000.
+    """
+    matches = []
+    port = int(port_start)
+    port_end = int(port_end)
+    while port <= port_end:
+        # the largest block aligned on its size that starts at port and does not go past port_end
+        size = port & -port or 0x10000
+        while size > port_end - port + 1:
+            size = size >> 1
+        if size == 1:
+            matches.append(str(port))
+        else:
+            matches.append("0x%04x/0x%04x" % (port, 0xffff & ~(size - 1)))
+        port = port + size
+    return matches
+
+
 def configure_ovs_bridge_for_routing_policies(bridge, json_config):
     vpconfig = jsonLoader(json.loads(json_config)).vpc
 
@@ -392,6 +418,11 @@ def configure_ovs_bridge_for_routing_policies(bridge, json_config):
     egress_rules_added = False
     ingress_rules_added = False
 
+    # flows keyed by their priority and match, the last ACL item matching the same packets wins as in the bridge
+    flows = {}
+    matches = []
+    per_port_flows = 0
+
     tiers = vpconfig.tiers
     for tier in tiers:
         tier_cidr = tier.cidr
@@ -404,37 +435,50 @@ def configure_ovs_bridge_for_routing_policies(bridge, json_config):
             direction = acl_item.direction
             source_port_start = acl_item.sourceportstart
             source_port_end = acl_item.sourceportend
-            protocol = acl_item.protocol
+            protocol = ACL_PROTOCOLS.get(acl_item.protocol, acl_item.protocol)
             source_cidrs = acl_item.sourcecidrs
             acl_priority = 1000 + number
+            if action == "deny":
+                actions = 'drop'
+            elif action == "allow":
+                actions = 'resubmit(,1)'
+            else:
+                continue
+            if source_port_start is None and source_port_end is None:
+                port_matches = [None]
+                ports = 1
+            else:
+                port_matches = get_port_range_matches(source_port_start, source_port_end)
+                ports = max(0, int(source_port_end) - int(source_port_start) + 1)
             for source_cidr in source_cidrs:
-                if direction is "ingress":
+                if direction == "ingress":
                     ingress_rules_added = True
                     # add flow rule to do action (allow/deny) for flows where source IP of the packet is in
                     # source_cidr and destination ip is in tier_cidr
-                    port = source_port_start
-                    while (port < source_port_end):
-                        if action is "deny":
-                            add_flow(bridge, priority= acl_priority, table=5, nw_src=source_cidr, nw_dst=tier_cidr, tp_dst=port,
-                                     nw_proto=protocol, actions='drop')
-                        if action is "allow":
-                            add_flow(bridge, priority= acl_priority,table=5, nw_src=source_cidr, nw_dst=tier_cidr, tp_dst=port,
-                                     nw_proto=protocol, actions='resubmit(,1)')
-                        port = port + 1
-
-                elif direction in "egress":
+                    nw_src, nw_dst = source_cidr, tier_cidr
+                elif direction == "egress":
                     egress_rules_added = True
                     # add flow rule to do action (allow/deny) for flows where destination IP of the packet is in
                     # source_cidr and source ip is in tier_cidr
-                    port = source_port_start
-                    while (port < source_port_end):
-                        if action is "deny":
-                            add_flow(bridge, priority= acl_priority, table=5, nw_src=tier_cidr, nw_dst=source_cidr, tp_dst=port,
-                                     nw_proto=protocol, actions='drop')
-                        if action is "allow":
-                            add_flow(bridge, priority= acl_priority, table=5, nw_src=tier_cidr, nw_dst=source_cidr, tp_dst=port,
-                                     nw_proto=protocol, actions='resubmit(,1)')
-                        port = port + 1
+                    nw_src, nw_dst = tier_cidr, source_cidr
+                else:
+                    continue
+                per_port_flows = per_port_flows + ports
+                for tp_dst in port_matches:
+                    match = (acl_priority, nw_src, nw_dst, tp_dst, protocol)
+                    if match not in flows:
+                        matches.append(match)
+                    flows[match] = actions
+
+    logging.debug("ACL items of the VPC compiled to %s flows, %s with one flow per port" % (len(matches), per_port_flows))
+    for match in matches:
+        acl_priority, nw_src, nw_dst, tp_dst, protocol = match
+        if tp_dst is None:
+            add_flow(bridge, priority=acl_priority, table=5, nw_src=nw_src, nw_dst=nw_dst,
+                     nw_proto=protocol, actions=flows[match])
+        else:
+            add_flow(bridge, priority=acl_priority, table=5, nw_src=nw_src, nw_dst=nw_dst, tp_dst=tp_dst,
+                     nw_proto=protocol, actions=flows[match])
 
     if egress_rules_added is False:
         # add a default rule in egress table to forward packet to L3 lookup table
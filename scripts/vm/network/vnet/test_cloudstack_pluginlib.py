@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import cloudstack_pluginlib
+
+import imp
+import inspect
+import os
+import random
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+XENSERVER_PLUGINLIB = os.path.join(HERE, '..', '..', 'hypervisor', 'xenserver', 'cloudstack_pluginlib.py')
+
+
+def matched_ports(matches):
+    """ The ports the tp_dst matches of a flow match, in order """
+    ports = []
+    for match in matches:
+        if '/' in match:
+            value, mask = [int(field, 16) for field in match.split('/')]
+            ports.extend(range(value, value + (~mask & 0xffff) + 1))
+        else:
+            ports.append(int(match))
+    return ports
+
+
+class TestPortRangeMatches(unittest.TestCase):
+
+    def test_ranges(self):
+        get_port_range_matches = cloudstack_pluginlib.get_port_range_matches
+        self.assertEqual(get_port_range_matches(0, 65535), ['0x0000/0x0000'])
+        self.assertEqual(get_port_range_matches(22, 22), ['22'])
+        self.assertEqual(get_port_range_matches('1024', '65535'),
+                         ['0x0400/0xfc00', '0x0800/0xf800', '0x1000/0xf000', '0x2000/0xe000', '0x4000/0xc000',
+                          '0x8000/0x8000'])
+        self.assertEqual(get_port_range_matches(1, 6), ['1', '0x0002/0xfffe', '0x0004/0xfffe', '6'])
+        self.assertEqual(get_port_range_matches(10, 9), [])
+
+    def test_coverage(self):
+        r = random.Random(1)
+        for i in range(200):
+            start = r.randint(0, 65535)
+            end = r.randint(start, min(65535, start + r.choice([0, 1, 100, 5000, 65535])))
+            self.assertEqual(matched_ports(cloudstack_pluginlib.get_port_range_matches(start, end)),
+                             range(start, end + 1))
+
+    def test_same_as_xenserver(self):
+        # The xenserver plugins are installed on their own, the library keeps a copy of the function
+        xenserver = imp.load_source('xenserver_cloudstack_pluginlib', XENSERVER_PLUGINLIB)
+        self.assertEqual(inspect.getsource(xenserver.get_port_range_matches),
+                         inspect.getsource(cloudstack_pluginlib.get_port_range_matches))
+
+
+if __name__ == '__main__':
+    unittest.main()
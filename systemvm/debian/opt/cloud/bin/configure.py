@@ -24,11 +24,12 @@ import sys
 import time
 
 from collections import OrderedDict
-from fcntl import flock, LOCK_EX, LOCK_UN
 
 from cs.CsDatabag import CsDataBag
 from cs.CsNetfilter import CsNetfilters
 from cs.CsDhcp import CsDhcp
+from cs.CsFragment import CsFragment
+from cs.CsMetadata import CsMetadataWriter
 from cs.CsRedundant import *
 from cs.CsFile import CsFile
 from cs.CsMonitor import CsMonitor
@@ -36,6 +37,7 @@ from cs.CsLoadBalancer import CsLoadBalancer
 from cs.CsConfig import CsConfig
 from cs.CsProcess import CsProcess
 from cs.CsStaticRoutes import CsStaticRoutes
+from cs.CsTiming import CsTiming
 
 
 class CsPassword(CsDataBag):
@@ -317,156 +319,16 @@ class CsAcl(CsDataBag):
 class CsVmMetadata(CsDataBag):
 
     def process(self):
-        for ip in self.dbag:
-            if ("id" == ip):
-                continue
-            logging.info("Processing metadata for %s" % ip)
-            for item in self.dbag[ip]:
-                folder = item[0]
-                file = item[1]
-                data = item[2]
-
-                # process only valid data
-                if folder != "userdata" and folder != "metadata":
-                    continue
-
-                if file == "":
-                    continue
-
-                self.__htaccess(ip, folder, file)
-
-                if data == "":
-                    self.__deletefile(ip, folder, file)
-                else:
-                    self.__createfile(ip, folder, file, data)
-
-    def __deletefile(self, ip, folder, file):
-        datafile = "/var/www/html/" + folder + "/" + ip + "/" + file
-
-        if os.path.exists(datafile):
-            os.remove(datafile)
-
-    def __createfile(self, ip, folder, file, data):
-        dest = "/var/www/html/" + folder + "/" + ip + "/" + file
-        metamanifestdir = "/var/www/html/" + folder + "/" + ip
-        metamanifest = metamanifestdir + "/meta-data"
-
-        # base64 decode userdata
-        if folder == "userdata" or folder == "user-data":
-            if data is not None:
-                # need to pad data if it is not valid base 64
-                if len(data) % 4 != 0:
-                    data += (4 - (len(data) % 4)) * "="
-                data = base64.b64decode(data)
-
-        fh = open(dest, "w")
-        self.__exflock(fh)
-        if data is not None:
-            fh.write(data)
-        else:
-            fh.write("")
-        self.__unflock(fh)
-        fh.close()
-        os.chmod(dest, 0644)
-
-        if folder == "metadata" or folder == "meta-data":
-            try:
-                os.makedirs(metamanifestdir, 0755)
-            except OSError as e:
-                # error 17 is already exists, we do it this way for concurrency
-                if e.errno != 17:
-                    print "failed to make directories " + metamanifestdir + " due to :" + e.strerror
-                    sys.exit(1)
-            if os.path.exists(metamanifest):
-                fh = open(metamanifest, "r+a")
-                self.__exflock(fh)
-                if file not in fh.read():
-                    fh.write(file + '\n')
-                self.__unflock(fh)
-                fh.close()
-            else:
-                fh = open(metamanifest, "w")
-                self.__exflock(fh)
-                fh.write(file + '\n')
-                self.__unflock(fh)
-                fh.close()
-
-        if os.path.exists(metamanifest):
-            os.chmod(metamanifest, 0644)
-
-    def __htaccess(self, ip, folder, file):
-        entry = "RewriteRule ^" + file + "$  ../" + folder + "/%{REMOTE_ADDR}/" + file + " [L,NC,QSA]"
-        htaccessFolder = "/var/www/html/latest"
-        htaccessFile = htaccessFolder + "/.htaccess"
-
-        CsHelper.mkdir(htaccessFolder, 0755, True)
-
-        if os.path.exists(htaccessFile):
-            fh = open(htaccessFile, "r+a")
-            self.__exflock(fh)
-            if entry not in fh.read():
-                fh.write(entry + '\n')
-            self.__unflock(fh)
-            fh.close()
-        else:
-            fh = open(htaccessFile, "w")
-            self.__exflock(fh)
-            fh.write("Options +FollowSymLinks\nRewriteEngine On\n\n")
-            fh.write(entry + '\n')
-            self.__unflock(fh)
-            fh.close()
-
-        entry = "Options -Indexes\nOrder Deny,Allow\nDeny from all\nAllow from " + ip
-        htaccessFolder = "/var/www/html/" + folder + "/" + ip
-        htaccessFile = htaccessFolder+"/.htaccess"
-
-        try:
-            os.makedirs(htaccessFolder, 0755)
-        except OSError as e:
-            # error 17 is already exists, we do it this way for sake of concurrency
-            if e.errno != 17:
-                print "failed to make directories " + htaccessFolder + " due to :" + e.strerror
-                sys.exit(1)
-
-        fh = open(htaccessFile, "w")
-        self.__exflock(fh)
-        fh.write(entry + '\n')
-        self.__unflock(fh)
-        fh.close()
-
-        if folder == "metadata" or folder == "meta-data":
-            entry = "RewriteRule ^meta-data/(.+)$  ../" + folder + "/%{REMOTE_ADDR}/$1 [L,NC,QSA]"
-            htaccessFolder = "/var/www/html/latest"
-            htaccessFile = htaccessFolder + "/.htaccess"
-
-            fh = open(htaccessFile, "r+a")
-            self.__exflock(fh)
-            if entry not in fh.read():
-                fh.write(entry + '\n')
-
-            entry = "RewriteRule ^meta-data/$  ../" + folder + "/%{REMOTE_ADDR}/meta-data [L,NC,QSA]"
-
-            fh.seek(0)
-            if entry not in fh.read():
-                fh.write(entry + '\n')
-            self.__unflock(fh)
-            fh.close()
-
-    def __exflock(self, file):
-        try:
-            flock(file, LOCK_EX)
-        except IOError as e:
-            print "failed to lock file" + file.name + " due to : " + e.strerror
-            sys.exit(1)  # FIXME
-        return True
-
-    def __unflock(self, file):
+        writer = CsMetadataWriter()
         try:
-            flock(file, LOCK_UN)
-        except IOError as e:
-            print "failed to unlock file" + file.name + " due to : " + e.strerror
-            sys.exit(1)  # FIXME
-        return True
+            for ip in self.dbag:
+                if ("id" == ip):
+                    continue
+                logging.info("Processing metadata for %s" % ip)
+                for item in self.dbag[ip]:
+                    writer.add(ip, item[0], item[1], item[2])
+        finally:
+            writer.commit()
 
 
 class CsSite2SiteVpn(CsDataBag):
@@ -949,37 +811,62 @@ class IpTablesExecutor:
 
     config = None
 
-    def __init__(self, config):
+    def __init__(self, config, force=False):
         self.config = config
+        # Process every databag, even if its cached fragment is still current
+        self.force = force
 
     def process(self):
-        acls = CsAcl('networkacl', self.config)
-        acls.process()
-
-        acls = CsAcl('firewallrules', self.config)
-        acls.process()
-
-        fwd = CsForwardingRules("forwardingrules", self.config)
-        fwd.process()
-
-        vpns = CsSite2SiteVpn("site2sitevpn", self.config)
-        vpns.process()
-
-        rvpn = CsRemoteAccessVpn("remoteaccessvpn", self.config)
-        rvpn.process()
-
-        lb = CsLoadBalancer("loadbalancer", self.config)
-        lb.process()
+        executors = [CsAcl('networkacl', self.config),
+                     CsAcl('firewallrules', self.config),
+                     CsForwardingRules("forwardingrules", self.config),
+                     CsSite2SiteVpn("site2sitevpn", self.config),
+                     CsRemoteAccessVpn("remoteaccessvpn", self.config),
+                     CsLoadBalancer("loadbalancer", self.config)]
+
+        # Only these executors do nothing but generate rules, and the ipsets of the egress
+        # firewall rules. The others also bring up ipsec, xl2tpd or haproxy, so they are
+        # always processed to converge those
+        cacheable = (CsAcl, CsForwardingRules)
+
+        # The generated rules also depend on the interfaces and the router type
+        context = [self.config.address().get_bag(), self.config.cmdline().get_bag()]
+        fw = self.config.get_fw()
+        ipsets = None
+        for executor in executors:
+            key = executor.db.key
+            if not isinstance(executor, cacheable):
+                with CsTiming.measure("iptables %s" % key):
+                    executor.process()
+                continue
+            fragment = CsFragment(key, [executor.get_bag()] + context)
+            current = not self.force and fragment.is_current()
+            # The cached rules are only reused while the ipsets they match on are there
+            if current and fragment.get_ipsets():
+                if ipsets is None:
+                    ipsets = set(CsHelper.execute("ipset list -n"))
+                current = fragment.get_ipsets() <= ipsets
+            if current:
+                logging.info("Fragment %s unchanged, reusing %s cached rules", key, len(fragment.get_rules()))
+                fw.extend(fragment.get_rules())
+                continue
+            start = len(fw)
+            with CsTiming.measure("iptables %s" % key):
+                executor.process()
+            added, removed = fragment.save(fw[start:])
+            logging.info("Fragment %s recomputed, %s rules: %s added, %s removed", key, len(fw) - start, added, removed)
 
         logging.debug("Configuring iptables rules")
-        nf = CsNetfilters()
-        nf.compare(self.config.get_fw())
+        with CsTiming.measure("iptables compare"):
+            nf = CsNetfilters(restore=self.config.use_iptables_restore())
+            nf.compare(self.config.get_fw())
 
         logging.debug("Configuring iptables rules done ...saving rules")
 
         # Save iptables configuration - will be loaded on reboot by the iptables-restore that is configured on /etc/rc.local
-        CsHelper.save_iptables("iptables-save", "/etc/iptables/rules.v4")
-        CsHelper.save_iptables("ip6tables-save", "/etc/iptables/rules.v6")
+        with CsTiming.measure("iptables save"):
+            CsHelper.save_iptables("iptables-save", "/etc/iptables/rules.v4")
+            CsHelper.save_iptables("ip6tables-save", "/etc/iptables/rules.v6")
 
 
 def main(argv):
@@ -990,7 +877,18 @@ def main(argv):
         logging.debug("No file was received, do not go on processing the other actions. Just leave for now.")
         return
 
-    json_type = os.path.basename(process_file).split('.json')[0]
+    return converge([process_file])
+
+
+def converge(process_files):
+    """ Converge the router for a list of already merged json files
+    Addresses, iptables and the redundant state are only processed once
+    """
+    json_types = []
+    for process_file in process_files:
+        json_type = os.path.basename(process_file).split('.json')[0]
+        if json_type not in json_types:
+            json_types.append(json_type)
 
     # The "GLOBAL" Configuration object
     config = CsConfig()
@@ -1003,8 +901,10 @@ def main(argv):
     config.set_address()
 
     logging.debug("Configuring ip addresses")
-    config.address().compare()
-    config.address().process()
+    with CsTiming.measure("address compare"):
+        config.address().compare()
+    with CsTiming.measure("address process"):
+        config.address().process()
 
     databag_map = OrderedDict([("guest_network",     {"process_iptables": True,  "executor": []}),
                                ("vm_password",       {"process_iptables": False, "executor": [CsPassword("vmpassword", config)]}),
@@ -1029,27 +929,35 @@ def main(argv):
             return
         for executor in db[key]['executor']:
             logging.debug("Processing for databag type: %s" % key)
-            executor.process()
+            with CsTiming.measure("process %s" % key):
+                executor.process()
 
-    def execIptables(config):
+    def execIptables(config, force=False):
         logging.debug("Processing iptables rules")
-        iptables_executor = IpTablesExecutor(config)
+        iptables_executor = IpTablesExecutor(config, force)
         iptables_executor.process()
 
-    if json_type == "cmd_line":
+    if "cmd_line" in json_types:
         logging.debug("cmd_line.json changed. All other files will be processed as well.")
         for key in databag_map.keys():
             execDatabag(key, databag_map)
-        execIptables(config)
-    elif json_type in databag_map.keys():
-        execDatabag(json_type, databag_map)
-        if databag_map[json_type]['process_iptables']:
-            execIptables(config)
+        execIptables(config, True)
     else:
-        logging.warn("Unable to find and process databag for file: %s, for json type=%s" % (process_file, json_type))
+        for json_type in json_types:
+            if json_type not in databag_map.keys():
+                logging.warn("Unable to find and process databag for json type=%s" % json_type)
+        process_iptables = False
+        # Follow the databag_map order, whatever the order the files were received in
+        for key in databag_map.keys():
+            if key in json_types:
+                execDatabag(key, databag_map)
+                process_iptables = process_iptables or databag_map[key]['process_iptables']
+        if process_iptables:
+            execIptables(config)
 
     red = CsRedundant(config)
-    red.set()
+    with CsTiming.measure("redundant set"):
+        red.set()
     return 0
 
 
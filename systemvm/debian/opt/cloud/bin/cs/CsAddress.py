@@ -17,11 +17,11 @@
 # under the License.
 import logging
 from netaddr import IPAddress, IPNetwork
-import subprocess
 import time
 import CsHelper
 from CsDatabag import CsDataBag
 from CsApp import CsApache, CsDnsmasq, CsPasswdSvc
+from CsIpBatch import CsIpBatch
 from CsRoute import CsRoute
 from CsRule import CsRule
 
@@ -31,6 +31,8 @@ VRRP_TYPES = ['guest']
 class CsAddress(CsDataBag):
 
     def compare(self):
+        # The changes are applied at the end of process()
+        CsIpBatch.load()
         for dev in CsDevice('', self.config).list():
             ip = CsIP(dev, self.config)
             ip.compare(self.dbag)
@@ -98,6 +100,13 @@ class CsAddress(CsDataBag):
         return None
 
     def process(self):
+        CsIpBatch.load()
+        try:
+            self.process_addresses()
+        finally:
+            CsIpBatch.commit()
+
+    def process_addresses(self):
         for dev in self.dbag:
             if dev == "id":
                 continue
@@ -277,8 +286,7 @@ class CsIP:
         if address["add"]:
             try:
                 logging.info("Configuring address %s on device %s", self.ip(), self.dev)
-                cmd = "ip addr add dev %s %s brd +" % (self.dev, self.ip())
-                CsHelper.execute(cmd)
+                CsIpBatch.add_address(self.dev, self.ip())
             except Exception as e:
                 logging.info("Exception occurred ==> %s" % e)
 
@@ -519,8 +527,8 @@ class CsIP:
             if not self.config.is_vpc():
                 # treat the first IP on a interface as special case to set up the routing rules
                 if self.get_type() in ["public"] and (len(self.iplist) == 1):
-                    CsHelper.execute("sudo ip route add throw " + self.config.address().dbag['eth0'][0]['network'] + " table " + tableName + " proto static")
-                    CsHelper.execute("sudo ip route add throw " + self.config.address().dbag['eth1'][0]['network'] + " table " + tableName + " proto static")
+                    CsIpBatch.route("add throw " + self.config.address().dbag['eth0'][0]['network'] + " table " + tableName + " proto static")
+                    CsIpBatch.route("add throw " + self.config.address().dbag['eth1'][0]['network'] + " table " + tableName + " proto static")
 
                 # add 'defaul via gateway' rule in the device specific routing table
                 if "gateway" in self.address and self.address["gateway"] != "None":
@@ -542,14 +550,14 @@ class CsIP:
 
                 route.add_network_route(self.dev, str(self.address["network"]))
 
-            CsHelper.execute("sudo ip route flush cache")
+            CsIpBatch.route("flush cache")
 
         elif method == "delete":
             # treat the last IP to be dis-associated with interface as special case to clean up the routing rules
             if self.get_type() in ["public"] and (not self.config.is_vpc()) and (len(self.iplist) == 0):
-                CsHelper.execute("sudo ip rule delete table " + tableName)
-                CsHelper.execute("sudo ip route flush table " + tableName)
-                CsHelper.execute("sudo ip route flush cache")
+                CsIpBatch.rule("delete table " + tableName)
+                CsIpBatch.route("flush table " + tableName)
+                CsIpBatch.route("flush cache")
                 CsRule(self.dev).delMark()
 
         self.fw_router()
@@ -591,12 +599,8 @@ class CsIP:
 
     def list(self):
         self.iplist = {}
-        cmd = ("ip addr show dev " + self.dev)
-        for i in CsHelper.execute(cmd):
-            vals = i.lstrip().split()
-            if (vals[0] == 'inet'):
-                cidr = vals[1]
-                self.iplist[cidr] = self.dev
+        for cidr in CsIpBatch.get_addresses(self.dev):
+            self.iplist[cidr] = self.dev
 
     def configured(self):
         if self.address['cidr'] in self.iplist.keys():
@@ -682,8 +686,7 @@ class CsIP:
         else:
             remove.append(ip)
         for ip in remove:
-            cmd = "ip addr del dev %s %s" % (self.dev, ip)
-            subprocess.call(cmd, shell=True)
+            CsIpBatch.del_address(self.dev, ip)
             logging.info("Removed address %s from device %s", ip, self.dev)
             self.post_config_change("delete")
 
@@ -78,6 +78,12 @@ class CsConfig(object):
     def use_extdns(self):
         return self.cmdline().idata().get('useextdns', 'false') == 'true'
 
+    def use_iptables_restore(self):
+        return self.cmdline().idata().get('iptables_restore', 'true') == 'true'
+
+    def use_dnsmasq_hup(self):
+        return self.cmdline().idata().get('dnsmasq_hup', 'true') == 'true'
+
     def get_dns(self):
         conf = self.cmdline().idata()
         dns = []
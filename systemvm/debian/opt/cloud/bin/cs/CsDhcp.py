@@ -26,6 +26,7 @@ LEASES = "/var/lib/misc/dnsmasq.leases"
 DHCP_HOSTS = "/etc/dhcphosts.txt"
 DHCP_OPTS = "/etc/dhcpopts.txt"
 CLOUD_CONF = "/etc/dnsmasq.d/cloud.conf"
+HOSTS = "/etc/hosts"
 
 
 class CsDhcp(CsDataBag):
@@ -40,6 +41,10 @@ class CsDhcp(CsDataBag):
         self.dhcp_opts = CsFile(DHCP_OPTS)
         self.conf = CsFile(CLOUD_CONF)
 
+        # Keep the lease time of the hosts that are already configured,
+        # so that unchanged entries produce the same line
+        self.host_lines = dict((line.strip().rsplit(',', 1)[0], line.strip()) for line in self.cloud.config)
+        self.lines = set()
         self.cloud.repopulate()
         self.dhcp_opts.repopulate()
 
@@ -56,7 +61,8 @@ class CsDhcp(CsDataBag):
         if self.conf.commit():
             restart_dnsmasq = True
 
-        if self.cloud.commit():
+        changed_hosts = self.changed_hosts()
+        if self.cloud.commit() and not self.config.use_dnsmasq_hup():
             restart_dnsmasq = True
 
         self.dhcp_opts.commit()
@@ -67,9 +73,28 @@ class CsDhcp(CsDataBag):
         if not self.cl.is_redundant() or self.cl.is_master():
             if restart_dnsmasq:
                 CsHelper.service("dnsmasq", "restart")
-            else:
-                CsHelper.start_if_stopped("dnsmasq")
-                CsHelper.service("dnsmasq", "reload")
+                return
+            CsHelper.start_if_stopped("dnsmasq")
+            # dnsmasq keeps the leases in memory and does not reread the leases file on
+            # SIGHUP, the leases of removed or changed hosts are released with dhcp_release
+            if changed_hosts and not self.release_leases(changed_hosts):
+                CsHelper.service("dnsmasq", "stop")
+                self.delete_leases(set([mac for mac, ip in changed_hosts] + [ip for mac, ip in changed_hosts]))
+                CsHelper.service("dnsmasq", "start")
+                return
+            # dnsmasq rereads the hosts and options files on SIGHUP (reload)
+            CsHelper.service("dnsmasq", "reload")
+
+    def changed_hosts(self):
+        """ Return the (mac, ip) of the dhcp hosts that were removed or changed """
+        old = set(self.cloud.config)
+        new = set(self.cloud.new_config)
+        changed = set()
+        for line in old - new:
+            fields = line.strip().split(',')
+            changed.add((fields[0], fields[2] if fields[1].startswith('set:') else fields[1]))
+        logging.info("DHCP hosts: %s added, %s removed or changed", len(new - old), len(old - new))
+        return changed
 
     def configure_server(self):
         # self.conf.addeq("dhcp-hostsfile=%s" % DHCP_HOSTS)
@@ -113,9 +138,44 @@ class CsDhcp(CsDataBag):
             self.conf.search(sline, line)
             idx += 1
 
-    def delete_leases(self):
+    def release_leases(self, hosts):
+        """ Release the leases held by the given (mac, ip) hosts with dhcp_release
+        Returns False if a lease could not be released
+        """
+        macs = set([mac for mac, ip in hosts])
+        ips = set([ip for mac, ip in hosts])
+        try:
+            leases = [line.split() for line in open(LEASES)]
+        except IOError:
+            return True
+        released = True
+        for fields in leases:
+            if len(fields) < 3 or (fields[1] not in macs and fields[2] not in ips):
+                continue
+            mac, ip = fields[1], fields[2]
+            device = None
+            for v in self.devinfo:
+                if IPAddress(ip) in v['network']:
+                    device = v['dev']
+            if device is None or CsHelper.execute2("dhcp_release %s %s %s" % (device, ip, mac)).returncode != 0:
+                logging.error("Could not release the dhcp lease of %s %s", mac, ip)
+                released = False
+        return released
+
+    def delete_leases(self, entries=None):
+        """ Delete the leases of the given macs and ips, or all of them """
         try:
-            open(LEASES, 'w').close()
+            if entries is None:
+                open(LEASES, 'w').close()
+                return
+            keep = []
+            for line in open(LEASES):
+                fields = line.split()
+                if len(fields) > 2 and (fields[1] in entries or fields[2] in entries):
+                    continue
+                keep.append(line)
+            with open(LEASES, 'w') as leases:
+                leases.writelines(keep)
         except IOError:
             return
 
@@ -128,10 +188,11 @@ class CsDhcp(CsDataBag):
             self.add_host(self.config.address().get_guest_ip(), "%s data-server" % CsHelper.get_hostname())
 
     def write_hosts(self):
-        file = CsFile("/etc/hosts")
+        file = CsFile(HOSTS)
         file.repopulate()
+        # One line per ip, no need to check for duplicates
         for ip in self.hosts:
-            file.add("%s\t%s" % (ip, self.hosts[ip]))
+            file.append("%s\t%s" % (ip, self.hosts[ip]))
         if file.is_changed():
             file.commit()
             logging.info("Updated hosts file")
@@ -140,25 +201,20 @@ class CsDhcp(CsDataBag):
 
     def add(self, entry):
         self.add_host(entry['ipv4_address'], entry['host_name'])
-        # lease time boils down to once a month
-        # with a splay of 60 hours to prevent storms
-        lease = randint(700, 760)
 
         if entry['default_entry']:
-            self.cloud.add("%s,%s,%s,%sh" % (entry['mac_address'],
-                                             entry['ipv4_address'],
-                                             entry['host_name'],
-                                             lease))
+            self.add_line(self.cloud, "%s,%s,%s" % (entry['mac_address'],
+                                                    entry['ipv4_address'],
+                                                    entry['host_name']))
         else:
             tag = entry['ipv4_address'].replace(".", "_")
-            self.cloud.add("%s,set:%s,%s,%s,%sh" % (entry['mac_address'],
-                                                    tag,
-                                                    entry['ipv4_address'],
-                                                    entry['host_name'],
-                                                    lease))
-            self.dhcp_opts.add("%s,%s" % (tag, 3))
-            self.dhcp_opts.add("%s,%s" % (tag, 6))
-            self.dhcp_opts.add("%s,%s" % (tag, 15))
+            self.add_line(self.cloud, "%s,set:%s,%s,%s" % (entry['mac_address'],
+                                                           tag,
+                                                           entry['ipv4_address'],
+                                                           entry['host_name']))
+            self.add_line(self.dhcp_opts, "%s,%s" % (tag, 3))
+            self.add_line(self.dhcp_opts, "%s,%s" % (tag, 6))
+            self.add_line(self.dhcp_opts, "%s,%s" % (tag, 15))
 
         i = IPAddress(entry['ipv4_address'])
         # Calculate the device
@@ -168,5 +224,20 @@ class CsDhcp(CsDataBag):
                 # Virtual Router
                 v['gateway'] = entry['default_gateway']
 
+    def add_line(self, file, line):
+        """ Add a line to the hosts or options file
+        Host lines get the lease time they already had, or a new one
+        """
+        if file is self.cloud:
+            if line in self.host_lines:
+                line = self.host_lines[line]
+            else:
+                # lease time boils down to once a month
+                # with a splay of 60 hours to prevent storms
+                line = "%s,%sh" % (line, randint(700, 760))
+        if line not in self.lines:
+            self.lines.add(line)
+            file.append(line)
+
     def add_host(self, ip, hosts):
         self.hosts[ip] = hosts
@@ -0,0 +1,91 @@
+# -- coding: utf-8 --
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+import hashlib
+import json
+import logging
+import os
+import re
+
+
+class CsFragment(object):
+    """ The iptables rules generated from one databag
+
+    The rules are cached on disk together with a fingerprint of the data
+    they were generated from. When the fingerprint has not changed the
+    cached rules can be used instead of processing the databag again.
+    """
+
+    FRAGMENT_DIR = "/var/cache/cloud/iptables"
+    BOOT_ID = "/proc/sys/kernel/random/boot_id"
+
+    def __init__(self, key, sources):
+        self.key = key
+        self.fpath = os.path.join(self.FRAGMENT_DIR, key + '.json')
+        self.fingerprint = self.compute_fingerprint(sources)
+        self.cached = self.load()
+
+    def compute_fingerprint(self, sources):
+        """ Fingerprint the databags the rules depend on
+        The boot id is part of it, so that a reboot starts from scratch
+        """
+        try:
+            boot_id = open(self.BOOT_ID).read().strip()
+        except IOError:
+            boot_id = ""
+        md5 = hashlib.md5()
+        md5.update(json.dumps([boot_id] + sources, sort_keys=True))
+        return md5.hexdigest()
+
+    def load(self):
+        try:
+            with open(self.fpath, 'r') as _fh:
+                return json.load(_fh)
+        except (IOError, ValueError):
+            logging.debug("No cached iptables fragment for %s", self.key)
+        return None
+
+    def is_current(self):
+        return self.cached is not None and self.cached.get('fingerprint') == self.fingerprint
+
+    def get_rules(self):
+        if self.cached is None:
+            return []
+        return self.cached['rules']
+
+    def get_ipsets(self):
+        """ The ipsets the cached rules match on """
+        names = set()
+        for rule in self.get_rules():
+            names.update(re.findall(r'--match-set (\S+)', rule[2]))
+        return names
+
+    def save(self, rules):
+        """ Store the rules, returns the number of (added, removed) rules """
+        old = set([tuple(r) for r in self.get_rules()])
+        new = set([tuple(r) for r in rules])
+        if not os.path.exists(self.FRAGMENT_DIR):
+            os.makedirs(self.FRAGMENT_DIR)
+        tmp = self.fpath + '.tmp'
+        try:
+            with open(tmp, 'w') as _fh:
+                json.dump({'fingerprint': self.fingerprint, 'rules': rules}, _fh)
+            os.rename(tmp, self.fpath)
+        except IOError:
+            logging.error("Could not write iptables fragment %s", self.key)
+        self.cached = {'fingerprint': self.fingerprint, 'rules': rules}
+        return len(new - old), len(old - new)
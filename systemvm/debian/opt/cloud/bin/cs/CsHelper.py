@@ -25,7 +25,9 @@ import sys
 import os.path
 import re
 import shutil
+import time
 from netaddr import *
+from CsTiming import CsTiming
 
 PUBLIC_INTERFACES = {"router": "eth2", "vpcrouter": "eth1"}
 
@@ -34,24 +36,23 @@ STATE_COMMANDS = {"router": "ip addr | grep eth0 | grep inet | wc -l | xargs bas
 
 
 def reconfigure_interfaces(router_config, interfaces):
+    # CsIpBatch uses this module, import it late
+    from CsIpBatch import CsIpBatch
     for interface in interfaces:
-        cmd = "ip link show %s | grep 'state DOWN'" % interface.get_device()
-        for device in execute(cmd):
-            if " DOWN " in device:
-                cmd = "ip link set %s up" % interface.get_device()
-                # If redundant only bring up public interfaces that are not eth1.
-                # Reason: private gateways are public interfaces.
-                # master.py and keepalived will deal with eth1 public interface.
-
-                if router_config.is_redundant() and interface.is_public():
-                    state_cmd = STATE_COMMANDS[router_config.get_type()]
-                    logging.info("Check state command => %s" % state_cmd)
-                    state = execute(state_cmd)[0]
-                    logging.info("Route state => %s" % state)
-                    if interface.get_device() != PUBLIC_INTERFACES[router_config.get_type()] and state == "MASTER":
-                        execute(cmd)
-                else:
-                    execute(cmd)
+        if CsIpBatch.is_link_down(interface.get_device()):
+            # If redundant only bring up public interfaces that are not eth1.
+            # Reason: private gateways are public interfaces.
+            # master.py and keepalived will deal with eth1 public interface.
+
+            if router_config.is_redundant() and interface.is_public():
+                state_cmd = STATE_COMMANDS[router_config.get_type()]
+                logging.info("Check state command => %s" % state_cmd)
+                state = execute(state_cmd)[0]
+                logging.info("Route state => %s" % state)
+                if interface.get_device() != PUBLIC_INTERFACES[router_config.get_type()] and state == "MASTER":
+                    CsIpBatch.set_link_up(interface.get_device())
+            else:
+                CsIpBatch.set_link_up(interface.get_device())
 
 
 def is_mounted(name):
@@ -184,6 +185,7 @@ def get_hostname():
 def execute(command):
     """ Execute command """
     returncode = -1
+    start = time.time()
     try:
         logging.info("Executing: %s" % command)
         result = subprocess.check_output(command, shell=True)
@@ -195,6 +197,7 @@ def execute(command):
         logging.error(e)
         returncode = e.returncode
     finally:
+        CsTiming.add_command(time.time() - start)
         logging.debug("Executed: %s - exitstatus=%s " % (command, returncode))
 
     return list()
@@ -216,11 +219,28 @@ def save_iptables(command, iptables_file):
 def execute2(command):
     """ Execute command """
     logging.debug("Executing: %s" % command)
+    start = time.time()
     p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
     p.wait()
+    CsTiming.add_command(time.time() - start)
     return p
 
 
+def execute_stdin(command, data):
+    """ Execute command with data as its standard input
+    Returns True if the command succeeded
+    """
+    logging.debug("Executing: %s" % command)
+    start = time.time()
+    p = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+    result = p.communicate(data)
+    CsTiming.add_command(time.time() - start)
+    if p.returncode != 0:
+        logging.error("Command [%s] failed with exitstatus=%s [%s]" % (command, p.returncode, result[1]))
+        return False
+    return True
+
+
 def service(name, op):
     execute("systemctl %s %s" % (op, name))
     logging.info("Service %s %s" % (name, op))
@@ -0,0 +1,233 @@
+# -- coding: utf-8 --
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+import logging
+import CsHelper
+
+ROUTE_TYPES = ['unicast', 'local', 'broadcast', 'multicast', 'throw', 'unreachable',
+               'prohibit', 'blackhole', 'nat', 'anycast']
+ROUTE_FLAGS = ['onlink', 'linkdown', 'pervasive', 'dead', 'notify']
+RULE_KEYS = ['from', 'to', 'fwmark', 'lookup', 'iif', 'oif', 'tos', 'priority']
+
+
+def parse_route(line):
+    """ Parse a route as printed by "ip route show" or given to "ip route add" """
+    vals = line.split()
+    route = {'type': 'unicast', 'table': 'main'}
+    if vals and vals[0] in ROUTE_TYPES:
+        route['type'] = vals.pop(0)
+    if not vals:
+        return route
+    prefix = vals.pop(0)
+    if prefix in ('0/0', '0.0.0.0/0'):
+        prefix = 'default'
+    elif prefix.endswith('/32'):
+        prefix = prefix[:-3]
+    route['prefix'] = prefix
+    while vals:
+        key = vals.pop(0)
+        if key in ROUTE_FLAGS or not vals:
+            continue
+        route[key] = vals.pop(0)
+    return route
+
+
+def parse_rule(line):
+    """ Parse a rule as printed by "ip rule show" or given to "ip rule add" """
+    vals = line.split()
+    rule = {}
+    if vals and vals[0].endswith(':'):
+        rule['priority'] = vals.pop(0)[:-1]
+    while len(vals) > 1:
+        key = vals.pop(0)
+        key = {'table': 'lookup', 'pref': 'priority', 'prio': 'priority'}.get(key, key)
+        if key not in RULE_KEYS:
+            continue
+        value = vals.pop(0)
+        if key == 'fwmark':
+            value = hex(int(value.split('/')[0], 0))
+        rule[key] = value
+    return rule
+
+
+class CsIpBatch(object):
+    """ A view of the addresses, links, rules and routes of the router
+
+    Between load() and commit() the state is read once and the changes to
+    the rules and routes are queued and applied with a single "ip -batch".
+    Address and link changes are executed at once, as the commands that
+    follow them (arping, services) need them, but they are recorded in
+    the view so that it does not have to be read again.
+
+    Outside of a batch every call reads or changes the system directly.
+    """
+
+    active = False
+    addresses = {}
+    links = {}
+    rules = []
+    routes = []
+    pending = []
+    flush_cache = False
+
+    @classmethod
+    def load(cls):
+        """ Start a batch, the system is read only when no batch is running """
+        if cls.active:
+            return
+        cls.addresses = cls.read_addresses()
+        cls.links = cls.read_links()
+        cls.rules = cls.read_rules()
+        cls.routes = cls.read_routes()
+        cls.pending = []
+        cls.flush_cache = False
+        cls.active = True
+
+    @classmethod
+    def commit(cls):
+        """ Apply the queued rule and route changes and end the batch """
+        pending = cls.pending
+        if cls.flush_cache:
+            pending.append("route flush cache")
+        cls.active = False
+        cls.pending = []
+        if not pending:
+            return True
+        logging.info("Applying %s ip rule and route changes" % len(pending))
+        return CsHelper.execute_stdin("ip -force -batch -", "".join(cmd + "\n" for cmd in pending))
+
+    @staticmethod
+    def read_addresses():
+        """ The ipv4 addresses (cidr) of every device """
+        addresses = {}
+        for line in CsHelper.execute("ip -o -4 addr show"):
+            vals = line.split()
+            if len(vals) < 4 or vals[2] != 'inet':
+                continue
+            addresses.setdefault(vals[1].split('@')[0], []).append(vals[3])
+        return addresses
+
+    @staticmethod
+    def read_links():
+        """ The state of every device """
+        links = {}
+        for line in CsHelper.execute("ip -o link show"):
+            vals = line.split()
+            if len(vals) < 2:
+                continue
+            dev = vals[1].rstrip(':').split('@')[0]
+            links[dev] = vals[vals.index('state') + 1] if 'state' in vals[:-1] else 'UNKNOWN'
+        return links
+
+    @staticmethod
+    def read_rules():
+        return [line.strip() for line in CsHelper.execute("ip rule show")]
+
+    @staticmethod
+    def read_routes():
+        return [parse_route(line) for line in CsHelper.execute("ip -4 route show table all")]
+
+    @classmethod
+    def get_addresses(cls, dev):
+        if not cls.active:
+            return cls.read_addresses().get(dev, [])
+        return list(cls.addresses.get(dev, []))
+
+    @classmethod
+    def is_link_down(cls, dev):
+        links = cls.links if cls.active else cls.read_links()
+        return links.get(dev) == 'DOWN'
+
+    @classmethod
+    def get_rules(cls):
+        if not cls.active:
+            return cls.read_rules()
+        return cls.rules
+
+    @classmethod
+    def find_route(cls, selector):
+        """ Return True if a route matches the selector of "ip route show" """
+        search = parse_route(selector)
+        routes = cls.routes if cls.active else cls.read_routes()
+        for route in routes:
+            if all(route.get(key) == value for key, value in search.items()):
+                return True
+        return False
+
+    @classmethod
+    def add_address(cls, dev, cidr):
+        CsHelper.execute("ip addr add dev %s %s brd +" % (dev, cidr))
+        if cls.active and cidr not in cls.addresses.setdefault(dev, []):
+            cls.addresses[dev].append(cidr)
+
+    @classmethod
+    def del_address(cls, dev, cidr):
+        CsHelper.execute("ip addr del dev %s %s" % (dev, cidr))
+        if cls.active and cidr in cls.addresses.get(dev, []):
+            cls.addresses[dev].remove(cidr)
+
+    @classmethod
+    def set_link_up(cls, dev):
+        CsHelper.execute("ip link set %s up" % dev)
+        if cls.active:
+            cls.links[dev] = 'UP'
+
+    @classmethod
+    def rule(cls, cmd):
+        """ Add or delete a rule, cmd is given as to "ip rule" """
+        if not cls.active:
+            CsHelper.execute("ip rule " + cmd)
+            return
+        cls.pending.append("rule " + cmd)
+        method, selector = cmd.split(None, 1)
+        rule = parse_rule(selector)
+        if method == "add":
+            rule.setdefault('from', 'all')
+            cls.rules.append(" ".join(["%s %s" % (key, rule[key]) for key in RULE_KEYS if key in rule and key != 'priority']))
+            return
+        # "ip rule delete" removes the first matching rule only, "from all" matches any source
+        if rule.get('from') == 'all':
+            del rule['from']
+        for line in cls.rules:
+            current = parse_rule(line)
+            if all(current.get(key) == value for key, value in rule.items()):
+                cls.rules.remove(line)
+                break
+
+    @classmethod
+    def route(cls, cmd):
+        """ Add, delete or flush routes, cmd is given as to "ip route" """
+        if not cls.active:
+            CsHelper.execute("ip route " + cmd)
+            return
+        if cmd == "flush cache":
+            # Once, at the end of the batch
+            cls.flush_cache = True
+            return
+        cls.pending.append("route " + cmd)
+        method, selector = cmd.split(None, 1)
+        if method == "add":
+            cls.routes.append(parse_route(selector))
+        elif method == "flush":
+            table = parse_route("0/0 " + selector)['table']
+            cls.routes = [r for r in cls.routes if r['table'] != table]
+        elif method in ("delete", "del"):
+            search = parse_route(selector)
+            for route in cls.routes:
+                if all(route.get(key) == value for key, value in search.items()):
+                    cls.routes.remove(route)
+                    break
@@ -0,0 +1,127 @@
+# -- coding: utf-8 --
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+import base64
+import logging
+import os
+from fcntl import flock, LOCK_EX, LOCK_UN
+import CsHelper
+
+
+class CsMetadataWriter(object):
+    """ Write the metadata and userdata files of many VMs in one go
+
+    Files are replaced through a temporary file and a rename, and only
+    when their content changed. The rewrite rules of latest/.htaccess
+    are collected and the file is written once, in commit().
+    """
+
+    HTML = "/var/www/html"
+    LOCK = "/var/lock/cloud_vmdata.lock"
+    HTACCESS_HEADER = "Options +FollowSymLinks\nRewriteEngine On\n\n"
+
+    def __init__(self, rewrite_rules=True):
+        # Maintain the rewrite rules in latest/.htaccess
+        self.rewrite_rules = rewrite_rules
+        self.rules = []
+        self.manifests = {}
+        self.written = 0
+        self.unchanged = 0
+        self.lock = open(self.LOCK, "a")
+        flock(self.lock, LOCK_EX)
+
+    def add(self, ip, folder, file, data):
+        # process only valid data
+        if folder != "userdata" and folder != "metadata":
+            return
+        if file == "":
+            return
+
+        vmfolder = os.path.join(self.HTML, folder, ip)
+        CsHelper.mkdir(vmfolder, 0755, True)
+        self.write(os.path.join(vmfolder, ".htaccess"), "Options -Indexes\nOrder Deny,Allow\nDeny from all\nAllow from " + ip + "\n")
+
+        if self.rewrite_rules:
+            self.rules.append("RewriteRule ^" + file + "$  ../" + folder + "/%{REMOTE_ADDR}/" + file + " [L,NC,QSA]")
+            if folder == "metadata":
+                self.rules.append("RewriteRule ^meta-data/(.+)$  ../" + folder + "/%{REMOTE_ADDR}/$1 [L,NC,QSA]")
+                self.rules.append("RewriteRule ^meta-data/$  ../" + folder + "/%{REMOTE_ADDR}/meta-data [L,NC,QSA]")
+
+        dest = os.path.join(vmfolder, file)
+        if data == "":
+            CsHelper.rm(dest)
+            return
+
+        # base64 decode userdata
+        if folder == "userdata" and data is not None:
+            # need to pad data if it is not valid base 64
+            if len(data) % 4 != 0:
+                data += (4 - (len(data) % 4)) * "="
+            data = base64.b64decode(data)
+        self.write(dest, data or "")
+
+        if folder == "metadata":
+            self.manifest(os.path.join(vmfolder, "meta-data")).append(file)
+
+    def manifest(self, path):
+        """ The list of files in a meta-data manifest, read once """
+        if path not in self.manifests:
+            self.manifests[path] = self.read(path).splitlines()
+        return self.manifests[path]
+
+    def commit(self):
+        """ Write the manifests and latest/.htaccess, then release the lock """
+        try:
+            for path, files in self.manifests.items():
+                seen = set()
+                lines = [f for f in files if not (f in seen or seen.add(f))]
+                self.write(path, "".join(line + "\n" for line in lines))
+
+            if self.rules:
+                htaccess = os.path.join(self.HTML, "latest", ".htaccess")
+                CsHelper.mkdir(os.path.dirname(htaccess), 0755, True)
+                content = self.read(htaccess) or self.HTACCESS_HEADER
+                existing = set(content.splitlines())
+                for rule in self.rules:
+                    if rule not in existing:
+                        existing.add(rule)
+                        content += rule + "\n"
+                self.write(htaccess, content)
+        finally:
+            flock(self.lock, LOCK_UN)
+            self.lock.close()
+        logging.info("VM metadata: %s files written, %s unchanged", self.written, self.unchanged)
+
+    def read(self, path):
+        try:
+            with open(path) as fh:
+                return fh.read()
+        except IOError:
+            return ""
+
+    def write(self, path, content):
+        """ Replace the file if its content changed, returns True if it was written """
+        if os.path.exists(path) and self.read(path) == content:
+            self.unchanged += 1
+            return False
+        tmp = path + ".tmp"
+        with open(tmp, "w") as fh:
+            fh.write(content)
+        os.chmod(tmp, 0644)
+        os.rename(tmp, path)
+        self.written += 1
+        return True
@@ -17,6 +17,7 @@
 # under the License.
 import CsHelper
 from CsDatabag import CsCmdLine
+from collections import OrderedDict
 import logging
 
 
@@ -78,10 +79,16 @@ class CsTable(object):
 
 class CsNetfilters(object):
 
-    def __init__(self, load=True):
+    def __init__(self, load=True, restore=False):
         self.rules = []
+        # Live rules indexed by CsNetfilter.get_key(), in iptables-save order
+        self.index = {}
         self.table = CsTable()
         self.chain = CsChain()
+        # When restore is set, rule changes are queued per table and applied
+        # with a single iptables-restore --noflush transaction in commit()
+        self.restore = restore
+        self.batch = OrderedDict()
         if load:
             self.get_all_rules()
 
@@ -102,6 +109,7 @@ class CsNetfilters(object):
 
     def save(self, rule):
         self.rules.append(rule)
+        self.index.setdefault(rule.get_key(), []).append(rule)
 
     def get(self):
         return self.rules
@@ -113,17 +121,22 @@ class CsNetfilters(object):
         return self.chain.has_chain(table, chain)
 
     def has_rule(self, new_rule):
-        for r in self.get():
-            if new_rule == r:
-                if new_rule.get_count() > 0:
-                    continue
-                r.mark_seen()
-                return True
-        return False
+        # Rules with a position are always inserted
+        if new_rule.get_count() > 0:
+            return False
+        matches = self.index.get(new_rule.get_key())
+        if not matches:
+            return False
+        matches[0].mark_seen()
+        return True
 
     def get_unseen(self):
         del_list = [x for x in self.rules if x.unseen()]
         for r in del_list:
+            if self.restore:
+                self.queue(r.get_table(), r.to_str(True))
+                logging.info("Delete rule %s from table %s", r.to_str(True), r.get_table())
+                continue
             cmd = "iptables -t %s %s" % (r.get_table(), r.to_str(True))
             logging.debug("unseen cmd:  %s ", cmd)
             CsHelper.execute(cmd)
@@ -172,6 +185,11 @@ class CsNetfilters(object):
                         cpy = cpy.replace("-A %s" % new_rule.get_chain(), '-I %s %s' % (new_rule.get_chain(), rule_count))
                     else:
                         cpy = cpy.replace("-A %s" % new_rule.get_chain(), '-I %s %s' % (new_rule.get_chain(), fw[1]))
+                if self.restore:
+                    self.queue(new_rule.get_table(), cpy)
+                    ruleSet.add(tupledFw)
+                    self.chain.add_rule(rule_chain)
+                    continue
                 ret = CsHelper.execute2("iptables -t %s %s" % (new_rule.get_table(), cpy))
                 # There are some issues in this framework causing failures  .. like adding a chain without checking it is present causing
                 # the failures. Also some of the rule like removeFromLoadBalancerRule is deleting rule and deleteLoadBalancerRule
@@ -185,13 +203,55 @@ class CsNetfilters(object):
                 self.chain.add_rule(rule_chain)
         self.del_standard()
         self.get_unseen()
+        self.commit()
 
     def add_chain(self, rule):
         """ Add the given chain if it is not already present """
         if not self.has_chain(rule.get_table(), rule.get_chain()):
+            if self.restore:
+                self.queue(rule.get_table(), "-N %s" % rule.get_chain())
+                return
             CsHelper.execute("iptables -t %s -N %s" % (rule.get_table(), rule.get_chain()))
             self.chain.add(rule.get_table(), rule.get_chain())
 
+    def queue(self, table, rule):
+        """ Queue an iptables command for the given table
+        The command is only applied when commit() is called
+        """
+        bits = rule.split()
+        # The table is given by the restore header, drop any -t option
+        while '-t' in bits:
+            i = bits.index('-t')
+            del bits[i:i + 2]
+        if not bits:
+            return
+        # Explicit chain creation fails the whole transaction if it exists already
+        if bits[0] == '-N':
+            if len(bits) < 2 or self.has_chain(table, bits[1]):
+                return
+            self.chain.add(table, bits[1])
+        self.batch.setdefault(table, []).append(' '.join(bits))
+
+    def commit(self):
+        """ Apply the queued commands, one iptables-restore transaction per table
+        If a transaction is rejected nothing of it is applied, so the commands
+        of that table are replayed one by one like in the per rule mode
+        """
+        for table in self.batch.keys():
+            rules = self.batch[table]
+            if not rules:
+                continue
+            data = "*%s\n%s\nCOMMIT\n" % (table, "\n".join(rules))
+            logging.info("Applying %s iptables commands to table %s with iptables-restore", len(rules), table)
+            if CsHelper.execute_stdin("iptables-restore --noflush", data):
+                continue
+            logging.warn("iptables-restore failed for table %s, falling back to one command per rule", table)
+            for rule in rules:
+                ret = CsHelper.execute2("iptables -t %s %s" % (table, rule))
+                if ret.returncode != 0:
+                    logging.debug("iptables command got failed ... continuing")
+        self.batch = OrderedDict()
+
     def del_standard(self):
         """ Del rules that are there but should not be deleted
         These standard firewall rules vary according to the device type
@@ -219,7 +279,8 @@ class CsNetfilters(object):
     def delete(self, rule):
         """ Delete a rule from the list of configured rules
         The rule will not actually be removed on the host """
-        self.rules[:] = [x for x in self.rules if not x == rule]
+        if self.index.pop(rule.get_key(), None):
+            self.rules[:] = [x for x in self.rules if not x == rule]
 
 
 class CsNetfilter(object):
@@ -280,6 +341,10 @@ class CsNetfilter(object):
     def get_rule(self):
         return self.rule
 
+    def get_key(self):
+        """ Hashable key, rules that compare equal have the same key """
+        return (self.get_table(), self.get_chain(), frozenset(self.get_rule().items()))
+
     def to_str(self, delete=False):
         """ Convert the rule back into aynactically correct iptables command """
         # Order is important
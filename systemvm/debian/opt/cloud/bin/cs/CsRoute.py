@@ -17,6 +17,7 @@
 # under the License.
 import CsHelper
 import logging
+from CsIpBatch import CsIpBatch
 
 
 class CsRoute:
@@ -40,11 +41,11 @@ class CsRoute:
         # remove "from all table tablename" if exists, else it will interfer with
         # routing of unintended traffic
         if self.findRule("from all lookup " + tablename):
-            CsHelper.execute("sudo ip rule delete from all table " + tablename)
+            CsIpBatch.rule("delete from all table " + tablename)
 
     def flush_table(self, tablename):
-        CsHelper.execute("ip route flush table %s" % (tablename))
-        CsHelper.execute("ip route flush cache")
+        CsIpBatch.route("flush table %s" % (tablename))
+        CsIpBatch.route("flush cache")
 
     def add_route(self, dev, address):
         """ Wrapper method that adds table name and device to route statement """
@@ -67,21 +68,14 @@ class CsRoute:
 
     def set_route(self, cmd, method="add"):
         """ Add a route if it is not already defined """
-        found = False
-        search = cmd
-        if "throw" in search:
-            search = "type " + search
-        for i in CsHelper.execute("ip route show " + search):
-            found = True
+        found = CsIpBatch.find_route(cmd)
         if not found and method == "add":
             logging.info("Add " + cmd)
-            cmd = "ip route add " + cmd
         elif found and method == "delete":
             logging.info("Delete " + cmd)
-            cmd = "ip route delete " + cmd
         else:
             return
-        CsHelper.execute(cmd)
+        CsIpBatch.route(method + " " + cmd)
 
     def add_defaultroute(self, gateway):
         """  Add a default route
@@ -104,17 +98,15 @@ class CsRoute:
         :return: bool
         """
         logging.info("Checking if default ipv4 route is present")
-        route_found = CsHelper.execute("ip -4 route list 0/0")
-
-        if len(route_found) > 0:
-            logging.info("Default route found: " + route_found[0])
+        if CsIpBatch.find_route("default"):
+            logging.info("Default route found")
             return True
         else:
             logging.warn("No default route found!")
             return False
 
     def findRule(self, rule):
-        for i in CsHelper.execute("ip rule show"):
-            if rule in i.strip():
+        for i in CsIpBatch.get_rules():
+            if rule in i:
                 return True
         return False
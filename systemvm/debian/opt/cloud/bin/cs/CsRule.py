@@ -15,8 +15,8 @@
 # KIND, either express or implied.  See the License for the
 # specific language governing permissions and limitations
 # under the License.
-import CsHelper
 import logging
+from CsIpBatch import CsIpBatch
 
 
 class CsRule:
@@ -32,31 +32,31 @@ class CsRule:
 
     def addRule(self, rule):
         if not self.findRule(rule + " lookup " + self.table):
-            cmd = "ip rule add " + rule + " table " + self.table
-            CsHelper.execute(cmd)
+            cmd = "add " + rule + " table " + self.table
+            CsIpBatch.rule(cmd)
             logging.info("Added rule %s for %s" % (cmd, self.table))
 
     def findRule(self, rule):
-        for i in CsHelper.execute("ip rule show"):
-            if rule in i.strip():
+        for i in CsIpBatch.get_rules():
+            if rule in i:
                 return True
         return False
 
     def addMark(self):
         if not self.findMark():
-            cmd = "ip rule add fwmark %s table %s" % (self.tableNo, self.table)
-            CsHelper.execute(cmd)
+            cmd = "add fwmark %s table %s" % (self.tableNo, self.table)
+            CsIpBatch.rule(cmd)
             logging.info("Added fwmark rule for %s" % (self.table))
 
     def delMark(self):
         if self.findMark():
-            cmd = "ip rule delete fwmark %s table %s" % (self.tableNo, self.table)
-            CsHelper.execute(cmd)
+            cmd = "delete fwmark %s table %s" % (self.tableNo, self.table)
+            CsIpBatch.rule(cmd)
             logging.info("Deleting fwmark rule for %s" % (self.table))
 
     def findMark(self):
         srch = "from all fwmark %s lookup %s" % (hex(self.tableNo), self.table)
-        for i in CsHelper.execute("ip rule show"):
-            if srch in i.strip():
+        for i in CsIpBatch.get_rules():
+            if srch in i:
                 return True
         return False
@@ -0,0 +1,109 @@
+# -- coding: utf-8 --
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+
+class CsTiming(object):
+    """ Where the time goes during one run of the configuration scripts
+
+    Steps are timed with measure(), the commands run through CsHelper are
+    counted. end() appends a json summary of the run to SUMMARY and, when
+    profiling was requested, writes a cProfile dump next to it. Only the
+    last PROFILE_KEEP dumps are kept, SUMMARY is rotated by logrotate.
+    """
+
+    LOG_DIR = "/var/log/cloud"
+    SUMMARY = os.path.join(LOG_DIR, "vr_timings.log")
+    # Set to any value to profile every run
+    PROFILE_ENV = "VR_PROFILE"
+    PROFILE_KEEP = 10
+
+    started = time.time()
+    args = []
+    steps = []
+    commands = 0
+    command_time = 0.0
+    profiler = None
+
+    @classmethod
+    def begin(cls, args, profile=False):
+        cls.started = time.time()
+        cls.args = list(args)
+        cls.steps = []
+        cls.commands = 0
+        cls.command_time = 0.0
+        cls.profiler = None
+        if profile or os.environ.get(cls.PROFILE_ENV):
+            import cProfile
+            cls.profiler = cProfile.Profile()
+            cls.profiler.enable()
+
+    @classmethod
+    @contextmanager
+    def measure(cls, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            cls.steps.append({"name": name, "seconds": round(time.time() - start, 4)})
+
+    @classmethod
+    def add_command(cls, seconds):
+        """ Account for one command run in a subprocess """
+        cls.commands += 1
+        cls.command_time += seconds
+
+    @classmethod
+    def summary(cls):
+        return {"started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(cls.started)),
+                "args": cls.args,
+                "seconds": round(time.time() - cls.started, 4),
+                "steps": cls.steps,
+                "subprocesses": {"count": cls.commands, "seconds": round(cls.command_time, 4)}}
+
+    @classmethod
+    def end(cls):
+        """ Write the summary, and the profile if one was taken """
+        summary = cls.summary()
+        logging.info("Run took %ss, %s subprocesses took %ss", summary["seconds"], cls.commands, summary["subprocesses"]["seconds"])
+        try:
+            if not os.path.isdir(cls.LOG_DIR):
+                os.makedirs(cls.LOG_DIR)
+            with open(cls.SUMMARY, "a") as fh:
+                fh.write(json.dumps(summary) + "\n")
+            if cls.profiler is not None:
+                cls.profiler.disable()
+                path = os.path.join(cls.LOG_DIR, "vr_profile-%s.%s.prof" % (time.strftime("%Y%m%d%H%M%S", time.localtime(cls.started)), os.getpid()))
+                cls.profiler.dump_stats(path)
+                logging.info("Profile written to %s", path)
+                cls.remove_old_profiles()
+        except (IOError, OSError) as e:
+            logging.error("Could not write the timings: %s", e)
+        cls.profiler = None
+
+    @classmethod
+    def remove_old_profiles(cls):
+        profiles = [os.path.join(cls.LOG_DIR, f) for f in os.listdir(cls.LOG_DIR)
+                    if f.startswith("vr_profile-") and f.endswith(".prof")]
+        profiles.sort(key=os.path.getmtime)
+        for path in profiles[:-cls.PROFILE_KEEP]:
+            os.remove(path)
@@ -17,28 +17,64 @@
 
 from netaddr import *
 
+# Secondary indexes of the dhcpentry data bag, built once per process
+# host_name -> key and mac_address -> key
+_index = {'dbag': None, 'size': 0, 'host_name': {}, 'mac_address': {}}
+
+
+def get_index(dbag):
+    """ Return the indexes for dbag, (re)building them if they do not match it """
+    if _index['dbag'] is not dbag or _index['size'] != len(dbag):
+        _index['host_name'] = {}
+        _index['mac_address'] = {}
+        for key, entry in dbag.iteritems():
+            if key == 'id':
+                continue
+            _index['host_name'][entry['host_name']] = key
+            _index['mac_address'][entry['mac_address']] = key
+        _index['dbag'] = dbag
+    return _index
+
+
+def find(dbag, field, value):
+    """ Return the key of the entry with the given host_name or mac_address """
+    key = get_index(dbag)[field].get(value)
+    if key is not None and (key not in dbag or dbag[key][field] != value):
+        # The data bag was changed behind our back
+        _index['dbag'] = None
+        key = get_index(dbag)[field].get(value)
+    return key
+
+
+def remove_entry(dbag, index, key):
+    if key not in dbag:
+        return
+    entry = dbag.pop(key)
+    for field in ('host_name', 'mac_address'):
+        if index[field].get(entry[field]) == key:
+            del index[field][entry[field]]
+
 
 def merge(dbag, data):
+    # Merging a list of entries only builds the indexes once
+    if isinstance(data, list):
+        for entry in data:
+            dbag = merge(dbag, entry)
+        return dbag
+
+    index = get_index(dbag)
     # A duplicate ip address wil clobber the old value
     # This seems desirable ....
     if "add" in data and data['add'] is False and "ipv4_address" in data:
-        if data['ipv4_address'] in dbag:
-            del(dbag[data['ipv4_address']])
+        remove_entry(dbag, index, data['ipv4_address'])
     else:
-        remove_keys = set()
-        for key, entry in dbag.iteritems():
-            if key != 'id' and entry['host_name'] == data['host_name']:
-                remove_keys.add(key)
-                break
-
-        for key, entry in dbag.iteritems():
-            if key != 'id' and entry['mac_address'] == data['mac_address']:
-                remove_keys.add(key)
-                break
-
-        for remove_key in remove_keys:
-            del(dbag[remove_key])
+        remove_entry(dbag, index, find(dbag, 'host_name', data['host_name']))
+        remove_entry(dbag, index, find(dbag, 'mac_address', data['mac_address']))
+        remove_entry(dbag, index, data['ipv4_address'])
 
         dbag[data['ipv4_address']] = data
+        index['host_name'][data['host_name']] = data['ipv4_address']
+        index['mac_address'][data['mac_address']] = data['ipv4_address']
 
+    index['size'] = len(dbag)
     return dbag
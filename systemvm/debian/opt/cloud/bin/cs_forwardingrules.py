@@ -16,6 +16,33 @@
 # under the License.
 
 
+# Position of the rules of every public ip, built once per process
+# public_ip -> (rule list, {ruleKey: position})
+_index = {}
+
+
+def get_index(dbag, source_ip):
+    """ Return the ruleKey -> position index of the rules of source_ip """
+    rules = dbag[source_ip]
+    if source_ip not in _index or _index[source_ip][0] is not rules or len(_index[source_ip][1]) > len(rules):
+        positions = {}
+        # The last matching rule wins
+        for position, forward in enumerate(rules):
+            positions[ruleKey(forward)] = position
+        _index[source_ip] = (rules, positions)
+    return _index[source_ip][1]
+
+
+def find(dbag, source_ip, rule):
+    """ Return the position of the rule of source_ip that matches rule, -1 if there is none """
+    position = get_index(dbag, source_ip).get(ruleKey(rule), -1)
+    if position != -1 and (position >= len(dbag[source_ip]) or not ruleCompare(dbag[source_ip][position], rule)):
+        # The data bag was changed behind our back
+        del _index[source_ip]
+        position = get_index(dbag, source_ip).get(ruleKey(rule), -1)
+    return position
+
+
 def merge(dbag, rules):
     for rule in rules["rules"]:
         source_ip = rule["source_ip_address"]
@@ -38,15 +65,13 @@ def merge(dbag, rules):
             if rules["type"] == "staticnatrules":
                 dbag[source_ip] = [newrule]
             elif rules["type"] == "forwardrules":
-                index = -1
                 if source_ip in dbag.keys():
-                    for forward in dbag[source_ip]:
-                        if ruleCompare(forward, newrule):
-                            index = dbag[source_ip].index(forward)
+                    index = find(dbag, source_ip, newrule)
                     if not index == -1:
                         dbag[source_ip][index] = newrule
                     else:
                         dbag[source_ip].append(newrule)
+                        get_index(dbag, source_ip)[ruleKey(newrule)] = len(dbag[source_ip]) - 1
                 else:
                     dbag[source_ip] = [newrule]
         else:
@@ -55,17 +80,23 @@ def merge(dbag, rules):
                     del dbag[source_ip]
             elif rules["type"] == "forwardrules":
                 if source_ip in dbag.keys():
-                    index = -1
-                    for forward in dbag[source_ip]:
-                        if ruleCompare(forward, newrule):
-                            index = dbag[source_ip].index(forward)
-                            print "removing index %s" % str(index)
+                    index = find(dbag, source_ip, newrule)
                     if not index == -1:
+                        print "removing index %s" % str(index)
                         del dbag[source_ip][index]
+                        # The positions of the following rules have shifted
+                        _index.pop(source_ip, None)
 
     return dbag
 
 
+# Key of the public side of a rule, rules with the same key are equal for ruleCompare
+def ruleKey(rule):
+    if rule["type"] == "forward":
+        return (rule["type"], rule["public_ports"], rule["protocol"])
+    return (rule["type"],)
+
+
 # Compare function checks only the public side, those must be equal the internal details could change
 def ruleCompare(ruleA, ruleB):
     if not ruleA["type"] == ruleB["type"]:
@@ -16,6 +16,7 @@
 # specific language governing permissions and limitations
 # under the License.
 
+import atexit
 import json
 import os
 import uuid
@@ -37,11 +38,18 @@ import cs_site2sitevpn
 import cs_remoteaccessvpn
 import cs_vpnusers
 import cs_staticroutes
+from cs.CsTiming import CsTiming
 
 
 class DataBag:
+    """ Databags are cached for the whole process
+    Every bag is read from disk at most once, saving only marks it dirty.
+    Dirty bags are written back by flush(), which also runs at exit.
+    """
 
     DPATH = "/etc/cloudstack"
+    cache = {}
+    dirty = set()
 
     def __init__(self):
         self.bdata = {}
@@ -52,6 +60,10 @@ class DataBag:
             os.makedirs(self.DPATH)
         self.fpath = os.path.join(self.DPATH, self.key + '.json')
 
+        if self.fpath in DataBag.cache:
+            self.dbag = DataBag.cache[self.fpath]
+            return
+
         try:
             with open(self.fpath, 'r') as _fh:
                 logging.debug("Loading data bag type %s", self.key)
@@ -61,18 +73,31 @@ class DataBag:
             data.update({"id": self.key})
         finally:
             self.dbag = data
+            DataBag.cache[self.fpath] = data
 
     def save(self, dbag):
-        try:
-            with open(self.fpath, 'w') as _fh:
-                logging.debug("Writing data bag type %s", self.key)
-                json.dump(
-                    dbag, _fh,
-                    sort_keys=True,
-                    indent=2
-                )
-        except IOError:
-            logging.error("Could not write data bag %s", self.key)
+        logging.debug("Updating data bag type %s", self.key)
+        self.dbag = dbag
+        DataBag.cache[self.fpath] = dbag
+        DataBag.dirty.add(self.fpath)
+
+    @classmethod
+    def flush(cls):
+        """ Write all the changed data bags, through a temporary file and a rename """
+        for fpath in sorted(cls.dirty):
+            tmp = fpath + '.tmp'
+            try:
+                with open(tmp, 'w') as _fh:
+                    logging.debug("Writing data bag %s", fpath)
+                    json.dump(
+                        cls.cache[fpath], _fh,
+                        sort_keys=True,
+                        indent=2
+                    )
+                os.rename(tmp, fpath)
+            except (IOError, OSError):
+                logging.error("Could not write data bag %s", fpath)
+        cls.dirty.clear()
 
     def getDataBag(self):
         return self.dbag
@@ -81,6 +106,9 @@ class DataBag:
         self.key = key
 
 
+atexit.register(DataBag.flush)
+
+
 class updateDataBag:
 
     DPATH = "/etc/cloudstack"
@@ -89,7 +117,8 @@ class updateDataBag:
         self.qFile = qFile
         self.fpath = ''
         self.bdata = {}
-        self.process()
+        with CsTiming.measure("merge %s" % qFile.type):
+            self.process()
 
     def process(self):
         self.db = DataBag()
@@ -307,6 +336,14 @@ class QueueFile:
     def setFile(self, name):
         self.fileName = name
 
+    def archive(self, name):
+        """ Move a queued file out of the way without processing it """
+        filename = '{cache_location}/{json_file}'.format(cache_location=self.configCache, json_file=name)
+        if self.keep:
+            self.__moveFile(filename, self.configCache + "/processed")
+        else:
+            os.remove(filename)
+
     def getType(self):
         return self.type
 
@@ -17,7 +17,7 @@
 # under the License.
 
 import sys
-from merge import QueueFile
+from merge import QueueFile, DataBag
 import logging
 import subprocess
 from subprocess import PIPE, STDOUT
@@ -25,39 +25,67 @@ import os
 import os.path
 import configure
 import json
-
-logging.basicConfig(filename='/var/log/cloud.log', level=logging.INFO, format='%(asctime)s  %(filename)s %(funcName)s:%(lineno)d %(message)s')
-
-# first commandline argument should be the file to process
-if (len(sys.argv) != 2):
-    print "[ERROR]: Invalid usage"
-    sys.exit(1)
+from cs.CsTiming import CsTiming
 
 # FIXME we should get this location from a configuration class
 jsonPath = "/var/cache/cloud/%s"
-jsonFilename = sys.argv[1]
-jsonConfigFile = jsonPath % jsonFilename
-currentGuestNetConfig = "/etc/cloudstack/guestnetwork.json"
+# Files that were merged but whose converge was deferred (DEFER_CONFIG)
+deferredConfig = jsonPath % "deferred_config"
+# These can be safely deferred, dramatically speeding up loading times
+deferrableTypes = ('vm_dhcp_entry', 'vm_metadata')
+guestnetKeys = ['eth1', 'eth2', 'eth3', 'eth4', 'eth5', 'eth6', 'eth7', 'eth8', 'eth9']
+
 
+def get_json_type(filename):
+    return os.path.basename(filename).split('.json')[0]
 
-def finish_config():
-    # Converge
-    returncode = configure.main(sys.argv)
+
+def finish_config(files):
+    # Write the merged data bags before converging
+    DataBag.flush()
+    # Converge, including everything that was deferred so far
+    deferred = get_deferred()
+    returncode = configure.converge(files + deferred)
+    if deferred:
+        os.remove(deferredConfig)
     sys.exit(returncode)
 
 
-def process_file():
-    print "[INFO] Processing JSON file %s" % sys.argv[1]
+def process_file(filename):
+    print "[INFO] Processing JSON file %s" % filename
     qf = QueueFile()
-    qf.setFile(sys.argv[1])
+    qf.setFile(filename)
     qf.load(None)
-    # These can be safely deferred, dramatically speeding up loading times
-    if not (os.environ.get('DEFER_CONFIG', False) and sys.argv[1] in ('vm_dhcp_entry.json', 'vm_metadata.json')):
-        # Converge
-        finish_config()
 
 
-def is_guestnet_configured(guestnet_dict, keys):
+def is_deferred(filename):
+    return os.environ.get('DEFER_CONFIG', False) and get_json_type(filename) in deferrableTypes
+
+
+def defer_config(filename):
+    print "[INFO] update_config.py :: Deferring converge of %s" % filename
+    with open(deferredConfig, 'a') as f:
+        f.write(filename + '\n')
+
+
+def get_deferred():
+    try:
+        with open(deferredConfig) as f:
+            return [line.strip() for line in f if line.strip()]
+    except IOError:
+        return []
+
+
+def get_queued_files():
+    """ Return the json files waiting in the cache directory, in arrival order
+    cmd_line.json always goes first, or the control interfaces will get deleted
+    """
+    path = os.path.dirname(jsonPath)
+    files = [f for f in os.listdir(path) if '.json' in f and os.path.isfile(os.path.join(path, f))]
+    return sorted(files, key=lambda f: (get_json_type(f) != 'cmd_line', os.path.getmtime(os.path.join(path, f)), f))
+
+
+def is_guestnet_configured(guestnet_dict, keys, jsonConfigFile):
 
     existing_keys = []
     new_eth_key = None
@@ -113,32 +141,89 @@ def is_guestnet_configured(guestnet_dict, keys):
     return exists
 
 
-# If the command line json file is unprocessed process it
-# This is important or, the control interfaces will get deleted!
-if jsonFilename != "cmd_line.json" and os.path.isfile(jsonPath % "cmd_line.json"):
-    qf = QueueFile()
-    qf.setFile("cmd_line.json")
-    qf.load(None)
+def guestnet_needs_processing(jsonConfigFile):
+    # If the guest network is already configured and have the same IP, do not try to configure it again otherwise it will break
+    # Use the cached data bag, an earlier file of the same batch may have changed it
+    db = DataBag()
+    db.setKey("guestnetwork")
+    db.load()
+    guestnet_dict = db.getDataBag()
 
-if not (os.path.isfile(jsonConfigFile) and os.access(jsonConfigFile, os.R_OK)):
-    print "[ERROR] update_config.py :: Unable to read and access %s to process it" % jsonConfigFile
-    sys.exit(1)
+    if guestnet_dict.keys() == ["id"]:
+        print "[INFO] update_config.py :: No GuestNetwork configured yet. Configuring first one now."
+        return True
 
-# If the guest network is already configured and have the same IP, do not try to configure it again otherwise it will break
-if jsonFilename.startswith("guest_network.json"):
-    if os.path.isfile(currentGuestNetConfig):
-        file = open(currentGuestNetConfig)
-        guestnet_dict = json.load(file)
+    if is_guestnet_configured(guestnet_dict, guestnetKeys, jsonConfigFile):
+        print "[INFO] update_config.py :: No need to process Guest Network."
+        return False
+    print "[INFO] update_config.py :: Processing Guest Network."
+    return True
 
-        if not is_guestnet_configured(guestnet_dict, ['eth1', 'eth2', 'eth3', 'eth4', 'eth5', 'eth6', 'eth7', 'eth8', 'eth9']):
-            print "[INFO] update_config.py :: Processing Guest Network."
-            process_file()
-        else:
-            print "[INFO] update_config.py :: No need to process Guest Network."
-            finish_config()
+
+def process_single(jsonFilename):
+    jsonConfigFile = jsonPath % jsonFilename
+
+    # If the command line json file is unprocessed process it
+    # This is important or, the control interfaces will get deleted!
+    if jsonFilename != "cmd_line.json" and os.path.isfile(jsonPath % "cmd_line.json"):
+        qf = QueueFile()
+        qf.setFile("cmd_line.json")
+        qf.load(None)
+
+    if not (os.path.isfile(jsonConfigFile) and os.access(jsonConfigFile, os.R_OK)):
+        print "[ERROR] update_config.py :: Unable to read and access %s to process it" % jsonConfigFile
+        sys.exit(1)
+
+    if jsonFilename.startswith("guest_network.json"):
+        if not guestnet_needs_processing(jsonConfigFile):
+            finish_config([jsonFilename])
     else:
-        print "[INFO] update_config.py :: No GuestNetwork configured yet. Configuring first one now."
-        process_file()
-else:
-    print "[INFO] update_config.py :: Processing incoming file => %s" % sys.argv[1]
-    process_file()
+        print "[INFO] update_config.py :: Processing incoming file => %s" % jsonFilename
+    process_file(jsonFilename)
+    if is_deferred(jsonFilename):
+        defer_config(jsonFilename)
+        return
+    finish_config([jsonFilename])
+
+
+def process_batch():
+    """ Merge every queued json file, then converge once for all of them """
+    processed = []
+    for jsonFilename in get_queued_files():
+        if jsonFilename.startswith("guest_network.json") and not guestnet_needs_processing(jsonPath % jsonFilename):
+            QueueFile().archive(jsonFilename)
+        else:
+            process_file(jsonFilename)
+        processed.append(jsonFilename)
+
+    if not processed and not get_deferred():
+        print "[INFO] update_config.py :: No queued files to process"
+        return
+    print "[INFO] update_config.py :: Merged %s queued files, converging" % len(processed)
+    finish_config(processed)
+
+
+def main(argv):
+    logging.basicConfig(filename='/var/log/cloud.log', level=logging.INFO, format='%(asctime)s  %(filename)s %(funcName)s:%(lineno)d %(message)s')
+
+    # --profile writes a cProfile dump of the run to /var/log/cloud, as does setting VR_PROFILE
+    profile = "--profile" in argv
+    argv = [arg for arg in argv if arg != "--profile"]
+
+    # first commandline argument should be the file to process, or --batch to process all queued files
+    if (len(argv) != 2):
+        print "[ERROR]: Invalid usage"
+        sys.exit(1)
+
+    CsTiming.begin(argv[1:], profile)
+    try:
+        if argv[1] == "--batch":
+            process_batch()
+        else:
+            process_single(argv[1])
+    finally:
+        CsTiming.end()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -80,13 +80,8 @@ done < $cfg
 mv $cfg /var/cache/cloud/processed/
 
 unset DEFER_CONFIG
-# trigger finish_config()
-if [ -f /etc/cloudstack/dhcpentry.json ]; then
-    /opt/cloud/bin/configure.py vm_dhcp_entry.json
-fi
-if [ -f /etc/cloudstack/vmdata.json ]; then
-    /opt/cloud/bin/configure.py vm_metadata.json
-fi
+# trigger finish_config() once for all the deferred and still queued files
+/opt/cloud/bin/update_config.py --batch >> $log 2>&1
 
 # Flush kernel conntrack table
 log_it "VR config: Flushing conntrack table"
@@ -0,0 +1,90 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+""" Measure how long CsDhcp takes to reconfigure dnsmasq
+
+Usage: PYTHONPATH=../debian/opt/cloud/bin python BenchmarkCsDhcp.py [hosts ...]
+
+Files are written to a temporary directory and no command is executed,
+the dnsmasq action (restart or reload) that would have been taken is reported.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import mock
+from netaddr import IPNetwork
+from cs import CsDhcp
+import merge
+
+
+def entry(i):
+    ip = "10.%s.%s.%s" % (1 + i / 62500, (i / 250) % 250, 2 + i % 250)
+    return {"ipv4_address": ip, "host_name": "vm-%s" % i, "mac_address": "02:00:%02x:%02x:%02x:%02x" % (i >> 24 & 255, i >> 16 & 255, i >> 8 & 255, i & 255),
+            "default_entry": True, "default_gateway": "10.0.0.1"}
+
+
+def run(size, tmpdir, config, helper):
+    dbag = {"id": "dhcpentry"}
+    for i in range(size):
+        dbag[entry(i)["ipv4_address"]] = entry(i)
+    dhcp = CsDhcp.CsDhcp("dhcpentry", config)
+    dhcp.dbag = dbag
+
+    def step(name, change):
+        change()
+        helper.reset_mock()
+        start = time.time()
+        dhcp.process()
+        elapsed = time.time() - start
+        actions = [c[0][1] for c in helper.service.call_args_list]
+        print "%6s hosts  %-12s %8.3fs  dnsmasq %s" % (size, name, elapsed, ','.join(actions))
+
+    step("initial", lambda: None)
+    step("unchanged", lambda: None)
+    step("add one", lambda: dbag.update({entry(size)["ipv4_address"]: entry(size)}))
+    step("remove one", lambda: dbag.pop(entry(0)["ipv4_address"]))
+
+
+def main(sizes):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        merge.DataBag.DPATH = tmpdir
+        for name in ("LEASES", "DHCP_HOSTS", "DHCP_OPTS", "CLOUD_CONF", "HOSTS"):
+            setattr(CsDhcp, name, os.path.join(tmpdir, name.lower()))
+
+        config = mock.Mock()
+        config.is_router.return_value = False
+        config.is_vpc.return_value = False
+        config.use_dnsmasq_hup.return_value = True
+        config.get_dns.return_value = ["10.0.0.1"]
+        config.address.return_value.get_guest_netmask.return_value = "255.0.0.0"
+        config.cmdline.return_value.is_redundant.return_value = False
+
+        with mock.patch('cs.CsDhcp.CsHelper') as helper:
+            helper.get_hostname.return_value = "r-1-VM"
+            helper.get_device_info.side_effect = lambda: [{"ip": "10.0.0.1/8", "dev": "eth0", "network": IPNetwork("10.0.0.1/8"), "dnsmasq": False}]
+            for size in sizes:
+                run(size, tmpdir, config, helper)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main([int(i) for i in sys.argv[1:]] or [1000, 5000])
@@ -24,6 +24,7 @@ class TestCsCmdLine(unittest.TestCase):
 
     def setUp(self):
         merge.DataBag.DPATH = "."
+        merge.DataBag.cache.clear()
         self.cscmdline = CsCmdLine('cmdline', {})
 
     def test_ini(self):
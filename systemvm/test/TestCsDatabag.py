@@ -15,6 +15,10 @@
 # specific language governing permissions and limitations
 # under the License.
 
+import json
+import os
+import shutil
+import tempfile
 import unittest
 from cs.CsDatabag import CsDataBag
 import merge
@@ -29,6 +33,23 @@ class TestCsDatabag(unittest.TestCase):
         csdatabag = CsDataBag("koffie")
         self.assertTrue(csdatabag is not None)
 
+    def test_cache(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            merge.DataBag.DPATH = tmpdir
+            csdatabag = CsDataBag("thee")
+            csdatabag.get_bag()['earl'] = 'grey'
+            csdatabag.save()
+            self.assertFalse(os.path.exists(os.path.join(tmpdir, "thee.json")))
+            self.assertEqual(CsDataBag("thee").get_bag()['earl'], 'grey')
+
+            merge.DataBag.flush()
+            with open(os.path.join(tmpdir, "thee.json")) as _fh:
+                self.assertEqual(json.load(_fh), {"id": "thee", "earl": "grey"})
+            self.assertEqual(os.listdir(tmpdir), ["thee.json"])
+        finally:
+            shutil.rmtree(tmpdir)
+
 
 if __name__ == '__main__':
     unittest.main()
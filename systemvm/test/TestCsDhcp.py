@@ -15,10 +15,15 @@
 # specific language governing permissions and limitations
 # under the License.
 
+import os
+import tempfile
 import unittest
 import mock
+from netaddr import IPNetwork
 from cs.CsDhcp import CsDhcp
+from cs import CsDhcp as CsDhcpModule
 from cs import CsHelper
+import cs_dhcp
 import merge
 
 
@@ -33,6 +38,72 @@ class TestCsDhcp(unittest.TestCase):
         csdhcp = CsDhcp("dhcpentry", {})
         self.assertTrue(csdhcp is not None)
 
+    def test_delete_leases(self):
+        fd, leases = tempfile.mkstemp()
+        os.write(fd, "1600000000 02:00:00:00:00:01 10.1.1.2 vm1 *\n"
+                     "1600000000 02:00:00:00:00:02 10.1.1.3 vm2 *\n"
+                     "1600000000 02:00:00:00:00:03 10.1.1.4 vm3 *\n")
+        os.close(fd)
+        try:
+            with mock.patch.object(CsDhcpModule, 'LEASES', leases):
+                csdhcp = CsDhcp("dhcpentry", {})
+                csdhcp.delete_leases(set(["02:00:00:00:00:01", "10.1.1.4"]))
+                self.assertEqual(open(leases).read(), "1600000000 02:00:00:00:00:02 10.1.1.3 vm2 *\n")
+                csdhcp.delete_leases()
+                self.assertEqual(open(leases).read(), "")
+        finally:
+            os.remove(leases)
+
+    def test_release_leases(self):
+        fd, leases = tempfile.mkstemp()
+        os.write(fd, "1600000000 02:00:00:00:00:01 10.1.1.2 vm1 *\n"
+                     "1600000000 02:00:00:00:00:02 10.1.1.3 vm2 *\n"
+                     "1600000000 02:00:00:00:00:03 10.1.1.9 vm3 *\n")
+        os.close(fd)
+        try:
+            with mock.patch.object(CsDhcpModule, 'LEASES', leases):
+                with mock.patch.object(CsHelper, 'execute2') as execute2:
+                    execute2.return_value.returncode = 0
+                    csdhcp = CsDhcp("dhcpentry", {})
+                    csdhcp.devinfo = [{'dev': 'eth0', 'network': IPNetwork('10.1.1.1/24')}]
+                    # The lease of a changed ip is released whatever its mac
+                    self.assertTrue(csdhcp.release_leases(set([("02:00:00:00:00:01", "10.1.1.2"),
+                                                               ("02:00:00:00:00:09", "10.1.1.3")])))
+                    self.assertEqual([c[0][0] for c in execute2.call_args_list],
+                                     ["dhcp_release eth0 10.1.1.2 02:00:00:00:00:01",
+                                      "dhcp_release eth0 10.1.1.3 02:00:00:00:00:02"])
+                    execute2.return_value.returncode = 1
+                    self.assertFalse(csdhcp.release_leases(set([("02:00:00:00:00:03", "10.1.1.9")])))
+                # The leases file is left to dnsmasq
+                self.assertEqual(len(open(leases).readlines()), 3)
+        finally:
+            os.remove(leases)
+
+    def test_merge(self):
+        def entry(ip, host, mac):
+            return {"ipv4_address": ip, "host_name": host, "mac_address": mac, "default_entry": True}
+
+        dbag = {"id": "dhcpentry"}
+        dbag = cs_dhcp.merge(dbag, [entry("10.1.1.2", "vm1", "02:00:00:00:00:01"),
+                                    entry("10.1.1.3", "vm2", "02:00:00:00:00:02")])
+        self.assertEqual(sorted(dbag.keys()), ["10.1.1.2", "10.1.1.3", "id"])
+
+        # Same host name, new ip and mac
+        dbag = cs_dhcp.merge(dbag, entry("10.1.1.4", "vm1", "02:00:00:00:00:03"))
+        self.assertEqual(sorted(dbag.keys()), ["10.1.1.3", "10.1.1.4", "id"])
+
+        # Same mac, new host name
+        dbag = cs_dhcp.merge(dbag, entry("10.1.1.5", "vm3", "02:00:00:00:00:02"))
+        self.assertEqual(sorted(dbag.keys()), ["10.1.1.4", "10.1.1.5", "id"])
+
+        dbag = cs_dhcp.merge(dbag, {"add": False, "ipv4_address": "10.1.1.4"})
+        self.assertEqual(sorted(dbag.keys()), ["10.1.1.5", "id"])
+
+        # Changed outside of merge
+        dbag["10.1.1.7"] = entry("10.1.1.7", "vm7", "02:00:00:00:00:07")
+        dbag = cs_dhcp.merge(dbag, entry("10.1.1.6", "vm7", "02:00:00:00:00:06"))
+        self.assertEqual(sorted(dbag.keys()), ["10.1.1.5", "10.1.1.6", "id"])
+
 
 if __name__ == '__main__':
     unittest.main()
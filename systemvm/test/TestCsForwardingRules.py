@@ -0,0 +1,52 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import unittest
+import cs_forwardingrules
+import merge
+
+
+class TestCsForwardingRules(unittest.TestCase):
+
+    def setUp(self):
+        merge.DataBag.DPATH = "."
+
+    def rules(self, revoke, *rules):
+        return {"type": "forwardrules",
+                "rules": [{"source_ip_address": "172.16.0.10", "destination_ip_address": ip,
+                           "source_port_range": ports, "destination_port_range": ports,
+                           "protocol": "tcp", "revoke": revoke} for ip, ports in rules]}
+
+    def test_merge(self):
+        dbag = {"id": "forwardingrules"}
+        dbag = cs_forwardingrules.merge(dbag, self.rules(False, ("10.1.1.2", "22:22"), ("10.1.1.2", "80:80"), ("10.1.1.3", "443:443")))
+        self.assertEqual([r["public_ports"] for r in dbag["172.16.0.10"]], ["22:22", "80:80", "443:443"])
+
+        # Same public side replaces the rule in place
+        dbag = cs_forwardingrules.merge(dbag, self.rules(False, ("10.1.1.4", "80:80")))
+        self.assertEqual([r["internal_ip"] for r in dbag["172.16.0.10"]], ["10.1.1.2", "10.1.1.4", "10.1.1.3"])
+
+        dbag = cs_forwardingrules.merge(dbag, self.rules(True, ("10.1.1.2", "22:22")))
+        dbag = cs_forwardingrules.merge(dbag, self.rules(False, ("10.1.1.5", "443:443")))
+        self.assertEqual([r["internal_ip"] for r in dbag["172.16.0.10"]], ["10.1.1.4", "10.1.1.5"])
+
+        dbag = cs_forwardingrules.merge(dbag, self.rules(True, ("10.1.1.4", "80:80"), ("10.1.1.5", "443:443")))
+        self.assertEqual(dbag["172.16.0.10"], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import shutil
+import tempfile
+import unittest
+from cs.CsFragment import CsFragment
+import merge
+
+
+class TestCsFragment(unittest.TestCase):
+
+    def setUp(self):
+        merge.DataBag.DPATH = "."
+        self.tmpdir = tempfile.mkdtemp()
+        CsFragment.FRAGMENT_DIR = self.tmpdir
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_cache(self):
+        dbag = {"id": "forwardingrules", "172.16.0.10": [{"type": "forward"}]}
+        fragment = CsFragment("forwardingrules", [dbag])
+        self.assertFalse(fragment.is_current())
+        rules = [["nat", "", "-A PREROUTING -d 172.16.0.10/32 -j DNAT --to-destination 10.1.1.2"],
+                 ["filter", 2, "-A FORWARD -j ACCEPT"]]
+        self.assertEqual(fragment.save(rules), (2, 0))
+
+        fragment = CsFragment("forwardingrules", [dbag])
+        self.assertTrue(fragment.is_current())
+        self.assertEqual(fragment.get_rules(), rules)
+
+        dbag["172.16.0.11"] = []
+        fragment = CsFragment("forwardingrules", [dbag])
+        self.assertFalse(fragment.is_current())
+        self.assertEqual(fragment.save(rules[1:]), (0, 1))
+
+    def test_ipsets(self):
+        fragment = CsFragment("firewallrules", [{"id": "firewallrules"}])
+        self.assertEqual(fragment.get_ipsets(), set())
+        fragment.save([["filter", "", " -I FW_EGRESS_RULES -m set --match-set sourceCidrIpset-3 src "
+                                      " -m set --match-set destCidrIpset-3 dst  -p tcp -m tcp --dport 80 -j ACCEPT"],
+                       ["filter", "", " -A FW_OUTBOUND -j FW_EGRESS_RULES"]])
+        self.assertEqual(fragment.get_ipsets(), set(["sourceCidrIpset-3", "destCidrIpset-3"]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import unittest
+import mock
+from cs.CsIpBatch import CsIpBatch, parse_route, parse_rule
+from cs.CsRoute import CsRoute
+from cs.CsRule import CsRule
+
+IP_OUTPUT = {
+    "ip -o -4 addr show": [
+        "1: lo    inet 127.0.0.1/8 scope host lo\\       valid_lft forever preferred_lft forever",
+        "2: eth0    inet 10.1.1.1/24 brd 10.1.1.255 scope global eth0\\       valid_lft forever preferred_lft forever",
+        "4: eth2    inet 172.16.0.10/24 brd 172.16.0.255 scope global eth2\\       valid_lft forever preferred_lft forever",
+        "4: eth2    inet 172.16.0.11/24 brd 172.16.0.255 scope global secondary eth2\\       valid_lft forever preferred_lft forever"],
+    "ip -o link show": [
+        "2: eth0: <BROADCAST,MULTICAST,UP,LOWER_UP> mtu 1500 qdisc pfifo_fast state UP mode DEFAULT group default qlen 1000",
+        "4: eth2: <BROADCAST,MULTICAST> mtu 1500 qdisc noop state DOWN mode DEFAULT group default qlen 1000"],
+    "ip rule show": [
+        "0:\tfrom all lookup local",
+        "32765:\tfrom all fwmark 0x2 lookup Table_eth2",
+        "32766:\tfrom all lookup main",
+        "32767:\tfrom all lookup default"],
+    "ip -4 route show table all": [
+        "default via 172.16.0.1 dev eth2 table Table_eth2 proto static",
+        "throw 10.1.1.0/24 table Table_eth2 proto static",
+        "default via 172.16.0.1 dev eth2",
+        "10.1.1.0/24 dev eth0 proto kernel scope link src 10.1.1.1",
+        "local 10.1.1.1 dev eth0 table local proto kernel scope host src 10.1.1.1"]
+}
+
+
+class TestCsIpBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.execute = mock.patch('cs.CsIpBatch.CsHelper.execute', side_effect=lambda cmd: IP_OUTPUT.get(cmd, [])).start()
+        self.execute_stdin = mock.patch('cs.CsIpBatch.CsHelper.execute_stdin', return_value=True).start()
+        CsIpBatch.active = False
+
+    def tearDown(self):
+        CsIpBatch.active = False
+        mock.patch.stopall()
+
+    def test_parse(self):
+        self.assertEqual(parse_route("0/0 via 10.0.0.1"), {'type': 'unicast', 'table': 'main', 'prefix': 'default', 'via': '10.0.0.1'})
+        self.assertEqual(parse_route("throw 10.0.0.0/8 table Table_eth1")['type'], 'throw')
+        self.assertEqual(parse_rule("32765:\tfrom all fwmark 0x2 lookup Table_eth2"),
+                         {'priority': '32765', 'from': 'all', 'fwmark': '0x2', 'lookup': 'Table_eth2'})
+        self.assertEqual(parse_rule("fwmark 2 table Table_eth2"), {'fwmark': '0x2', 'lookup': 'Table_eth2'})
+
+    def test_snapshot(self):
+        CsIpBatch.load()
+        self.assertEqual(CsIpBatch.get_addresses("eth2"), ["172.16.0.10/24", "172.16.0.11/24"])
+        self.assertTrue(CsIpBatch.is_link_down("eth2"))
+        self.assertFalse(CsIpBatch.is_link_down("eth0"))
+        self.assertTrue(CsRoute().defaultroute_exists())
+        self.assertTrue(CsRule("eth2").findMark())
+        self.assertFalse(CsRule("eth3").findMark())
+        # Reading the state again does not run any command
+        count = self.execute.call_count
+        CsIpBatch.load()
+        CsRoute().findRule("lookup main")
+        self.assertEqual(self.execute.call_count, count)
+
+    def test_batch(self):
+        CsIpBatch.load()
+        route = CsRoute()
+        route.add_route("eth2", "172.16.0.1")
+        route.add_network_route("eth2", "10.1.1.0/24")
+        route.add_network_route("eth2", "10.1.2.0/24")
+        route.add_network_route("eth2", "10.1.2.0/24")
+        route.flush_table("Table_eth3")
+        CsRule("eth3").addMark()
+        CsRule("eth3").addMark()
+        CsRule("eth2").delMark()
+        CsRule("eth2").addRule("from 172.16.0.0/24")
+        self.assertTrue(CsRule("eth3").findMark())
+        self.assertFalse(CsRule("eth2").findMark())
+        self.execute_stdin.assert_not_called()
+        CsIpBatch.add_address("eth3", "192.168.1.1/24")
+        self.assertEqual(CsIpBatch.get_addresses("eth3"), ["192.168.1.1/24"])
+
+        self.assertTrue(CsIpBatch.commit())
+        self.assertFalse(CsIpBatch.active)
+        self.execute_stdin.assert_called_once_with("ip -force -batch -",
+                                                   "route add throw 10.1.2.0/24 table Table_eth2 proto static\n"
+                                                   "route flush table Table_eth3\n"
+                                                   "rule add fwmark 3 table Table_eth3\n"
+                                                   "rule delete fwmark 2 table Table_eth2\n"
+                                                   "rule add from 172.16.0.0/24 table Table_eth2\n"
+                                                   "route flush cache\n")
+
+    def test_direct(self):
+        CsRule("eth3").addMark()
+        self.execute.assert_any_call("ip rule add fwmark 3 table Table_eth3")
+        self.execute_stdin.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+from cs.CsMetadata import CsMetadataWriter
+import merge
+
+
+class TestCsMetadata(unittest.TestCase):
+
+    def setUp(self):
+        merge.DataBag.DPATH = "."
+        self.tmpdir = tempfile.mkdtemp()
+        CsMetadataWriter.HTML = self.tmpdir
+        CsMetadataWriter.LOCK = os.path.join(self.tmpdir, "lock")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def read(self, *path):
+        return open(os.path.join(self.tmpdir, *path)).read()
+
+    def test_write(self):
+        writer = CsMetadataWriter()
+        for ip in ("10.1.1.2", "10.1.1.3"):
+            writer.add(ip, "metadata", "instance-id", "i-" + ip)
+            writer.add(ip, "metadata", "local-hostname", "vm")
+            writer.add(ip, "userdata", "user-data", "aGVsbG8")
+            writer.add(ip, "password", "vm_password", "secret")
+        writer.commit()
+        self.assertEqual(writer.written, 13)
+
+        self.assertEqual(self.read("userdata", "10.1.1.2", "user-data"), "hello")
+        self.assertEqual(self.read("metadata", "10.1.1.3", "meta-data"), "instance-id\nlocal-hostname\n")
+        self.assertTrue(self.read("metadata", "10.1.1.3", ".htaccess").endswith("Allow from 10.1.1.3\n"))
+        htaccess = self.read("latest", ".htaccess").splitlines()
+        self.assertEqual(htaccess[0], "Options +FollowSymLinks")
+        self.assertEqual(len(htaccess), 3 + 5)
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, "password")))
+
+        writer = CsMetadataWriter()
+        writer.add("10.1.1.2", "metadata", "instance-id", "i-10.1.1.2")
+        writer.add("10.1.1.2", "metadata", "local-hostname", "")
+        writer.commit()
+        self.assertEqual(writer.written, 0)
+        self.assertEqual(writer.unchanged, 5)
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, "metadata", "10.1.1.2", "local-hostname")))
+
+
+if __name__ == '__main__':
+    unittest.main()
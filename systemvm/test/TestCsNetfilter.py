@@ -16,7 +16,8 @@
 # under the License.
 
 import unittest
-from cs.CsNetfilter import CsNetfilter
+import mock
+from cs.CsNetfilter import CsNetfilter, CsNetfilters
 import merge
 
 
@@ -29,6 +30,67 @@ class TestCsNetfilter(unittest.TestCase):
         csnetfilter = CsNetfilter()
         self.assertTrue(csnetfilter is not None)
 
+    def test_has_rule(self):
+        csnetfilters = CsNetfilters(load=False)
+        for table, rule in [("filter", "-A INPUT -i eth0 -m state --state RELATED,ESTABLISHED -j ACCEPT"),
+                            ("filter", "-A INPUT -i eth0 -m state --state RELATED,ESTABLISHED -j ACCEPT"),
+                            ("nat", "-A POSTROUTING -o eth2 -j SNAT --to-source 10.0.0.1")]:
+            live = CsNetfilter()
+            live.parse(rule)
+            live.set_table(table)
+            csnetfilters.save(live)
+
+        new_rule = CsNetfilter()
+        new_rule.parse("-A INPUT -i eth0 -m state --state ESTABLISHED,RELATED -j ACCEPT")
+        new_rule.set_table("filter")
+        self.assertTrue(csnetfilters.has_rule(new_rule))
+        self.assertEqual([r.unseen() for r in csnetfilters.get()], [False, True, True])
+
+        new_rule.set_count(1)
+        self.assertFalse(csnetfilters.has_rule(new_rule))
+
+        other_table = CsNetfilter()
+        other_table.parse("-A POSTROUTING -o eth2 -j SNAT --to-source 10.0.0.1")
+        other_table.set_table("filter")
+        self.assertFalse(csnetfilters.has_rule(other_table))
+
+        csnetfilters.del_rule("nat", "-A POSTROUTING -o eth2 -j SNAT --to-source 10.0.0.1")
+        self.assertEqual(len(csnetfilters.get()), 2)
+
+    @mock.patch('cs.CsNetfilter.CsHelper')
+    def test_compare_restore(self, mock_helper):
+        mock_helper.execute.return_value = ["*filter",
+                                            ":INPUT ACCEPT [0:0]",
+                                            "-A INPUT -i eth9 -j DROP",
+                                            "COMMIT"]
+        mock_helper.execute_stdin.return_value = True
+        csnetfilters = CsNetfilters(restore=True)
+        csnetfilters.compare([["filter", "front", "-A INPUT -i eth0 -p tcp -m tcp --dport 22 -j ACCEPT"],
+                              ["filter", "", "-A ACL_INBOUND_eth2 -j DROP"],
+                              ["nat", "", "-A POSTROUTING -t nat -o eth1 -j ACCEPT"]])
+        self.assertEqual(mock_helper.execute2.call_count, 0)
+        self.assertEqual(mock_helper.execute_stdin.call_count, 2)
+        filter_data = mock_helper.execute_stdin.call_args_list[0][0][1]
+        self.assertEqual(filter_data, "*filter\n"
+                                      "-N ACL_INBOUND_eth2\n"
+                                      "-I INPUT -i eth0 -p tcp -m tcp --dport 22 -j ACCEPT\n"
+                                      "-A ACL_INBOUND_eth2 -j DROP\n"
+                                      "-D INPUT -i eth9 -j DROP\n"
+                                      "COMMIT\n")
+        nat_data = mock_helper.execute_stdin.call_args_list[1][0][1]
+        self.assertTrue("-A POSTROUTING -o eth1 -j ACCEPT\n" in nat_data)
+
+    @mock.patch('cs.CsNetfilter.CsHelper')
+    def test_commit_fallback(self, mock_helper):
+        mock_helper.execute_stdin.return_value = False
+        mock_helper.execute2.return_value.returncode = 0
+        csnetfilters = CsNetfilters(load=False, restore=True)
+        csnetfilters.queue("filter", "-A INPUT -j ACCEPT")
+        csnetfilters.queue("filter", "-A OUTPUT -j ACCEPT")
+        csnetfilters.commit()
+        self.assertEqual(mock_helper.execute2.call_count, 2)
+        mock_helper.execute2.assert_called_with("iptables -t filter -A OUTPUT -j ACCEPT")
+
 
 if __name__ == '__main__':
     unittest.main()
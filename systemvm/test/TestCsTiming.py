@@ -0,0 +1,74 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import mock
+from cs.CsTiming import CsTiming
+from cs import CsHelper
+
+
+class TestCsTiming(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        mock.patch.object(CsTiming, 'LOG_DIR', self.tmpdir).start()
+        mock.patch.object(CsTiming, 'SUMMARY', os.path.join(self.tmpdir, "vr_timings.log")).start()
+
+    def tearDown(self):
+        mock.patch.stopall()
+        shutil.rmtree(self.tmpdir)
+
+    def test_summary(self):
+        CsTiming.begin(["--batch"])
+        with CsTiming.measure("process dhcp"):
+            CsHelper.execute("true")
+            CsHelper.execute2("true")
+        CsTiming.end()
+        CsTiming.begin(["cmd_line.json"])
+        CsTiming.end()
+
+        lines = open(CsTiming.SUMMARY).readlines()
+        self.assertEqual(len(lines), 2)
+        summary = json.loads(lines[0])
+        self.assertEqual(summary["args"], ["--batch"])
+        self.assertEqual([step["name"] for step in summary["steps"]], ["process dhcp"])
+        self.assertEqual(summary["subprocesses"]["count"], 2)
+        self.assertEqual(json.loads(lines[1])["subprocesses"]["count"], 0)
+
+    def test_profile(self):
+        CsTiming.begin(["--batch"], profile=True)
+        CsTiming.end()
+        self.assertEqual(len([f for f in os.listdir(self.tmpdir) if f.endswith(".prof")]), 1)
+
+    def test_profile_keep(self):
+        mock.patch.object(CsTiming, 'PROFILE_KEEP', 2).start()
+        for i in range(3):
+            open(os.path.join(self.tmpdir, "vr_profile-2020010100000%s.1.prof" % i), "w").close()
+            os.utime(os.path.join(self.tmpdir, "vr_profile-2020010100000%s.1.prof" % i), (i, i))
+        CsTiming.begin(["--batch"], profile=True)
+        CsTiming.end()
+        profiles = sorted(f for f in os.listdir(self.tmpdir) if f.endswith(".prof"))
+        self.assertEqual(len(profiles), 2)
+        self.assertTrue("vr_profile-20200101000002.1.prof" in profiles)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+import merge
+import update_config
+
+
+class TestUpdateConfig(unittest.TestCase):
+
+    def setUp(self):
+        merge.DataBag.DPATH = "."
+        self.tmpdir = tempfile.mkdtemp()
+        self.jsonPath = update_config.jsonPath
+        update_config.jsonPath = os.path.join(self.tmpdir, "%s")
+
+    def tearDown(self):
+        update_config.jsonPath = self.jsonPath
+        shutil.rmtree(self.tmpdir)
+
+    def test_get_queued_files(self):
+        os.mkdir(os.path.join(self.tmpdir, "processed"))
+        for i, name in enumerate(["vm_dhcp_entry.json.b", "cmdline", "forwarding_rules.json.a", "cmd_line.json"]):
+            path = os.path.join(self.tmpdir, name)
+            open(path, "w").close()
+            os.utime(path, (i, i))
+        self.assertEqual(update_config.get_queued_files(), ["cmd_line.json", "vm_dhcp_entry.json.b", "forwarding_rules.json.a"])
+
+    def test_get_json_type(self):
+        self.assertEqual(update_config.get_json_type("vm_dhcp_entry.json.0c3e1b"), "vm_dhcp_entry")
+
+
+if __name__ == '__main__':
+    unittest.main()